@@ -1,7 +1,8 @@
 
 
-__all__ = ['frozen', 'frozenrpm', 'frozenpkg']
+__all__ = ['frozen', 'frozenrpm', 'frozendeb', 'frozenpkg']
 
 from frozen import *
 from frozenrpm import *
 from frozentgz import *
+from frozendeb import *
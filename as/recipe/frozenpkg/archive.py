@@ -0,0 +1,327 @@
+
+import os
+import stat
+import time
+import zlib
+import gzip
+import struct
+import tarfile
+import threading
+import subprocess
+import collections
+from multiprocessing.pool import ThreadPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: the compressions supported, and the extension they add to the tar file
+COMPRESSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'xz':   '.xz',
+    'zstd': '.zst',
+}
+
+#: external compressors: they are used with a pipe, with the tar file in their stdin
+EXTERNAL_COMPRESSORS = {
+    'xz':   lambda level, threads: ['xz', '-c', '-%d' % level, '-T%d' % threads],
+    'zstd': lambda level, threads: ['zstd', '-c', '-q', '-%d' % level, '-T%d' % threads],
+}
+
+#: default compression levels
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'xz':   6,
+    'zstd': 3,
+}
+
+#: size of the blocks compressed independently when using several threads with gzip
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+#: size of the reads from the external compressors
+PIPE_READ_SIZE = 64 * 1024
+
+
+
+def collect_tree(buildroot, top, exclude = None):
+    """
+    Return the (path, real path, stat) for all the things we must package in "top"
+    (a directory in the buildroot), sorted by path. Symlinks to things outside the
+    buildroot are dereferenced, and the other symlinks are kept (so nothing in the
+    buildroot is packaged twice). Links to a directory that contains them (or that
+    contains the buildroot) are kept too, so we do not loop forever.
+    """
+    real_buildroot = os.path.realpath(buildroot)
+    entries = []
+    pending = [(top, top, ())]
+    while pending:
+        path, real, parents = pending.pop()
+        st = os.lstat(real)
+        if stat.S_ISLNK(st.st_mode):
+            target = os.path.realpath(real)
+            if os.path.exists(target) and not (target == real_buildroot or
+                                               target.startswith(real_buildroot + os.sep) or
+                                               real_buildroot.startswith(target.rstrip(os.sep) + os.sep)):
+                target_st = os.stat(target)
+                if (target_st.st_dev, target_st.st_ino) in parents:
+                    logger.debug('... keeping link "%s" to a parent directory' % path)
+                else:
+                    real, st = target, target_st
+
+        entries.append((path, real, st))
+        if stat.S_ISDIR(st.st_mode):
+            parents = parents + ((st.st_dev, st.st_ino),)
+            for name in os.listdir(real):
+                child = os.path.join(path, name)
+                if not (exclude and exclude(child)):
+                    pending.append((child, os.path.join(real, name), parents))
+
+    entries.sort()
+    return entries
+
+
+def _gzip_member(data, level):
+    """
+    Compress some data as a complete gzip member
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    header = struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0, 0, 0, 3)
+    body = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack('<LL', zlib.crc32(data) & 0xffffffffL, len(data) & 0xffffffffL)
+    return header + body + trailer
+
+
+class _CountingWriter(object):
+    """
+    A file-like object that counts the bytes written through it
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.written = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.written += len(data)
+
+    def close(self):
+        if isinstance(self.fileobj, gzip.GzipFile):
+            self.fileobj.close()
+
+
+class HashingFile(object):
+    """
+    A file-like object that writes to "fileobj", updating "digest" (a hashlib object)
+    with the data written, so we get the digest of a file while we write it
+    """
+
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.digest.update(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class _ExternalWriter(_CountingWriter):
+    """
+    A file-like object that compresses the data written through it with an external
+    compressor, that writes to "out" (directly when it is a real file, or through a
+    pipe we copy from)
+    """
+
+    def __init__(self, command, out):
+        direct = hasattr(out, 'fileno')
+        try:
+            self.compressor = subprocess.Popen(command, stdin = subprocess.PIPE,
+                                               stdout = out if direct else subprocess.PIPE)
+        except OSError, e:
+            from zc.buildout import UserError
+            raise UserError('could not run "%s": %s' % (' '.join(command), str(e)))
+        self.command = command
+        self._copier, self._copy_error = None, None
+        if not direct:
+            self._copier = threading.Thread(target = self._copy_output, args = (out,))
+            self._copier.daemon = True
+            self._copier.start()
+        _CountingWriter.__init__(self, self.compressor.stdin)
+
+    def _copy_output(self, out):
+        try:
+            for data in iter(lambda: self.compressor.stdout.read(PIPE_READ_SIZE), ''):
+                out.write(data)
+        except Exception, e:
+            self._copy_error = e
+
+    def close(self):
+        self.compressor.stdin.close()
+        if self._copier:
+            self._copier.join()
+        if self.compressor.wait() != 0:
+            raise Exception('could not compress with "%s"' % ' '.join(self.command))
+        if self._copy_error:
+            raise self._copy_error
+
+
+class ParallelGzipWriter(object):
+    """
+    A file-like object that compresses blocks of data in several threads, writing
+    them as a sequence of gzip members (what "pigz" does). The result is a standard
+    gzip file that can be decompressed with any gzip tool.
+    """
+
+    def __init__(self, fileobj, level, threads, block_size = GZIP_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.written = 0
+        self._pool = ThreadPool(threads)
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffer_len = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_len += len(data)
+        self.written += len(data)
+        if self._buffer_len >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        block = ''.join(self._buffer)
+        self._buffer, self._buffer_len = [], 0
+        self._pending.append(self._pool.apply_async(_gzip_member, (block, self.level)))
+
+        ## do not keep too many blocks in memory
+        while len(self._pending) > 2 * self.threads:
+            self.fileobj.write(self._pending.popleft().get())
+
+    def close(self):
+        try:
+            if self._buffer_len or not self._pending:
+                self._flush_block()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().get())
+        finally:
+            self._pool.close()
+            self._pool.join()
+
+
+def utf8(value):
+    """
+    Return a string as UTF-8 bytes (metadata can come as unicode from the options)
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def check_compression(compression, valid = None):
+    """
+    Raise an error if "compression" is not a valid compression
+    """
+    valid = valid or COMPRESSIONS.keys()
+    if not compression in valid:
+        from zc.buildout import UserError
+        raise UserError('unknown compression "%s" (valid compressions: %s)' %
+                        (compression, ', '.join(sorted(valid))))
+
+
+def compressed_writer(out, compression, level = None, threads = 1):
+    """
+    Return a file-like object that compresses everything written through it into "out".
+    The number of uncompressed bytes written is kept in its "written" attribute, and
+    it must be closed (but that does not close "out").
+    """
+    check_compression(compression)
+    if level is None:
+        level = DEFAULT_LEVELS.get(compression, 0)
+
+    if compression == 'gzip' and threads > 1:
+        return ParallelGzipWriter(out, level, threads)
+    elif compression == 'gzip':
+        return _CountingWriter(gzip.GzipFile(filename = '', mode = 'wb', compresslevel = level, fileobj = out))
+    elif compression in EXTERNAL_COMPRESSORS:
+        return _ExternalWriter(EXTERNAL_COMPRESSORS[compression](level, threads), out)
+    else:
+        return _CountingWriter(out)
+
+
+def log_throughput(what, num_entries, written, filename, compression, elapsed, threads):
+    elapsed = max(elapsed, 0.001)
+    uncompressed_mb = written / (1024.0 * 1024.0)
+    compressed_mb = os.path.getsize(filename) / (1024.0 * 1024.0)
+    logger.info('... %s: %d entries, %.1f MB (%.1f MB with %s) in %.1f secs: %.1f MB/s with %d thread(s).' %
+                (what, num_entries, uncompressed_mb, compressed_mb, compression, elapsed,
+                 uncompressed_mb / elapsed, threads))
+
+
+def write_tar(root, filename, compression = 'none', level = None, threads = 1, exclude = None, digest = None):
+    """
+    Write a tar file with all the contents of "root" (but the paths matching "exclude"),
+    in one pass and without modifying anything in "root". The compression extension
+    is added to the filename, and the full filename is returned. When "digest" is not
+    None, it is a hashlib object that is updated with the contents of the file written.
+
+    Symlinks are handled as in the other packages (see collect_tree()), and files that
+    are hardlinks to a file already in the archive are stored as hardlink entries.
+    """
+    check_compression(compression)
+
+    filename = filename + COMPRESSIONS[compression]
+    tmp_filename = filename + '.tmp'
+    out = open(tmp_filename, 'wb')
+    start = time.time()
+    try:
+        stream = compressed_writer(HashingFile(out, digest) if digest else out, compression, level, threads)
+        tar = tarfile.open(fileobj = stream, mode = 'w|')
+        num_entries = _add_tree(tar, root, exclude)
+        tar.close()
+        stream.close()
+    except:
+        ## do not leave a partial file in the output directory
+        os.remove(tmp_filename)
+        raise
+    finally:
+        out.close()
+    os.rename(tmp_filename, filename)
+
+    log_throughput('tar', num_entries, stream.written, filename, compression, time.time() - start, threads)
+    return filename
+
+
+def _add_tree(tar, root, exclude = None):
+    num_entries = 0
+    inodes = {}
+    for path, real, st in collect_tree(root, root, exclude):
+        if path == root:
+            continue
+        tarinfo = tar.gettarinfo(real, arcname = '/' + os.path.relpath(path, root))
+
+        if tarinfo.isreg():
+            inode = (st.st_dev, st.st_ino)
+            if inode in inodes:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = inodes[inode]
+                tarinfo.size = 0
+                tar.addfile(tarinfo)
+                num_entries += 1
+                continue
+            inodes[inode] = tarinfo.name
+
+            f = open(real, 'rb')
+            try:
+                tar.addfile(tarinfo, f)
+            finally:
+                f.close()
+        else:
+            tar.addfile(tarinfo)
+        num_entries += 1
+    return num_entries
@@ -0,0 +1,210 @@
+
+import os
+import stat
+import errno
+import shutil
+import ctypes
+import ctypes.util
+
+from jobs import run_jobs
+from archive import collect_tree
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: the ioctl for cloning a file in Linux (reflinks in btrfs, xfs...)
+FICLONE = 0x40049409
+
+#: maximum size copied in one call to copy_file_range/sendfile
+CHUNK_SIZE = 64 * 1024 * 1024
+
+#: errors meaning "this copy method cannot be used here"
+UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                      errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    except OSError:
+        return None, None
+
+    copy_file_range = getattr(libc, 'copy_file_range', None)
+    if copy_file_range:
+        copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_size_t, ctypes.c_uint]
+        copy_file_range.restype = ctypes.c_ssize_t
+
+    sendfile = getattr(libc, 'sendfile', None)
+    if sendfile:
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+        sendfile.restype = ctypes.c_ssize_t
+
+    return copy_file_range, sendfile
+
+_copy_file_range, _sendfile = _load_libc()
+
+
+def reflink(src, dst):
+    """
+    Try to clone "src" as "dst" sharing their data blocks. Return True if it could be done.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    src_file = open(src, 'rb')
+    try:
+        dst_file = open(dst, 'wb')
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except (IOError, OSError):
+            dst_file.close()
+            os.remove(dst)
+            return False
+        dst_file.close()
+    finally:
+        src_file.close()
+    return True
+
+
+def _kernel_copy(src, dst):
+    """
+    Copy a file with copy_file_range (or sendfile), so the data never goes through
+    our buffers. Return True if it could be done.
+    """
+    for func in (_copy_file_range, _sendfile):
+        if not func:
+            continue
+
+        src_file = open(src, 'rb')
+        dst_file = open(dst, 'wb')
+        try:
+            size = os.fstat(src_file.fileno()).st_size
+            copied = 0
+            while copied < size:
+                count = min(size - copied, CHUNK_SIZE)
+                if func is _copy_file_range:
+                    n = func(src_file.fileno(), None, dst_file.fileno(), None, count, 0)
+                else:
+                    n = func(dst_file.fileno(), src_file.fileno(), None, count)
+                if n < 0:
+                    err = ctypes.get_errno()
+                    if copied == 0 and err in UNSUPPORTED_ERRNOS:
+                        break
+                    raise OSError(err, os.strerror(err), src)
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return True
+        finally:
+            src_file.close()
+            dst_file.close()
+    return False
+
+
+def copy_file(src, dst, hardlink = False, preserve_times = True):
+    """
+    Copy a file with the fastest method available: a reflink, a hardlink (only when
+    "hardlink" is True, as then both files are the same file), the kernel copy
+    functions, or a regular copy. "dst" can be a directory.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if hardlink:
+        try:
+            os.link(os.path.realpath(src), dst)
+            return dst
+        except OSError:
+            pass
+
+    if not reflink(src, dst) and not _kernel_copy(src, dst):
+        shutil.copyfile(src, dst)
+
+    if preserve_times:
+        shutil.copystat(src, dst)
+    else:
+        shutil.copymode(src, dst)
+    return dst
+
+
+def copy_tree(src, dst, hardlink = False, jobs = 1, exclude = None):
+    """
+    Copy a directory tree (like "shutil.copytree", following symlinks), copying
+    the files with "jobs" threads. Destination paths matching "exclude" are not copied.
+    """
+    if exclude and exclude(dst):
+        return 0
+
+    pairs = []
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(src, followlinks = True):
+        dest_dir = os.path.normpath(os.path.join(dst, os.path.relpath(dirpath, src)))
+        if exclude:
+            dirnames[:] = [d for d in dirnames if not exclude(os.path.join(dest_dir, d))]
+            filenames = [f for f in filenames if not exclude(os.path.join(dest_dir, f))]
+        os.makedirs(dest_dir)
+        dirs.append((dirpath, dest_dir))
+        for filename in filenames:
+            pairs.append((os.path.join(dirpath, filename), os.path.join(dest_dir, filename)))
+
+    run_jobs(lambda pair: copy_file(pair[0], pair[1], hardlink), pairs, jobs)
+
+    for dirpath, dest_dir in dirs:
+        shutil.copystat(dirpath, dest_dir)
+    return len(pairs)
+
+
+def link_tree(src, dst, exclude = None):
+    """
+    Replicate "src" at "dst" with hardlinks (or copies, when we cannot link).
+    Destination paths matching "exclude" are skipped (and reported to its "skipped"
+    method, if it has one).
+    """
+    if exclude and exclude(dst):
+        if hasattr(exclude, 'skipped'):
+            exclude.skipped(src, dst)
+        return
+    if os.path.isdir(src) and not os.path.islink(src):
+        os.makedirs(dst)
+        for name in os.listdir(src):
+            link_tree(os.path.join(src, name), os.path.join(dst, name), exclude)
+    elif os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    else:
+        try:
+            os.link(src, dst)
+        except OSError:
+            copy_file(src, dst)
+
+
+def link_packaged_tree(buildroot, top, dest_root, exclude = None):
+    """
+    Replicate "top" (a directory in the buildroot) at the same path in "dest_root",
+    as it goes in the packages (see collect_tree()) and without modifying the
+    buildroot: its files are hardlinked, and the targets of the symlinks that
+    are dereferenced are copied.
+    """
+    real_buildroot = os.path.realpath(buildroot)
+    dirs = []
+    for path, real, st in collect_tree(buildroot, top, exclude):
+        dest = os.path.join(dest_root, os.path.relpath(path, buildroot))
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            dirs.append((real, dest))
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(real), dest)
+        else:
+            copy_file(real, dest, hardlink = os.path.realpath(real).startswith(real_buildroot + os.sep))
+
+    for real, dest in dirs:
+        shutil.copystat(real, dest)
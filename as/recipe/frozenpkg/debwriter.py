@@ -0,0 +1,269 @@
+
+import os
+import stat
+import time
+import hashlib
+import tarfile
+import tempfile
+import StringIO
+
+from archive import compressed_writer, check_compression, collect_tree, log_throughput, HashingFile, COMPRESSIONS, utf8
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+AR_MAGIC = '!<arch>\n'
+
+#: the Debian architectures for the machines reported by "uname"
+DEB_ARCHITECTURES = {
+    'x86_64':  'amd64',
+    'i386':    'i386',
+    'i486':    'i386',
+    'i586':    'i386',
+    'i686':    'i386',
+    'aarch64': 'arm64',
+    'armv7l':  'armhf',
+    'ppc64le': 'ppc64el',
+}
+
+#: the Debian operators for the operators in the dependencies
+DEB_OPERATORS = {
+    '<':  '<<',
+    '<=': '<=',
+    '=':  '=',
+    '>=': '>=',
+    '>':  '>>',
+}
+
+READ_SIZE = 1024 * 1024
+
+
+
+def deb_architecture():
+    machine = os.uname()[4]
+    return DEB_ARCHITECTURES.get(machine, machine)
+
+
+def deb_package_name(name):
+    """
+    A valid Debian package name (lowercase, and no underscores) for "name"
+    """
+    return name.lower().replace('_', '-')
+
+
+def _ar_member_header(name, size, mtime, mode = 0100644):
+    return '%-16s%-12d%-6d%-6d%-8o%-10d`\n' % (name, mtime, 0, 0, mode, size)
+
+
+def _ar_member(out, name, data, mtime):
+    out.write(_ar_member_header(name, len(data), mtime))
+    out.write(data)
+    if len(data) % 2:
+        out.write('\n')
+
+
+class _HashingReader(object):
+    """
+    A file-like object that computes the MD5 of everything read through it
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+
+    def read(self, size = -1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        return data
+
+
+def write_deb(dest_dir, buildroot, prefix, metadata, compression = 'gzip', level = None, threads = 1,
+              exclude = None, config = None, digest = None):
+    """
+    Write a Debian binary package at "dest_dir" with the contents of "prefix" in the
+    buildroot (but the paths matching "exclude"), returning the file written.
+
+    "metadata" has the information for the control file: name, version, release,
+    description, maintainer, url, section, deps (parsed), pre/post (the install scripts),
+    def_user/def_group (the owner of the files) and def_mode (the mode of the directories).
+    The files matching "config" are marked as conffiles. When "digest" is not None,
+    it is a hashlib object that is updated with the contents of the file written.
+    """
+    check_compression(compression)
+
+    arch = deb_architecture()
+    name = deb_package_name(metadata['name'])
+    version = '%s-%s' % (metadata['version'], metadata['release'])
+    filename = os.path.join(dest_dir, '%s_%s_%s.deb' % (name, version, arch))
+    start = time.time()
+    mtime = int(start)
+
+    entries = collect_tree(buildroot, os.path.normpath(buildroot + '/' + prefix), exclude)
+
+    ## the data goes to a temporary file, as the control archive (that goes before
+    ## the data in the package) needs the sizes and digests we get while writing it
+    data_file = tempfile.TemporaryFile(dir = dest_dir)
+    try:
+        stream = compressed_writer(data_file, compression, level, threads)
+        data_tar = tarfile.open(fileobj = stream, mode = 'w|', format = tarfile.GNU_FORMAT)
+        md5sums, conffiles, installed_size = _add_data(data_tar, buildroot, prefix, entries, metadata, mtime, config)
+        data_tar.close()
+        stream.close()
+
+        control = _control(metadata, name, version, arch, installed_size)
+        control_tar = _control_tar(control, metadata, md5sums, conffiles, mtime)
+
+        tmp_filename = filename + '.tmp'
+        out = open(tmp_filename, 'wb')
+        try:
+            dest = HashingFile(out, digest) if digest else out
+            dest.write(AR_MAGIC)
+            _ar_member(dest, 'debian-binary', '2.0\n', mtime)
+            _ar_member(dest, 'control.tar.gz', control_tar, mtime)
+
+            data_size = data_file.tell()
+            dest.write(_ar_member_header('data.tar' + COMPRESSIONS[compression], data_size, mtime))
+            data_file.seek(0)
+            while True:
+                data = data_file.read(READ_SIZE)
+                if not data:
+                    break
+                dest.write(data)
+            if data_size % 2:
+                dest.write('\n')
+        finally:
+            out.close()
+        os.rename(tmp_filename, filename)
+    finally:
+        data_file.close()
+
+    log_throughput('deb', len(entries), stream.written, filename, compression, time.time() - start, threads)
+    return filename
+
+
+def _tarinfo(name, mode, mtime, metadata):
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(mode)
+    info.mtime = mtime
+    info.uname = metadata['def_user']
+    info.gname = metadata['def_group']
+    return info
+
+
+def _add_data(tar, buildroot, prefix, entries, metadata, mtime, config):
+    """
+    Add the entries to the data archive, returning the MD5 sums, the conffiles and the installed size (in KB)
+    """
+    ## the parents of the prefix
+    parents = []
+    parent = os.path.dirname(os.path.normpath('/' + prefix.lstrip('/')))
+    while parent != '/':
+        parents.insert(0, parent)
+        parent = os.path.dirname(parent)
+    for parent in ['/'] + parents:
+        info = _tarinfo('.' + parent.rstrip('/') + '/', 0755, mtime, metadata)
+        info.type = tarfile.DIRTYPE
+        info.uname = info.gname = 'root'
+        tar.addfile(info)
+
+    md5sums, conffiles = [], []
+    installed_size = 0
+    inodes = {}
+    for path, real, st in entries:
+        name = '/' + os.path.relpath(path, buildroot)
+        info = _tarinfo('.' + name, st.st_mode, int(st.st_mtime), metadata)
+        if stat.S_ISDIR(st.st_mode):
+            info.name += '/'
+            info.type = tarfile.DIRTYPE
+            info.mode = metadata['def_mode']
+            tar.addfile(info)
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(real)
+            tar.addfile(info)
+        elif stat.S_ISREG(st.st_mode):
+            inode = (st.st_dev, st.st_ino)
+            if inode in inodes:
+                ## a hardlink to a file we have already added
+                info.type = tarfile.LNKTYPE
+                info.linkname, md5 = inodes[inode]
+                tar.addfile(info)
+            else:
+                info.size = st.st_size
+                f = open(real, 'rb')
+                try:
+                    reader = _HashingReader(f)
+                    tar.addfile(info, reader)
+                finally:
+                    f.close()
+                md5 = reader.md5.hexdigest()
+                inodes[inode] = (info.name, md5)
+                installed_size += st.st_size
+            md5sums.append('%s  %s\n' % (md5, name.lstrip('/')))
+            if config and config(path):
+                conffiles.append(name + '\n')
+        else:
+            continue
+
+    return md5sums, conffiles, (installed_size + 1023) / 1024
+
+
+def _control(metadata, name, version, arch, installed_size):
+    fields = [
+        ('Package', name),
+        ('Version', version),
+        ('Architecture', arch),
+        ('Maintainer', metadata['maintainer']),
+        ('Installed-Size', str(installed_size)),
+    ]
+    if metadata['deps']:
+        deps = []
+        for dep_name, operator, dep_version in metadata['deps']:
+            if operator:
+                deps.append('%s (%s %s)' % (dep_name, DEB_OPERATORS[operator], dep_version))
+            else:
+                deps.append(dep_name)
+        fields.append(('Depends', ', '.join(deps)))
+    if metadata['section']:
+        fields.append(('Section', metadata['section']))
+    fields.append(('Priority', 'optional'))
+    if metadata['url']:
+        fields.append(('Homepage', metadata['url']))
+
+    ## the extended description: every line starts with a space, and empty lines are " ."
+    description = metadata['description'].strip().splitlines() or [name]
+    extended = [' ' + (line.rstrip() or '.') for line in description[1:]]
+    fields.append(('Description', '\n'.join([description[0]] + extended)))
+    return ''.join(['%s: %s\n' % field for field in fields])
+
+
+def _control_tar(control, metadata, md5sums, conffiles, mtime):
+    """
+    Return the (gzipped) control archive
+    """
+    members = [('control', control, 0644), ('md5sums', ''.join(md5sums), 0644)]
+    if conffiles:
+        members.append(('conffiles', ''.join(conffiles), 0644))
+    for script, commands in [('preinst', metadata['pre']), ('postinst', metadata['post'])]:
+        if commands:
+            members.append((script, '#!/bin/sh\n' + commands + '\n', 0755))
+
+    buf = StringIO.StringIO()
+    tar = tarfile.open(fileobj = buf, mode = 'w:gz', format = tarfile.GNU_FORMAT)
+    info = tarfile.TarInfo('./')
+    info.type = tarfile.DIRTYPE
+    info.mode = 0755
+    info.mtime = mtime
+    tar.addfile(info)
+    for name, contents, mode in members:
+        contents = utf8(contents)
+        info = tarfile.TarInfo('./' + name)
+        info.size = len(contents)
+        info.mode = mode
+        info.mtime = mtime
+        info.uname = info.gname = 'root'
+        tar.addfile(info, StringIO.StringIO(contents))
+    tar.close()
+    return buf.getvalue()
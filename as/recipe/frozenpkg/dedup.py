@@ -0,0 +1,103 @@
+
+import os
+import stat
+import hashlib
+import tempfile
+
+from jobs import run_jobs
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+READ_SIZE = 1024 * 1024
+
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def _link(src, dst):
+    """
+    Replace "dst" by a hardlink to "src" (atomically: "dst" always exists)
+    """
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(dst), prefix = '.dedup-')
+    os.close(fd)
+    os.remove(tmp_path)
+    os.link(src, tmp_path)
+    try:
+        os.rename(tmp_path, dst)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def find_duplicates(root, jobs = 1, exclude = None):
+    """
+    Return the groups of identical files in "root" (but those matching "exclude"),
+    hashing the files with "jobs" threads. Only files with the same size are hashed,
+    and files that are already hardlinks to each other are only hashed once. Files
+    with different modes are never in the same group (a hardlink has only one mode),
+    and neither are ".py" files with different modification times (their bytecode
+    would not be valid anymore).
+    """
+    by_size = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        if exclude:
+            dirnames[:] = [d for d in dirnames if not exclude(os.path.join(dirpath, d))]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if exclude and exclude(path):
+                continue
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                mtime = int(st.st_mtime) if filename.endswith('.py') else None
+                by_size.setdefault((st.st_size, st.st_mode, mtime), []).append((path, st))
+
+    ## only one path for every inode
+    candidates = []
+    for key, files in by_size.items():
+        inodes = {}
+        for path, st in files:
+            inodes.setdefault((st.st_dev, st.st_ino), []).append(path)
+        if len(inodes) > 1:
+            candidates += [(key, sorted(paths)) for paths in inodes.values()]
+
+    digests = run_jobs(lambda candidate: _hash_file(candidate[1][0]), candidates, jobs)
+
+    groups = {}
+    for (key, paths), digest in zip(candidates, digests):
+        groups.setdefault((key, digest), []).append(paths)
+    return [sorted(g) for g in groups.values() if len(g) > 1]
+
+
+def dedup_tree(root, jobs = 1, exclude = None):
+    """
+    Replace the identical files in "root" by hardlinks to one of them (files are never
+    modified, so it is safe even when they are hardlinks to files in some cache).
+    Return the number of files replaced and the bytes saved.
+    """
+    num_files, num_bytes = 0, 0
+    for group in find_duplicates(root, jobs, exclude):
+        ## every item in the group is a list of paths for the same inode
+        src = group[0][0]
+        size = os.lstat(src).st_size
+        for paths in group[1:]:
+            for path in paths:
+                logger.debug('... linking "%s" to "%s"' % (path, src))
+                _link(src, path)
+                num_files += 1
+            num_bytes += size
+    return num_files, num_bytes
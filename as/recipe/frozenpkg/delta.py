@@ -0,0 +1,452 @@
+
+import os
+import stat
+import time
+import json
+import struct
+import hashlib
+import tarfile
+import tempfile
+import threading
+import StringIO
+import subprocess
+import contextlib
+from distutils.spawn import find_executable
+
+from archive import collect_tree, compressed_writer, HashingFile
+from runner import run
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: extension of the files manifests (the files in a package, with their digests)
+FILES_MANIFEST_EXT = '.files.json'
+
+#: extension of the delta tarballs
+DELTA_EXT = '.delta.tar.gz'
+
+#: the magic bytes of the compressed streams we can read, and the tools for decompressing them
+DECOMPRESSORS = [
+    ('\x1f\x8b',            ['gzip', '-dc']),
+    ('BZh',                 ['bzip2', '-dc']),
+    ('\xfd7zXZ\x00',        ['xz', '-dc']),
+    ('\x28\xb5\x2f\xfd',    ['zstd', '-dc', '-q']),
+]
+
+#: RPM header tags we read from the previous packages
+RPMTAG_NAME, RPMTAG_VERSION, RPMTAG_RELEASE, RPMTAG_ARCH = 1000, 1001, 1002, 1022
+
+#: size of the reads when hashing files
+READ_SIZE = 1024 * 1024
+
+#: the script that applies a delta on a host where the previous package is installed
+APPLY_SCRIPT = '''#!/bin/sh
+# Apply the delta from @FROM@ to @TO@: extract the delta
+# and run "sh apply-delta.sh [ROOT]" (ROOT is where the package is installed, default: /)
+set -e
+ROOT="${1:-/}"
+HERE="$(cd "$(dirname "$0")" && pwd)"
+if [ ! -d "$ROOT/@PREFIX@" ]; then
+    echo "@PREFIX@ is not installed at $ROOT" >&2
+    exit 1
+fi
+while IFS= read -r path; do
+    if [ -n "$path" ]; then
+        rm -rf "$ROOT/$path"
+    fi
+done < "$HERE/deleted.txt"
+tar -C "$ROOT" -xpf "$HERE/files.tar"
+echo "@TO@ applied at $ROOT"
+'''
+
+
+
+def _hash_stream(f):
+    h = hashlib.sha256()
+    for data in iter(lambda: f.read(READ_SIZE), ''):
+        h.update(data)
+    return h.hexdigest()
+
+
+def _hash_file(path):
+    f = open(path, 'rb')
+    try:
+        return _hash_stream(f)
+    finally:
+        f.close()
+
+
+def _name(path):
+    return path.lstrip('.').lstrip('/')
+
+
+def tree_files(buildroot, top, exclude = None):
+    """
+    Return the files in "top" (a directory in the buildroot) as they are packaged in
+    RPMs and debs, as a dictionary with the path (relative to the buildroot) and an
+    entry: ['f', sha256, mode] for files, ['l', target, sha256 of the target] for
+    symlinks and ['d', None, mode] for directories.
+    """
+    files = {}
+    digests = {}
+    for path, real, st in collect_tree(buildroot, top, exclude):
+        name = os.path.relpath(path, buildroot)
+        if stat.S_ISLNK(st.st_mode):
+            target_sha256 = _hash_file(real) if os.path.isfile(real) else None
+            files[name] = ['l', os.readlink(real), target_sha256]
+        elif stat.S_ISDIR(st.st_mode):
+            files[name] = ['d', None, stat.S_IMODE(st.st_mode)]
+        elif stat.S_ISREG(st.st_mode):
+            ## hardlinks are only hashed once
+            inode = (st.st_dev, st.st_ino)
+            if not inode in digests:
+                digests[inode] = _hash_file(real)
+            files[name] = ['f', digests[inode], stat.S_IMODE(st.st_mode)]
+    return files
+
+
+def write_files_manifest(filename, files, info):
+    """
+    Save the files of a package (and some "info" about it, like its name and version)
+    """
+    tmp_filename = filename + '.tmp'
+    f = open(tmp_filename, 'w')
+    try:
+        json.dump(dict(info, files = files), f, indent = 1, sort_keys = True)
+    finally:
+        f.close()
+    os.rename(tmp_filename, filename)
+    return filename
+
+
+def _copy_input(f, size, out):
+    try:
+        while size:
+            data = f.read(min(size, READ_SIZE))
+            if not data:
+                break
+            out.write(data)
+            size -= len(data)
+    except IOError:
+        ## the decompressor has finished without reading everything
+        pass
+    finally:
+        out.close()
+
+
+@contextlib.contextmanager
+def _decompressed(f, offset, size = None):
+    """
+    Return a stream with the contents of "f" from "offset" (and only "size" bytes,
+    if it is not None), decompressed if they are compressed
+    """
+    f.seek(offset)
+    magic = f.read(6)
+    f.seek(offset)
+    command = None
+    for prefix, decompressor in DECOMPRESSORS:
+        if magic.startswith(prefix):
+            command = decompressor
+    if command is None:
+        yield f
+        return
+
+    if size is None:
+        ## the decompressor reads the file descriptor from the current position
+        os.lseek(f.fileno(), offset, os.SEEK_SET)
+        job = subprocess.Popen(command, stdin = f, stdout = subprocess.PIPE)
+        copier = None
+    else:
+        job = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        copier = threading.Thread(target = _copy_input, args = (f, size, job.stdin))
+        copier.daemon = True
+        copier.start()
+    try:
+        yield job.stdout
+    finally:
+        job.stdout.close()
+        job.wait()
+        if copier:
+            copier.join()
+
+
+def _tar_files(stream):
+    files = {}
+    tar = tarfile.open(fileobj = stream, mode = 'r|')
+    for member in tar:
+        name = _name(member.name)
+        if not name:
+            continue
+        if member.isfile():
+            files[name] = ['f', _hash_stream(tar.extractfile(member)), member.mode & 07777]
+        elif member.islnk():
+            files[name] = list(files.get(_name(member.linkname), ['f', None, member.mode & 07777]))
+        elif member.issym():
+            files[name] = ['l', member.linkname, None]
+        elif member.isdir():
+            files[name] = ['d', None, member.mode & 07777]
+    return files
+
+
+def _rpm_header(f):
+    """
+    Read a RPM header at the current position, returning its string tags
+    """
+    magic, nindex, hsize = struct.unpack('>8sII', f.read(16))
+    if not magic.startswith('\x8e\xad\xe8\x01'):
+        raise ValueError('not a RPM header')
+    index = f.read(16 * nindex)
+    data = f.read(hsize)
+    tags = {}
+    for i in range(nindex):
+        tag, type, offset, count = struct.unpack('>IIII', index[i * 16:(i + 1) * 16])
+        if type == 6:
+            tags[tag] = data[offset:data.index('\0', offset)]
+    return tags, 16 + 16 * nindex + hsize
+
+
+def rpm_info(filename):
+    """
+    Return the name, version, release and arch of a RPM, and the offset of its payload
+    """
+    f = open(filename, 'rb')
+    try:
+        f.seek(96)
+        _, sig_size = _rpm_header(f)
+        f.seek(96 + sig_size + (-sig_size % 8))
+        tags, header_size = _rpm_header(f)
+        info = {
+            'name':     tags.get(RPMTAG_NAME),
+            'version':  tags.get(RPMTAG_VERSION),
+            'release':  tags.get(RPMTAG_RELEASE),
+            'arch':     tags.get(RPMTAG_ARCH),
+        }
+        return info, 96 + sig_size + (-sig_size % 8) + header_size
+    finally:
+        f.close()
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError('truncated cpio archive')
+    return data
+
+
+def _cpio_files(stream):
+    files = {}
+    links = {}
+    while True:
+        header = _read_exactly(stream, 110)
+        fields = [int(header[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+        ino, mode, nlink, size, namesize = fields[0], fields[1], fields[4], fields[6], fields[11]
+        name = _read_exactly(stream, namesize)[:-1]
+        _read_exactly(stream, -(110 + namesize) % 4)
+        if name == 'TRAILER!!!':
+            break
+
+        name = _name(name)
+        if stat.S_ISREG(mode):
+            ## the data of a set of hardlinks goes with the last one of them
+            h = hashlib.sha256()
+            remaining = size
+            while remaining:
+                data = _read_exactly(stream, min(remaining, READ_SIZE))
+                h.update(data)
+                remaining -= len(data)
+            files[name] = ['f', h.hexdigest(), stat.S_IMODE(mode)]
+            if nlink > 1:
+                links.setdefault(ino, []).append(name)
+                if size:
+                    for link in links[ino]:
+                        files[link][1] = h.hexdigest()
+        elif stat.S_ISLNK(mode):
+            files[name] = ['l', _read_exactly(stream, size), None]
+        elif stat.S_ISDIR(mode):
+            files[name] = ['d', None, stat.S_IMODE(mode)]
+        _read_exactly(stream, -size % 4)
+    return files
+
+
+def _deb_files(f):
+    if f.read(8) != '!<arch>\n':
+        raise ValueError('not a Debian package')
+    while True:
+        header = f.read(60)
+        if len(header) < 60:
+            raise ValueError('no data in the Debian package')
+        name, size = header[:16].strip().rstrip('/'), int(header[48:58])
+        if name.startswith('data.tar'):
+            with _decompressed(f, f.tell(), size) as stream:
+                return _tar_files(stream)
+        f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def load_files(filename):
+    """
+    Return the files of a previous package (a files manifest, a tar file, a RPM
+    or a deb) and what we know about it (its name, version...)
+    """
+    info = {'package': os.path.basename(filename)}
+    if filename.endswith('.json'):
+        manifest = json.load(open(filename))
+        files = manifest.pop('files')
+        info.update(manifest)
+        return files, info
+
+    f = open(filename, 'rb')
+    try:
+        if filename.endswith('.rpm'):
+            rpm, payload_offset = rpm_info(filename)
+            info.update(rpm)
+            with _decompressed(f, payload_offset) as stream:
+                return _cpio_files(stream), info
+        elif filename.endswith('.deb'):
+            return _deb_files(f), info
+        else:
+            with _decompressed(f, 0) as stream:
+                return _tar_files(stream), info
+    finally:
+        f.close()
+
+
+def diff_files(old, new, top):
+    """
+    Return the paths that are new or have changed in "new", and the paths that must
+    be removed (the paths in "top" that are not in "new", or that have changed their
+    type). Symlinks that were dereferenced in the previous package (ie, in the tar files
+    built by older versions) are the same when they have the same contents.
+    """
+    top = top.strip('/')
+    old = dict([(path, entry) for path, entry in old.items() if path == top or path.startswith(top + '/')])
+    changed, deleted = [], []
+    for path, entry in sorted(new.items()):
+        prev = old.get(path)
+        if prev is not None:
+            prev, entry = list(prev), list(entry)
+            if prev == entry or (prev[0] == 'd' and entry[0] == 'd') or \
+               (prev[0] == 'l' and entry[0] == 'l' and prev[1] == entry[1]):
+                continue
+            if entry[0] == 'l' and (prev[0] == 'd' or (prev[0] == 'f' and prev[1] == entry[2])):
+                continue
+            if prev[0] != entry[0]:
+                deleted.append(path)
+        changed.append(path)
+
+    ## the contents of dereferenced links to directories are not removed, and
+    ## the contents of the directories removed are removed with them
+    linked = set([path for path, entry in new.items() if entry[0] == 'l'])
+    removed = set(deleted)
+    for path in sorted(old.keys()):
+        if path in new:
+            continue
+        removed.add(path)
+        parents = path.split('/')
+        if [i for i in range(1, len(parents)) if '/'.join(parents[:i]) in linked or
+                                                 '/'.join(parents[:i]) in removed]:
+            continue
+        deleted.append(path)
+    return changed, deleted
+
+
+def _add_data(tar, name, data, mode = 0644):
+    info = tarfile.TarInfo(name)
+    info.size, info.mode, info.mtime = len(data), mode, time.time()
+    tar.addfile(info, StringIO.StringIO(data))
+
+
+def _tarinfo(buildroot, path, kind, attrs):
+    """
+    The entry for a path in the buildroot, with the owner and the mode of the
+    directories used in the packages (and not the ones of the user building them)
+    """
+    full_path = os.path.join(buildroot, path)
+    ## the links that are dereferenced when packaging are dereferenced here too
+    st = os.lstat(full_path) if kind == 'l' else os.stat(full_path)
+    info = tarfile.TarInfo(path)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = int(st.st_mtime)
+    info.uid = info.gid = 0
+    info.uname = attrs['def_user']
+    info.gname = attrs['def_group']
+    if kind == 'l':
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(full_path)
+    elif kind == 'd':
+        info.type = tarfile.DIRTYPE
+        info.mode = attrs['def_mode']
+    else:
+        info.size = st.st_size
+    return info
+
+
+def write_delta(filename, buildroot, prefix, new, changed, deleted, description, attrs, digest = None):
+    """
+    Write a delta tarball with the "changed" paths in the buildroot (in "files.tar"),
+    the "deleted" paths (in "deleted.txt") and a script that applies them. Files are
+    owned by the "def_user" and "def_group" in "attrs", and directories get its
+    "def_mode", as in the packages. When "digest" is not None, it is updated with
+    the contents of the file written.
+    """
+    files_tar = tempfile.TemporaryFile(dir = os.path.dirname(filename))
+    try:
+        tar = tarfile.open(fileobj = files_tar, mode = 'w', format = tarfile.GNU_FORMAT)
+        for path in changed:
+            info = _tarinfo(buildroot, path, new[path][0], attrs)
+            if info.isfile():
+                f = open(os.path.join(buildroot, path), 'rb')
+                try:
+                    tar.addfile(info, f)
+                finally:
+                    f.close()
+            else:
+                tar.addfile(info)
+        tar.close()
+
+        script = APPLY_SCRIPT
+        for key, value in (('@FROM@', description['from']), ('@TO@', description['to']),
+                           ('@PREFIX@', prefix.strip('/'))):
+            script = script.replace(key, value)
+
+        tmp_filename = filename + '.tmp'
+        out = open(tmp_filename, 'wb')
+        try:
+            stream = compressed_writer(HashingFile(out, digest) if digest else out, 'gzip')
+            delta = tarfile.open(fileobj = stream, mode = 'w|', format = tarfile.GNU_FORMAT)
+            _add_data(delta, 'apply-delta.sh', script, 0755)
+            _add_data(delta, 'delta.json', json.dumps(description, indent = 1, sort_keys = True) + '\n')
+            _add_data(delta, 'deleted.txt', ''.join([path + '\n' for path in deleted]))
+            info = tarfile.TarInfo('files.tar')
+            info.size, info.mode, info.mtime = files_tar.tell(), 0644, time.time()
+            files_tar.seek(0)
+            delta.addfile(info, files_tar)
+            delta.close()
+            stream.close()
+        finally:
+            out.close()
+        os.rename(tmp_filename, filename)
+    finally:
+        files_tar.close()
+    return filename
+
+
+def make_deltarpm(old_rpm, new_rpm, dest_dir, timeout = None):
+    """
+    Create a deltarpm from "old_rpm" to "new_rpm" with "makedeltarpm", returning
+    the file created (or None if we do not have "makedeltarpm")
+    """
+    if not find_executable('makedeltarpm'):
+        logger.warning('"makedeltarpm" not found: not creating a deltarpm')
+        return None
+
+    old, _ = rpm_info(old_rpm)
+    new, _ = rpm_info(new_rpm)
+    filename = os.path.join(dest_dir, '%s-%s-%s_%s-%s.%s.drpm' % (new['name'], old['version'], old['release'],
+                                                                 new['version'], new['release'], new['arch']))
+    result = run(['makedeltarpm', old_rpm, new_rpm, filename], timeout, log = logger)
+    if not result.ok:
+        from zc.buildout import UserError
+        raise UserError('could not create the deltarpm: %s' % result.error())
+    return filename
@@ -0,0 +1,226 @@
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import pkg_resources
+
+from copier import link_tree
+from manifest import content_stamp
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: placeholder for the virtualenv directory in the cached scripts
+VIRTUALENV_DIR_MARK = '@VIRTUALENV_DIR@'
+
+#: the description of a cache entry
+ENTRY_FILE = 'entry.json'
+
+#: default size limit for the cache (in MB)
+DEFAULT_CACHE_SIZE = 2048
+
+
+
+def python_abi():
+    """
+    Return a string that identifies the binary compatibility of the current interpreter
+    """
+    return '%d.%d-%d-%s' % (sys.version_info[0], sys.version_info[1],
+                            sys.maxunicode, pkg_resources.get_build_platform())
+
+
+def _tree_size(path):
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def _copy_replacing(src, dst, old, new):
+    contents = open(src, 'rb').read()
+    f = open(dst, 'wb')
+    try:
+        f.write(contents.replace(old, new))
+    finally:
+        f.close()
+    shutil.copystat(src, dst)
+
+
+class EggCache(object):
+    """
+    A cache of installed eggs, shared between builds.
+
+    Every entry has the files that the installation of a distribution creates in
+    the site-packages directory, the scripts it creates in "bin/" and its entry
+    in "easy-install.pth". Entries are found by the contents of the egg (or the
+    source directory of a develop egg), so rebuilt eggs are installed again.
+    Entries are restored with hardlinks, and the least recently used entries
+    are removed when the cache is bigger than its limit.
+    """
+
+    def __init__(self, cache_dir, max_size = DEFAULT_CACHE_SIZE):
+        self.cache_dir = os.path.join(cache_dir, 'eggs')
+        self.max_size = max_size * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._keys = {}
+
+    def key(self, dist):
+        ## hashing the contents is not cheap, so we do it once per build
+        with self._lock:
+            if dist.location in self._keys:
+                return self._keys[dist.location]
+        h = hashlib.sha1()
+        h.update('%s\0%s\0%s\0%s' % (dist.key, dist.version, python_abi(),
+                                      content_stamp(dist.location)))
+        with self._lock:
+            self._keys[dist.location] = h.hexdigest()
+        return h.hexdigest()
+
+    def cacheable(self, dist):
+        """
+        We can only cache the distributions we can hash
+        """
+        return bool(dist.location) and os.path.exists(dist.location)
+
+    def restore(self, dist, virtualenv_dir, site_packages, exclude = None):
+        """
+        Restore the installation of a distribution in a virtualenv, returning True
+        if it was found in the cache. Files matching "exclude" are not restored.
+        """
+        if not self.cacheable(dist):
+            return False
+
+        entry_dir = os.path.join(self.cache_dir, self.key(dist))
+        entry_filename = os.path.join(entry_dir, ENTRY_FILE)
+        if not os.path.exists(entry_filename):
+            self._count(hit = False)
+            return False
+
+        entry = json.load(open(entry_filename))
+        dest = os.path.join(site_packages, entry['egg'])
+        if os.path.lexists(dest):
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                shutil.rmtree(dest)
+            else:
+                os.remove(dest)
+        link_tree(os.path.join(entry_dir, 'site-packages', entry['egg']), dest, exclude)
+
+        bin_dir = os.path.join(virtualenv_dir, 'bin')
+        for script in entry['scripts']:
+            dest_script = os.path.join(bin_dir, script)
+            if exclude and exclude(dest_script):
+                continue
+            if os.path.lexists(dest_script):
+                os.remove(dest_script)
+            _copy_replacing(os.path.join(entry_dir, 'scripts', script), dest_script,
+                            VIRTUALENV_DIR_MARK, virtualenv_dir)
+
+        ## the modification time of the entry is used for the LRU
+        os.utime(entry_filename, None)
+
+        logger.info('... restored "%s" from the eggs cache' % dist.key)
+        self._count(hit = True)
+        return True
+
+    def store(self, dist, virtualenv_dir, site_packages, source = None):
+        """
+        Save the installation of a distribution in a virtualenv. The files of the
+        egg are taken from "source" when the installed egg is not complete (ie, some
+        files were excluded when it was installed).
+        """
+        if not self.cacheable(dist):
+            return
+
+        installed = [d for d in pkg_resources.find_distributions(site_packages)
+                     if d.key == dist.key and d.location != site_packages]
+        if not installed:
+            logger.debug('... could not find "%s" in %s: not caching it' % (dist.key, site_packages))
+            return
+        installed = installed[0]
+        egg = os.path.basename(installed.location)
+
+        scripts = []
+        bin_dir = os.path.join(virtualenv_dir, 'bin')
+        names = installed.get_entry_map('console_scripts').keys() + installed.get_entry_map('gui_scripts').keys()
+        if installed.has_metadata('scripts'):
+            names += installed.metadata_listdir('scripts')
+        for name in names:
+            if os.path.isfile(os.path.join(bin_dir, name)) and not name in scripts:
+                scripts.append(name)
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        ## build the entry in a temporary directory, and rename it when complete
+        tmp_dir = tempfile.mkdtemp(prefix = 'tmp-', dir = self.cache_dir)
+        try:
+            os.makedirs(os.path.join(tmp_dir, 'site-packages'))
+            os.makedirs(os.path.join(tmp_dir, 'scripts'))
+            link_tree(source or installed.location, os.path.join(tmp_dir, 'site-packages', egg))
+            for script in scripts:
+                _copy_replacing(os.path.join(bin_dir, script), os.path.join(tmp_dir, 'scripts', script),
+                                virtualenv_dir, VIRTUALENV_DIR_MARK)
+
+            entry = {
+                'key': dist.key,
+                'version': dist.version,
+                'abi': python_abi(),
+                'egg': egg,
+                'scripts': scripts,
+                'size': _tree_size(tmp_dir),
+            }
+            f = open(os.path.join(tmp_dir, ENTRY_FILE), 'w')
+            try:
+                json.dump(entry, f)
+            finally:
+                f.close()
+
+            os.rename(tmp_dir, os.path.join(self.cache_dir, self.key(dist)))
+            logger.debug('... saved "%s" in the eggs cache' % dist.key)
+        except OSError, e:
+            ## maybe another build has saved this egg at the same time
+            logger.debug('... could not save "%s" in the eggs cache: %s' % (dist.key, str(e)))
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in its limit
+        """
+        if not os.path.exists(self.cache_dir):
+            return
+
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            entry_filename = os.path.join(self.cache_dir, name, ENTRY_FILE)
+            try:
+                size = json.load(open(entry_filename))['size']
+                entries.append((os.stat(entry_filename).st_mtime, size, name))
+                total_size += size
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+
+        entries.sort()
+        while total_size > self.max_size and entries:
+            _, size, name = entries.pop(0)
+            logger.debug('... evicting %s from the eggs cache' % name)
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors = True)
+            total_size -= size
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
@@ -7,8 +7,30 @@ import logging
 import glob
 import re
 import tempfile
+import time
+import hashlib
 import pkg_resources
-import subprocess
+
+from jobs import jobs_from_cfg, run_jobs
+from copier import copy_file, copy_tree
+from archive import write_tar
+from venvcache import VenvCache
+from manifest import Manifest, stamp, content_stamp
+from store import ArtifactStore, ContentStore, DEFAULT_STORE_SIZE, fingerprint, write_fingerprint
+from eggcache import EggCache, DEFAULT_CACHE_SIZE
+from wscache import WorkingSetCache
+from installer import can_install, install_egg
+from matcher import PathMatcher
+from report import BuildReport, REPORT_EXT, PROFILE_EXT
+from relocate import relocate_tree
+from precompile import precompile_tree, drop_sources
+from layout import check_site_layout, merge_eggs, zip_merged_eggs, import_time, IMPORT_RUNS
+from dedup import dedup_tree
+from strip import strip_tree
+from slim import SlimPolicy, SlimExclude, slim_eggs
+from delta import tree_files, write_files_manifest, load_files, diff_files, write_delta, make_deltarpm, \
+                  FILES_MANIFEST_EXT, DELTA_EXT
+from runner import run, timeout_from_cfg
 
 
 
@@ -16,6 +38,42 @@ logger = logging.getLogger(__name__)
 
 
 
+#: options that do not change the package built (so they are not part of the fingerprint)
+FINGERPRINT_SKIP_OPTIONS = [
+    'debug',
+    'cache-dir',
+    'build-dir',
+    'incremental',
+    'install-jobs',
+    'egg-installer',
+    'egg-cache',
+    'egg-cache-size',
+    'venv-cache',
+    'working-set-cache',
+    'compression-threads',
+    'copy-jobs',
+    'relocation-jobs',
+    'precompile-jobs',
+    'dedup-jobs',
+    'strip-jobs',
+    'package-jobs',
+    'command-timeout',
+    'artifact-store',
+    'artifact-store-size',
+    'report',
+    'profile',
+]
+
+#: the operators we can use in the dependencies
+DEPENDENCY_OPERATORS = ['<', '<=', '=', '==', '>=', '>']
+
+#: the formats we can create from the buildroot, with the module and the class that create them
+PACKAGE_FORMATS = {
+    'rpm': ('frozenrpm', 'FrozenRPM'),
+    'deb': ('frozendeb', 'FrozenDeb'),
+    'tgz': ('frozentgz', 'FrozenTgz'),
+}
+
 #: list of regular expressions for eggs that we will not copy
 SKIP_EGGS = [
     'zc.recipe.egg-.*',
@@ -23,9 +81,77 @@ SKIP_EGGS = [
 
 
 
+def _recipe_version():
+    """
+    The version of this recipe (packages built by other versions are not reused)
+    """
+    try:
+        return pkg_resources.get_distribution('as.recipe.frozenpkg').version
+    except pkg_resources.DistributionNotFound:
+        return 'unknown'
+
 def _lst_from_cfg(opt):
     return [r.strip() for r in opt.split('\n') if r.strip()]
 
+def _bool_from_cfg(opt, default = False):
+    opt = (opt or '').strip().lower()
+    if not opt:
+        return default
+    return opt in ('yes', 'true', 'on', '1', 'sure')
+
+def _deps_from_cfg(opt):
+    """
+    Parse a list of dependencies (separated by spaces, commas or lines) like
+    "glibc, python >= 2.6" as (name, operator, version) tuples
+    """
+    words = opt.replace(',', ' ').split()
+    deps = []
+    while words:
+        name = words.pop(0)
+        if name in DEPENDENCY_OPERATORS:
+            from zc.buildout import UserError
+            raise UserError('could not parse the dependencies "%s"' % opt.strip())
+        if words and words[0] in DEPENDENCY_OPERATORS:
+            if len(words) < 2:
+                from zc.buildout import UserError
+                raise UserError('could not parse the dependencies "%s"' % opt.strip())
+            operator, version = words.pop(0), words.pop(0)
+            deps.append((name, '=' if operator == '==' else operator, version))
+        else:
+            deps.append((name, '', ''))
+    return deps
+
+def _disk_usage(path):
+    """
+    Return the number of files and bytes in a file or a directory tree
+    """
+    if os.path.islink(path) or not os.path.isdir(path):
+        return 1, os.lstat(path).st_size
+
+    num_files, num_bytes = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                num_bytes += os.lstat(os.path.join(dirpath, filename)).st_size
+                num_files += 1
+            except OSError:
+                pass
+    return num_files, num_bytes
+
+def _is_update(previous, current, same_item = None):
+    """
+    Return True if "current" has (at least) all the items in "previous", so we can
+    update a previous build instead of starting from scratch
+    """
+    if previous is None:
+        return False
+    for key, value in previous.items():
+        if not key in current:
+            return False
+        if same_item and not same_item(value, current[key]):
+            return False
+    return True
+
 ################################################################################
 
 class Frozen(object):
@@ -33,6 +159,9 @@ class Frozen(object):
     Frozen packages base class
     """
 
+    #: the format of the packages created by this recipe (when there is no "formats" option)
+    format = None
+
     def __init__ (self, buildout, name, options):
         self.name = name
         self.options = options
@@ -42,17 +171,182 @@ class Frozen(object):
         # patch some options
         self.eggs = self.options["eggs"]
 
-        debug = options.get('debug', '').lower()
-        if debug in ('yes', 'true', 'on', '1', 'sure'):
-            self.debug = True
-        else:
-            self.debug = False
+        self.debug = _bool_from_cfg(options.get('debug', ''))
 
     def install(self):
         """
-        Create a RPM
+        Create the package
         """
-        self.rpmbuild_dir = os.path.abspath(tempfile.mkdtemp(suffix = '', prefix = 'rpmbuild-'))
+        if _bool_from_cfg(self.options.get('profile', '')):
+            import cProfile
+            profiler = cProfile.Profile()
+            profile_filename = self._report_filename(PROFILE_EXT)
+            try:
+                artifacts = profiler.runcall(self._build)
+            finally:
+                profiler.dump_stats(profile_filename)
+                logger.info('Profiler stats saved at %s.' % profile_filename)
+            artifacts = artifacts + [profile_filename]
+        else:
+            artifacts = self._build()
+
+        logger.info('Build times: %s.' % self.report.summary())
+        if _bool_from_cfg(self.options.get('report', '')):
+            report_filename = self.report.save(self._report_filename(REPORT_EXT),
+                                               package = self.pkg_name,
+                                               version = self.pkg_version,
+                                               recipe = self.__class__.__name__,
+                                               fingerprint = self.fingerprint)
+            logger.info('Build report saved at %s.' % report_filename)
+            artifacts = artifacts + [report_filename]
+
+        return artifacts
+
+    def _build(self):
+        """
+        Stage the buildroot and create the package, returning the files created
+        """
+        self._setup_build()
+        buildout_dir = self.buildout['buildout']['directory']
+        with self.report.phase('working-set'):
+            dists = self._working_set()
+
+        ## maybe we have already built this with exactly the same inputs...
+        with self.report.phase('fingerprint'):
+            fp = self.fingerprint = fingerprint(self._fingerprint_inputs(dists))
+        artifact_store = None
+        if _bool_from_cfg(self.options.get('artifact-store', '')):
+            artifact_store = ArtifactStore(self._cache_dir(),
+                                           int(self.options.get('artifact-store-size', DEFAULT_STORE_SIZE)))
+            restored = artifact_store.get(fp, buildout_dir)
+            if restored is not None:
+                logger.info('Nothing to build: found artifacts with fingerprint %s.' % fp)
+                if not self.incremental:
+                    shutil.rmtree(self.rpmbuild_dir)
+                self.report.result = 'restored'
+                self.report.add_artifacts(restored)
+                return restored + [write_fingerprint(a, fp) for a in restored]
+
+        manifest = Manifest(self._manifest_filename())
+        changed = self._stage(manifest, dists)
+
+        package_inputs = self._package_inputs()
+        artifacts = manifest.get('artifacts')
+        if not changed and manifest.matches('package', package_inputs) and artifacts and \
+           all([os.path.exists(os.path.join(buildout_dir, a)) for a in artifacts]):
+            logger.info('Nothing has changed: keeping %s.' % ', '.join(artifacts))
+            manifest.record('package', package_inputs)
+            manifest.record('artifacts', artifacts)
+            manifest.save()
+            self.report.result = 'up-to-date'
+            return artifacts
+
+        ## the previous package is read before it can be overwritten by the new one
+        delta_base = None
+        if self.delta_from:
+            with self.report.phase('delta-base'):
+                delta_base = load_files(self.delta_from)
+
+        artifacts = [os.path.join(buildout_dir, a) for a in self._package_formats()]
+        artifacts += self._debug_artifacts()
+        artifacts += self._delta_artifacts(artifacts, delta_base)
+        self.report.result = 'built'
+        self.report.add_artifacts(artifacts)
+
+        logger.debug('Fingerprint for %s: %s' % (', '.join(artifacts), fp))
+        fingerprints = [write_fingerprint(a, fp) for a in artifacts]
+        if artifact_store and artifacts:
+            artifact_store.put(fp, artifacts)
+            artifact_store.evict()
+        artifacts = artifacts + fingerprints
+
+        manifest.record('package', package_inputs)
+        manifest.record('artifacts', artifacts)
+        manifest.save()
+
+        if not self.incremental and not self.debug:
+            shutil.rmtree(self.rpmbuild_dir)
+
+        return artifacts
+
+    def update(self):
+        """
+        Update the package, rebuilding only what has changed
+        """
+        if self.incremental:
+            return self.install()
+
+    def _package(self):
+        """
+        Create the package(s) from the buildroot, returning the list of files created
+        """
+        raise NotImplementedError
+
+    def _prepare_package(self):
+        """
+        Prepare the buildroot for packaging. It is run before any package is created,
+        and it is the only place where the buildroot can be modified when packaging.
+        """
+        pass
+
+    def _packager(self, format):
+        """
+        Return the recipe that creates packages in some format, sharing our build
+        """
+        module_name, class_name = PACKAGE_FORMATS[format]
+        cls = getattr(__import__(module_name, globals()), class_name)
+        if isinstance(self, cls):
+            return self
+        packager = cls.__new__(cls)
+        packager.__dict__.update(self.__dict__)
+        return packager
+
+    def _package_formats(self):
+        """
+        Create the packages in all the formats from the same buildroot (at the same
+        time, with "package-jobs" threads), returning the names of the files created
+        in the buildout directory
+        """
+        packagers = [self._packager(format) for format in self.formats]
+        for packager in packagers:
+            packager._prepare_package()
+
+        jobs = jobs_from_cfg(self.options.get('package-jobs', ''), len(packagers))
+        artifacts = []
+        for files in run_jobs(lambda packager: packager._package(), packagers, jobs):
+            artifacts += files
+        return artifacts
+
+    ############################################################################
+
+    def _setup_build(self):
+        """
+        Load the package options and prepare the build directory
+        """
+        self.incremental = _bool_from_cfg(self.options.get('incremental', ''))
+
+        ## with a build directory (in the same filesystem as the buildout), the packages
+        ## are published in a store there and linked from the buildout, without copying them
+        build_dir = self.options.get('build-dir', '').strip()
+        self.content_store = None
+        if build_dir:
+            build_dir = os.path.abspath(os.path.join(self.buildout['buildout']['directory'], build_dir))
+            if not os.path.exists(build_dir):
+                os.makedirs(build_dir)
+            self.content_store = ContentStore(os.path.join(build_dir, 'store'))
+
+        if self.incremental:
+            ## a persistent staging directory, so we can reuse the previous build
+            self.rpmbuild_dir = os.path.abspath(os.path.join(build_dir or self.buildout['buildout']['parts-directory'],
+                                                             self.name))
+            if not os.path.exists(self.rpmbuild_dir):
+                os.makedirs(self.rpmbuild_dir)
+        else:
+            self.rpmbuild_dir = os.path.abspath(tempfile.mkdtemp(suffix = '', prefix = 'rpmbuild-',
+                                                                 dir = build_dir or None))
+
+        if self.content_store and not os.path.exists(os.path.join(self.rpmbuild_dir, 'OUTPUT')):
+            os.makedirs(os.path.join(self.rpmbuild_dir, 'OUTPUT'))
 
         self.pkg_name = self.options['pkg-name']
         self.pkg_version = self.options.get('pkg-version', '0.1')
@@ -67,29 +361,314 @@ class Frozen(object):
 
         self.buildroot = os.path.abspath(os.path.join(self.rpmbuild_dir, "BUILDROOT", self.pkg_name))
         self.virtualenv_dir = os.path.abspath(self.buildroot + self.pkg_prefix)
+        self.debug_dir = os.path.abspath(os.path.join(self.rpmbuild_dir, "DEBUG", self.pkg_name))
+
+        ## files matching the cleanups are never copied to the virtualenv (but the
+        ## sources we compile, that are removed once we have their bytecode)
+        self.precompile = _bool_from_cfg(self.options.get('precompile', ''))
+        self.cleanups = PathMatcher(_lst_from_cfg(self.options.get('extra-cleanups', '')), self.virtualenv_dir,
+                                    keep = ['.py'] if self.precompile else [])
+
+        self.command_timeout = timeout_from_cfg(self.options.get('command-timeout', ''))
+
+        self.slim_policy = SlimPolicy.from_cfg(self.options.get('slim-policy', ''))
+
+        self.site_layout = self.options.get('site-layout', 'eggs').strip()
+        check_site_layout(self.site_layout)
+
+        self.delta_from = self.options.get('delta-from', '').strip()
+        if self.delta_from:
+            self.delta_from = os.path.abspath(os.path.join(self.buildout['buildout']['directory'], self.delta_from))
+            if not os.path.isfile(self.delta_from):
+                from zc.buildout import UserError
+                raise UserError('previous package "%s" not found' % self.delta_from)
+
+        self.formats = []
+        for format in self.options.get('formats', '').replace(',', ' ').split() or [self.format]:
+            if not format in PACKAGE_FORMATS:
+                from zc.buildout import UserError
+                raise UserError('unknown package format "%s" (valid formats: %s)' %
+                                (format, ', '.join(sorted(PACKAGE_FORMATS.keys()))))
+            if not format in self.formats:
+                self.formats.append(format)
+
+        ## counting the files after every phase is not free, so we only do it for the reports
+        if _bool_from_cfg(self.options.get('report', '')):
+            self.report = BuildReport(self.buildroot)
+        else:
+            self.report = BuildReport()
+        self.fingerprint = None
 
-        ## create the build directory
-        try:
-            if not os.path.exists(self.virtualenv_dir):
-                os.makedirs(self.virtualenv_dir)
+    def _output_dir(self):
+        """
+        The directory where the packages are written: the buildout directory, or
+        a directory in the build directory when we publish them in the store
+        """
+        if self.content_store:
+            return os.path.join(self.rpmbuild_dir, 'OUTPUT')
+        return self.buildout['buildout']['directory']
+
+    def _publish(self, filename, sha256 = None):
+        """
+        Make a package available in the buildout directory, returning its path there.
+        With a build directory, the package is moved to the store (with its digest,
+        when we have computed it while writing the package) and linked from there.
+        """
+        buildout_dir = self.buildout['buildout']['directory']
+        dest = os.path.join(buildout_dir, os.path.basename(filename))
+        if self.content_store:
+            sha256 = self.content_store.publish(filename, sha256, '%s-%s' % (self.pkg_version, self.pkg_release))
+            logger.debug('... %s published as %s' % (os.path.basename(filename), sha256))
+            return self.content_store.link(sha256, dest)
+        if os.path.abspath(filename) != os.path.abspath(dest):
+            shutil.copy(filename, dest)
+        return dest
+
+    def _report_filename(self, ext):
+        """
+        The file (next to the packages) where we save the build reports
+        """
+        name = '%s-%s%s' % (self.options['pkg-name'], self.options.get('pkg-version', '0.1'), ext)
+        return os.path.join(self.buildout['buildout']['directory'], name)
+
+    def _manifest_filename(self):
+        """
+        The manifest of the last build (only for incremental builds)
+        """
+        if self.incremental:
+            return os.path.join(self.rpmbuild_dir, 'manifest.json')
+        return None
+
+    def _stage(self, manifest, dists):
+        """
+        Stage the virtualenv at the buildroot, running only the phases whose inputs
+        have changed since the last build. Return True if the buildroot has changed.
+        """
+        venv_inputs = {
+            'python': [os.path.realpath(sys.executable), sys.version],
+            'buildroot': self.buildroot,
+            'prefix': self.pkg_prefix,
+            'venv-cache': self.options.get('venv-cache', ''),
+            'precompile': [self.options.get('precompile', ''), self.options.get('precompile-optimize', '')],
+            'site-layout': self.site_layout,
+            'strip': [self.options.get('strip', ''), self.options.get('strip-debug', '')],
+            'slim-policy': self.options.get('slim-policy', ''),
+        }
+        eggs_inputs = self._eggs_inputs(dists)
+        outputs_inputs = self._outputs_inputs()
+        dirs_inputs = self.options.get('extra-dirs', '')
+        copies_inputs = self._extra_copies_inputs()
+        cleanups_inputs = self.options.get('extra-cleanups', '')
+
+        for phase, inputs in [('venv', venv_inputs),
+                              ('eggs', eggs_inputs),
+                              ('outputs', outputs_inputs),
+                              ('extra-dirs', dirs_inputs),
+                              ('extra-copies', copies_inputs),
+                              ('extra-cleanups', cleanups_inputs)]:
+            manifest.record(phase, inputs)
+
+        ## removing things from the virtualenv is not supported: we just start from scratch
+        full = not os.path.exists(self.virtualenv_dir) or \
+               not manifest.matches('venv', venv_inputs) or \
+               not manifest.matches('extra-dirs', dirs_inputs) or \
+               not manifest.matches('extra-cleanups', cleanups_inputs) or \
+               (self.site_layout != 'eggs' and not manifest.matches('eggs', eggs_inputs)) or \
+               not _is_update(manifest.get('eggs'), eggs_inputs, lambda old, new: old[0] == new[0]) or \
+               not _is_update(manifest.get('outputs'), outputs_inputs) or \
+               not _is_update(manifest.get('extra-copies', {}).get('sources'), copies_inputs['sources'])
+
+        if full:
+            manifest.invalidate()
+            manifest.reset()
+            if os.path.exists(self.buildroot):
+                logger.info('Removing previous buildroot at "%s".' % self.buildroot)
+                shutil.rmtree(self.buildroot)
+            if os.path.exists(self.debug_dir):
+                shutil.rmtree(self.debug_dir)
+
+            ## create the build directory
+            try:
+                if not os.path.exists(self.virtualenv_dir):
+                    os.makedirs(self.virtualenv_dir)
+
+                with self.report.phase('venv'):
+                    self._create_venv()
+            except:
+                logger.critical('ERROR: could not create virtual environment at "%s".' % (self.virtualenv_dir))
+                raise
+
+            with self.report.phase('eggs'):
+                self._copy_eggs(dists)
+            with self.report.phase('outputs'):
+                self._copy_outputs()
+            with self.report.phase('extra-dirs'):
+                self._create_extra_dirs()
+            with self.report.phase('extra-copies'):
+                self._copy_extra_files()
+        else:
+            previous_eggs = manifest.get('eggs')
+            changed_dists = [d for d in dists if previous_eggs.get(d.key) != eggs_inputs[d.key]]
+            changed_outputs = not manifest.matches('outputs', outputs_inputs)
+            changed_copies = not manifest.matches('extra-copies', copies_inputs)
+            if not (changed_dists or changed_outputs or changed_copies):
+                logger.info('The buildroot at "%s" is up to date.' % self.buildroot)
+                return False
+
+            manifest.invalidate()
+            if changed_dists:
+                logger.info('Reinstalling changed eggs: %s.' % ', '.join([d.key for d in changed_dists]))
+                with self.report.phase('eggs'):
+                    self._copy_eggs(changed_dists)
+                    self._save_easy_install_pth(dists)
+            if changed_outputs:
+                with self.report.phase('outputs'):
+                    self._copy_outputs()
+            if changed_copies:
+                with self.report.phase('extra-copies'):
+                    self._copy_extra_files()
+
+        ## installing a develop egg can modify its directory (ie, "setup.cfg" or "build/"),
+        ## so we must take the stamps of the develop eggs after installing them
+        manifest.record('eggs', self._eggs_inputs(dists))
+
+        with self.report.phase('extra-cleanups'):
+            self._extra_cleanups()
+        merged = []
+        if self.site_layout != 'eggs':
+            with self.report.phase('site-layout'):
+                merged = self._merge_eggs(dists)
+        with self.report.phase('relocation'):
+            self._prepare_venv()
+        if self.precompile:
+            with self.report.phase('precompile'):
+                self._precompile()
+        if self.site_layout == 'zip':
+            with self.report.phase('site-zip'):
+                zip_merged_eggs(self._site_packages_dir())
+        if _bool_from_cfg(self.options.get('strip', '')):
+            with self.report.phase('strip'):
+                self._strip()
+        if _bool_from_cfg(self.options.get('dedup', '')):
+            with self.report.phase('dedup'):
+                self._dedup()
+        return True
+
+    def _eggs_inputs(self, dists):
+        inputs = {}
+        for dist in dists:
+            ## eggs in the eggs directory never change, but develop eggs can change at any time
+            if dist.precedence == pkg_resources.DEVELOP_DIST:
+                location_stamp = stamp(dist.location)
+            else:
+                location_stamp = None
+            inputs[dist.key] = [dist.version, dist.location, location_stamp]
+        return inputs
+
+    def _outputs_inputs(self):
+        inputs = {}
+        for output in self._parts_outputs():
+            inputs[output] = stamp(output)
+        return inputs
+
+    def _extra_copies_inputs(self):
+        ## everything in the sources is copied, so nothing is skipped in their stamps
+        sources = {}
+        for src, dest in self._extra_copies():
+            for src_el in glob.glob(src):
+                sources[src_el] = stamp(src_el, filtered = False)
+        return {
+            'spec': self.options.get('extra-copies', ''),
+            'sources': sources,
+        }
+
+    def _extra_copies_fingerprint(self):
+        """
+        The contents of the extra-copies sources (all of them, as they are all copied)
+        """
+        sources = {}
+        for src, dest in self._extra_copies():
+            for src_el in glob.glob(src):
+                sources[src_el] = content_stamp(src_el, filtered = False)
+        return sources
 
-            self._create_venv()
-        except:
-            logger.critical('ERROR: could not create virtual environment at "%s".' % (self.virtualenv_dir))
-            raise
+    def _fingerprint_inputs(self, dists):
+        """
+        All the inputs that can change the package built
+        """
+        eggs = []
+        for dist in dists:
+            if dist.precedence == pkg_resources.DEVELOP_DIST:
+                eggs.append([dist.key, dist.version, content_stamp(dist.location)])
+            else:
+                eggs.append([dist.key, dist.version, dist.location])
+
+        options = {}
+        for key, value in self.options.items():
+            if not key in FINGERPRINT_SKIP_OPTIONS:
+                options[key] = value
+
+        return {
+            'recipe': '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+            'recipe-version': _recipe_version(),
+            'python': [os.path.realpath(sys.executable), sys.version],
+            'eggs': eggs,
+            'outputs': dict([(output, content_stamp(output)) for output in self._parts_outputs()]),
+            'extra-copies': self._extra_copies_fingerprint(),
+            'delta-from': stamp(self.delta_from) if self.delta_from else None,
+            'options': options,
+        }
+
+    def _package_inputs(self):
+        """
+        The options used when packaging the buildroot
+        """
+        inputs = {}
+        for key in self.options.keys():
+            if key.startswith('pkg-') or key.startswith('attr-'):
+                inputs[key] = self.options[key]
+        inputs['formats'] = self.formats
+        for key in ('delta-from', 'delta-manifest'):
+            inputs[key] = self.options.get(key, '')
+        if self.delta_from:
+            inputs['delta-from-stamp'] = stamp(self.delta_from)
+        return inputs
 
     ############################################################################
 
+    def _attr_confs(self):
+        """
+        The (absolute) paths of the configuration files in the package (they can be globs)
+        """
+        confs = []
+        for line in _lst_from_cfg(self.options.get('attr-conf', '')):
+            if not os.path.isabs(line):
+                line = os.path.abspath(self.pkg_prefix + '/' + line)
+            confs.append(line)
+        return confs
+
     def _virtualenv_path(self, path):
         """
         Return a path inside the virtualenv
         """
         return os.path.normpath(os.path.abspath(self.virtualenv_dir + '/' + path))
 
+    def _cache_dir(self):
+        """
+        Return the directory where we keep things shared between builds
+        """
+        default_cache_dir = os.path.join(os.path.expanduser('~'), '.frozenpkg')
+        return os.path.join(self.buildout['buildout']['directory'],
+                            self.options.get('cache-dir', default_cache_dir))
+
     def _create_venv(self):
         """
         Create a virtualenv in a directory
         """
+        if _bool_from_cfg(self.options.get('venv-cache', '')):
+            logger.info('Creating virtualenv from a cached template.')
+            VenvCache(self._cache_dir(), self.command_timeout).clone(self.virtualenv_dir, self.cleanups)
+            return
 
         ## we cannot use the Virtualenv library: there is something broken that do not allows us
         ## to use it as a library...
@@ -103,19 +682,68 @@ class Frozen(object):
             ]
 
         logger.info('Creating virtualenv by launching "%s".' % (" ".join(virtualenv)))
-        job = subprocess.Popen(virtualenv,
-                               stdout = subprocess.PIPE,
-                               stderr = subprocess.STDOUT)
-        stdout, _ = job.communicate()
+        result = run(virtualenv, self.command_timeout, log = logger)
+        if not result.ok:
+            logger.critical('could not run virtualenv: %s' % result.error())
+            sys.exit(1)
+
 
-        if job.returncode != 0:
-            logger.critical('could not run virtualenv')
+    def _site_packages_dir(self):
+        """
+        Return the site-packages directory of the virtualenv
+        """
+        candidates = glob.glob(os.path.join(self.virtualenv_dir, 'lib', 'python*', 'site-packages'))
+        if not candidates:
+            logger.critical('could NOT find site-packages in %s' % self.virtualenv_dir)
             sys.exit(1)
+        return candidates[0]
+
+    def _working_set(self):
+        """
+        Return the distributions that must be installed in the virtualenv
+        """
+        distributions = _lst_from_cfg(self.options.get('eggs', self.name))
+        develop_dir = self.buildout['buildout']['develop-eggs-directory']
+        eggs_dir = self.buildout['buildout']['eggs-directory']
+
+        ## resolving the working set means scanning the eggs directories, so we cache it
+        ws, ws_cache = None, None
+        if _bool_from_cfg(self.options.get('working-set-cache', ''), True):
+            ws_cache = WorkingSetCache(self._cache_dir())
+            ws_key = ws_cache.key(distributions, develop_dir, eggs_dir, self._pinned_versions())
+            ws = ws_cache.get(ws_key)
+
+        if ws is None:
+            import zc.buildout.easy_install
+            ws = list(zc.buildout.easy_install.working_set(distributions, [develop_dir, eggs_dir]))
+            if ws_cache:
+                ws_cache.put(ws_key, ws)
+
+        ## check if we must skip some eggs (by their name, or their name and version)
+        skip_eggs = re.compile('(?:%s)\Z' % '|'.join(_lst_from_cfg(self.options.get('eggs-skip', '')) + SKIP_EGGS))
+        dists = []
+        for dist in ws:
+            if [n for n in (dist.key, dist.project_name, dist.egg_name()) if skip_eggs.match(n)]:
+                logger.debug('... skipping "%s"' % dist.key)
+                continue
+            dists.append(dist)
+        return dists
 
+    def _pinned_versions(self):
+        """
+        The versions pinned in the buildout (they change the working set resolved)
+        """
+        section = self.buildout['buildout'].get('versions', '')
+        if not section:
+            return {}
+        try:
+            return dict(self.buildout[section].items())
+        except KeyError:
+            return {}
 
-    def _copy_eggs (self):
+    def _copy_eggs (self, dists):
         """
-        Copy all the required eggs to the virtualenv
+        Copy the eggs for some distributions to the virtualenv
         """
         bin_dir = os.path.join(self.virtualenv_dir, 'bin')
         easy_install = os.path.join(bin_dir, 'easy_install')
@@ -123,56 +751,240 @@ class Frozen(object):
             logger.critical('could NOT find easy_install at %s' % easy_install )
             sys.exit(1)
 
-        distributions = _lst_from_cfg(self.options.get('eggs', self.name))
+        jobs = jobs_from_cfg(self.options.get('install-jobs', '1'))
+
+        egg_cache = None
+        if _bool_from_cfg(self.options.get('egg-cache', '')):
+            egg_cache = EggCache(self._cache_dir(),
+                                 int(self.options.get('egg-cache-size', DEFAULT_CACHE_SIZE)))
+        site_packages = self._site_packages_dir()
+
+        internal_installer = self.options.get('egg-installer', 'easy_install').strip() == 'internal'
+
+        ## the files removed by the slim policy are not even copied when we stage the eggs,
+        ## but eggs installed by easy_install (and zipped eggs) must be slimmed afterwards
+        exclude = self.cleanups
+        if self.slim_policy:
+            exclude = SlimExclude(self.slim_policy, site_packages, self.cleanups)
+        slim_later = []
+
+        def _install_cached_egg(dist):
+            start = time.time()
+            if egg_cache and egg_cache.restore(dist, self.virtualenv_dir, site_packages, exclude):
+                method = 'cache'
+            elif internal_installer and can_install(dist):
+                install_egg(dist, self.virtualenv_dir, site_packages, exclude)
+                if egg_cache:
+                    egg_cache.store(dist, self.virtualenv_dir, site_packages, dist.location)
+                method = 'internal'
+            else:
+                self._install_egg(dist)
+                if egg_cache:
+                    egg_cache.store(dist, self.virtualenv_dir, site_packages)
+                method = 'easy_install'
+            if method == 'easy_install' or os.path.isfile(dist.location):
+                slim_later.append(dist.key)
+            self.report.add_egg(dist, time.time() - start, method)
+
+        logger.info('Installing eggs in virtualenv (%d jobs).' % jobs)
+        run_jobs(_install_cached_egg, dists, jobs)
+
+        if self.slim_policy:
+            self._slim_eggs(site_packages, slim_later, exclude.results)
+
+        if egg_cache:
+            logger.info('Eggs cache: %d hits, %d misses.' % (egg_cache.hits, egg_cache.misses))
+            egg_cache.evict()
+
+        if jobs > 1 or egg_cache or internal_installer:
+            ## concurrent installers can lose each other's updates to
+            ## "easy-install.pth", and eggs restored from the cache or installed
+            ## by us are not there, so we write it again in the working set order
+            self._save_easy_install_pth(dists)
+
+
+    def _install_egg (self, dist):
+        """
+        Install a distribution in the virtualenv with "easy_install" (or "pip", if that fails)
+        """
+        bin_dir = os.path.join(self.virtualenv_dir, 'bin')
+        easy_install = os.path.join(bin_dir, 'easy_install')
 
-        import zc.buildout.easy_install
-        ws = zc.buildout.easy_install.working_set(
-                distributions,
-                [self.buildout['buildout']['develop-eggs-directory'], self.buildout['buildout']['eggs-directory']]
-                )
+        ## the scripts in a relocated virtualenv point to the final prefix,
+        ## so we run them with the interpreter in the build directory
+        python = os.path.join(bin_dir, 'python')
 
-        logger.info('Installing eggs in virtualenv.')
-        for dist in ws:
+        args = ['--no-deps']
+        try:
+            find_links = _lst_from_cfg(self.buildout['buildout']['find-links'])
+            for l in find_links:
+                args += ['--find-links', l]
+        except KeyError:
+            pass
+
+        ## the output of eggs installed at the same time is mixed, so every line has the egg name
+        prefix = '...... %s: ' % dist.key
+        command = [python, easy_install] + args + [dist.location]
+        result = run(command, self.command_timeout, log = logger, prefix = prefix)
+
+        if not result.ok:
+            logger.debug('...... retrying "%s" with pip' % dist.key)
+            pip = os.path.join(bin_dir, 'pip')
+            ## current versions of pip have no "--egg" nor "--download-cache", but
+            ## they can use the downloads cache (if it exists) as their cache
+            pip_args = ['install']
+            try:
+                download_cache = self.buildout['buildout']['download-cache']
+                pip_args += ['--cache-dir', download_cache]
+            except KeyError:
+                pass
+            command = [python, pip] + pip_args + args + ["%s==%s" % (dist.key, dist.version)]
+            result = run(command, self.command_timeout, log = logger, prefix = prefix)
 
-            ## check if we must skip this egg
-            skip_eggs = _lst_from_cfg(self.options.get('eggs-skip', '')) + list(SKIP_EGGS)
-            if dist.key in skip_eggs:
-                logger.debug('... skipping "%s"' % dist.key)
-                continue
+            if not result.ok:
+                from zc.buildout import UserError
+                msg = 'could NOT run easy_install: %s' % result.error()
+                logger.critical(msg)
+                raise UserError(msg)
 
-            logger.info('... installing "%s" from "%s"' % (dist.key, dist.location))
+        logger.info('... installed "%s" from "%s"' % (dist.key, dist.location))
 
-            args = ['--no-deps']
-            try:
-                find_links = _lst_from_cfg(self.buildout['buildout']['find-links'])
-                for l in find_links:
-                    args += ['--find-links', l]
-            except KeyError:
-                logger.debug('... no additional find-links')
 
-            command = [easy_install] + args + [dist.location]
-            job = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-            stdout, _ = job.communicate()
+    def _save_easy_install_pth(self, dists):
+        """
+        Write the "easy-install.pth" file with the eggs installed for "dists" in that order
+        """
+        site_packages = self._site_packages_dir()
+        pth_filename = os.path.join(site_packages, 'easy-install.pth')
+
+        installed = pkg_resources.Environment([site_packages])
+        ordered = []
+        for dist in dists:
+            for installed_dist in installed[dist.key]:
+                entry = './' + os.path.basename(installed_dist.location)
+                if installed_dist.location != site_packages and not entry in ordered:
+                    ordered.append(entry)
+
+        ## keep the lines that are not eggs we have installed (ie, the
+        ## "import sys" lines added by setuptools and the eggs from the virtualenv)
+        head, tail = [], []
+        if os.path.exists(pth_filename):
+            lines = [l.rstrip('\n') for l in open(pth_filename).readlines()]
+            for line in lines:
+                if line.strip() in ordered:
+                    continue
+                if line.startswith('import') and ('__egginsert' in line or 'sys.__plen' in line) and \
+                   'new' in line:
+                    tail.append(line)
+                else:
+                    head.append(line)
+
+        logger.debug('... writing %d eggs in %s' % (len(ordered), pth_filename))
+        if os.path.exists(pth_filename):
+            ## it can be a hardlink to some other file (ie, after removing duplicates)
+            os.remove(pth_filename)
+        pth_file = open(pth_filename, 'w')
+        try:
+            pth_file.write('\n'.join(head + ordered + tail) + '\n')
+        finally:
+            pth_file.close()
 
-            if job.returncode != 0:
-                logger.debug('...... retrying with pip')
-                pip = os.path.join(bin_dir, 'pip')
-                pip_args = ['install', '--egg']
-                ## try to use a downloads cache (if it exists)
-                try:
-                    download_cache = self.buildout['buildout']['download-cache']
-                    pip_args += ['--download-cache', download_cache]
-                except KeyError:
-                    pass
-                command = [pip] + pip_args + args + ["%s==%s" % (dist.key, dist.version)]
-                job = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                stdout, _ = job.communicate()
-
-                if job.returncode != 0:
-                    from zc.buildout import UserError
-                    msg = 'could NOT run easy_install: %s: %s' % (' '.join(command), stdout)
-                    logger.critical(msg)
-                    raise UserError(msg)
+
+    def _slim_eggs(self, site_packages, keys, results):
+        """
+        Remove the files matching the "slim-policy" rules from the eggs for "keys" (the
+        eggs we could not slim while staging them), and report them with the "results"
+        of the files that were not copied
+        """
+        if keys:
+            logger.info('Slimming %d eggs in the site-packages.' % len(keys))
+            for egg_name, removed in slim_eggs(site_packages, keys, self.slim_policy).items():
+                for rule, (num_files, num_bytes) in removed.items():
+                    stats = results.setdefault(egg_name, {}).setdefault(rule, [0, 0])
+                    stats[0] += num_files
+                    stats[1] += num_bytes
+
+        totals = {}
+        for egg_name, removed in sorted(results.items()):
+            for rule, (num_files, num_bytes) in sorted(removed.items()):
+                self.report.add_detail('slim', {'egg': egg_name, 'rule': rule,
+                                                'files': num_files, 'bytes': num_bytes})
+                rule_totals = totals.setdefault(rule, [0, 0])
+                rule_totals[0] += num_files
+                rule_totals[1] += num_bytes
+                self.report.count('slim-files', num_files)
+                self.report.count('slim-bytes-saved', num_bytes)
+
+        for rule, (num_files, num_bytes) in sorted(totals.items()):
+            logger.info('... rule "%s": %d files (%d bytes) removed.' % (rule, num_files, num_bytes))
+
+    def _merge_eggs(self, dists):
+        """
+        Merge the pure-Python eggs in the site-packages directory (or in a zip), so the
+        interpreter does not have to look for modules in every egg when it starts.
+        Return the eggs merged.
+        """
+        site_packages = self._site_packages_dir()
+        self.import_modules = self._top_level_modules(site_packages, dists)
+        before = import_time(self._python(), self.import_modules, timeout = self.command_timeout)
+        if before is not None:
+            self.report.add_timing('import-before', before)
+
+        logger.info('Merging eggs in the site-packages (layout: %s).' % self.site_layout)
+        merged = merge_eggs(site_packages, [d.key for d in dists], self.site_layout)
+        logger.info('... %d eggs merged.' % len(merged))
+        self.report.count('merged-eggs', len(merged))
+
+        ## the zip must have the bytecode, so it is created after compiling (if we compile)
+        if self.site_layout == 'zip' and not self.precompile:
+            zip_merged_eggs(site_packages)
+        if merged and before is not None:
+            self._measure_imports(before)
+        return merged
+
+
+    def _top_level_modules(self, site_packages, dists):
+        """
+        The top-level modules of the distributions installed in the site-packages
+        """
+        keys = [d.key for d in dists]
+        modules = []
+        for dist in pkg_resources.find_distributions(site_packages):
+            if dist.key in keys and dist.has_metadata('top_level.txt'):
+                modules += list(dist.get_metadata_lines('top_level.txt'))
+        return modules
+
+
+    def _measure_imports(self, before):
+        """
+        Measure the time it takes to start the interpreter and import the top-level
+        modules of the working set once the eggs have been merged. It is measured
+        before compiling anything, so it is compared with the time "before" merging
+        them with the same bytecode (and it is the best of some warm runs, not a cold
+        start).
+        """
+        after = import_time(self._python(), self.import_modules, timeout = self.command_timeout)
+        if after is None:
+            return
+        self.report.add_timing('import-after', after)
+        measure = 'best of %d warm runs, without writing bytecode, before precompiling' % IMPORT_RUNS
+        if self.site_layout == 'zip' and self.precompile:
+            measure += ' (with the eggs merged in a directory, as they are zipped after precompiling)'
+        self.report.add_detail('imports', {
+            'before': round(before, 3),
+            'after': round(after, 3),
+            'layout': self.site_layout,
+            'measure': measure,
+        })
+        logger.info('Importing the working set: %.3f secs (%.3f secs before merging the eggs; best of %d warm runs).' %
+                    (after, before, IMPORT_RUNS))
+
+
+    def _python(self):
+        """
+        The interpreter in the virtualenv (in the build directory)
+        """
+        return os.path.join(self.virtualenv_dir, 'bin', 'python')
 
 
     def _copy_outputs(self):
@@ -182,20 +994,46 @@ class Frozen(object):
         """
         logger.info('Copying outputs.')
         buildout_dir = self.buildout['buildout']['directory']
-        for part in self.buildout['buildout']['parts'].split():
-            try:
-                outputs = self.buildout[part]['output']
-                for output in outputs.splitlines():
-                    rel_dir = os.path.relpath(output, buildout_dir)
-                    dest_dir = self._virtualenv_path(os.path.dirname(rel_dir))
+        copies = []
+        for output in self._parts_outputs():
+            rel_dir = os.path.relpath(output, buildout_dir)
+            dest_dir = self._virtualenv_path(os.path.dirname(rel_dir))
+            if self.cleanups(os.path.join(dest_dir, os.path.basename(output))):
+                logger.debug('... skipping "%s"' % rel_dir)
+                continue
+
+            logger.debug('... "%s" -> "%s"' % (rel_dir, dest_dir))
+            if not os.path.exists(dest_dir):
+                os.makedirs(dest_dir)
+            copies.append((output, dest_dir))
+
+        hardlink = self._copy_hardlinks()
+        run_jobs(lambda copy: copy_file(copy[0], copy[1], hardlink),
+                 copies, self._copy_jobs())
+
+
+    def _copy_jobs(self):
+        return jobs_from_cfg(self.options.get('copy-jobs', '1'))
+
+    def _copy_hardlinks(self):
+        """
+        Return True if we can copy files with hardlinks, ie, when the staging directory is
+        in the same filesystem as the buildout and the user has enabled it
+        """
+        return _bool_from_cfg(self.options.get('copy-hardlinks', ''))
 
-                    logger.debug('... "%s" -> "%s"' % (rel_dir, dest_dir))
-                    if not os.path.exists(dest_dir):
-                        os.makedirs(dest_dir)
-                    shutil.copy2(output, dest_dir)
 
+    def _parts_outputs(self):
+        """
+        Return the "output" files of all the parts in the buildout
+        """
+        outputs = []
+        for part in self.buildout['buildout']['parts'].split():
+            try:
+                outputs += self.buildout[part]['output'].splitlines()
             except KeyError:
                 pass
+        return outputs
 
 
     def _copy_extra_files (self):
@@ -206,26 +1044,19 @@ class Frozen(object):
         assert (self.virtualenv_dir != None and len(self.virtualenv_dir) > 0)
         assert (self.pkg_prefix != None and len(self.pkg_prefix) > 0)
 
-        buildout_dir = self.buildout['buildout']['directory']
-
-        extra_copies = _lst_from_cfg(self.options.get('extra-copies', self.name))
         logger.info('Copying extras.')
-        for copy_line in extra_copies:
-            try:
-                src, dest = [b.strip() for b in copy_line.split("->")]
-            except Exception, e:
-                logger.critical("ERROR: malformed copy specification: %s [skipping]" % str(e))
-                return
-
-            if not os.path.isabs(src):
-                src = os.path.join(buildout_dir, src)
-
+        hardlink = self._copy_hardlinks()
+        jobs = self._copy_jobs()
+        for src, dest in self._extra_copies():
             full_path_dest = os.path.normpath(self._virtualenv_path(dest))
             for src_el in glob.glob(src):
                 logger.debug('... copying "%s".' % src_el)
                 try:
                     if os.path.isdir(src_el):
-                        shutil.copytree(src_el, full_path_dest)
+                        ## the destination can exist when updating a previous build
+                        if os.path.isdir(full_path_dest):
+                            shutil.rmtree(full_path_dest)
+                        copy_tree(src_el, full_path_dest, hardlink, jobs, self.cleanups)
                     else:
                         # maybe the destination is a directory: then we have to
                         # create it at the target too...
@@ -233,12 +1064,40 @@ class Frozen(object):
                             logger.debug('... creating "%s" directory.' % dest)
                             os.makedirs(full_path_dest)
 
-                        shutil.copy(src_el, full_path_dest)
+                        if os.path.isdir(full_path_dest):
+                            dest_file = os.path.join(full_path_dest, os.path.basename(src_el))
+                        else:
+                            dest_file = full_path_dest
+                        if self.cleanups(dest_file):
+                            logger.debug('... skipping "%s".' % src_el)
+                            continue
+
+                        copy_file(src_el, full_path_dest, hardlink, preserve_times = False)
 
                 except Exception, e:
                     logger.critical('ERROR: when copying "%s" to "%s": %s' % (src_el, full_path_dest, str(e)))
 
 
+    def _extra_copies (self):
+        """
+        Return the (source glob, destination) pairs in the "extra-copies"
+        """
+        buildout_dir = self.buildout['buildout']['directory']
+
+        copies = []
+        for copy_line in _lst_from_cfg(self.options.get('extra-copies', '')):
+            try:
+                src, dest = [b.strip() for b in copy_line.split("->")]
+            except Exception, e:
+                logger.critical("ERROR: malformed copy specification: %s [skipping]" % str(e))
+                break
+
+            if not os.path.isabs(src):
+                src = os.path.join(buildout_dir, src)
+            copies.append((src, dest))
+        return copies
+
+
     def _create_extra_dirs (self):
         """
         Create any extra dirs
@@ -273,39 +1132,44 @@ class Frozen(object):
         """
         extra_cleanups = self.options.get('extra-cleanups', None)
         if extra_cleanups:
+            ## most of the files matching the cleanups have never been copied, but
+            ## some things (ie, eggs installed with easy_install) must be removed now
             logger.debug('Performing extra cleanups.')
+            removed_files, removed_bytes = 0, 0
             for cleanup_pattern in _lst_from_cfg(extra_cleanups):
                 for cleanup_file in glob.glob(self._virtualenv_path(cleanup_pattern)):
-                    logger.debug('... removing "%s".' % cleanup_file)
-                    if os.path.isdir(cleanup_file):
+                    if self.precompile and cleanup_file.endswith('.py'):
+                        ## it will be removed after compiling it
+                        continue
+                    num_files, num_bytes = _disk_usage(cleanup_file)
+                    logger.debug('... removing "%s" (%d bytes).' % (cleanup_file, num_bytes))
+                    if os.path.isdir(cleanup_file) and not os.path.islink(cleanup_file):
                         shutil.rmtree(cleanup_file, ignore_errors = True)
                     else:
                         try:
                             os.remove(cleanup_file)
-                        except IOError, e:
+                        except (IOError, OSError), e:
                             logger.error('ERROR: could not remove "%s": %s' % (cleanup_file, str(e)))
+                            continue
+                    removed_files += num_files
+                    removed_bytes += num_bytes
+
+            if removed_files:
+                logger.info('Extra cleanups removed %d files (%d bytes) after staging.' % (removed_files, removed_bytes))
 
 
     def _prepare_venv(self):
         """
-        Finish the virtualenv by making it relocatable and removing some extra things we do not need...
+        Finish the virtualenv by pointing it to the prefix where it will be installed
+        and removing some extra things we do not need...
         """
+        prefix = os.path.normpath('/' + self.pkg_prefix.lstrip('/'))
+        jobs = jobs_from_cfg(self.options.get('relocation-jobs', '1'))
 
-        virtualenv = [
-            'virtualenv',
-            '--relocatable',
-            self.virtualenv_dir,
-            ]
-
-        logger.info('Making virtualenv relocatable with "%s".' % (" ".join(virtualenv)))
-        job = subprocess.Popen(virtualenv,
-                               stdout = subprocess.PIPE,
-                               stderr = subprocess.STDOUT)
-        stdout, _ = job.communicate()
-
-        if job.returncode != 0:
-            logger.critical('ERROR: could not run "virtualenv".')
-            sys.exit(1)
+        logger.info('Relocating virtualenv to "%s" (%d jobs).' % (prefix, jobs))
+        num_files = relocate_tree(self.virtualenv_dir, self.virtualenv_dir, prefix, jobs)
+        logger.info('... %d files relocated.' % num_files)
+        self.report.count('relocated-files', num_files)
 
         local_dir = os.path.join(self.virtualenv_dir, "local")
         if os.path.exists(local_dir):
@@ -314,31 +1178,157 @@ class Frozen(object):
 
 
 
-    def _create_tar (self, filename, compress = False):
+    def _precompile(self):
         """
-        Create a tar file from the virtualenv
+        Byte-compile the Python files in the virtualenv, with the paths of the installation prefix
         """
-        logger.info('Creating tar file from the virtualenv.')
-        import tarfile
-        with tarfile.open(filename, 'w' if not compress else 'w:gz', dereference = True) as t:
-            for name in glob.glob(os.path.join(self.buildroot, '*')):
-                rel_name = '/' + os.path.relpath(name, self.buildroot)
-                t.add(name, arcname = rel_name)
-
-        if compress:
-            output = os.path.join(filename + ".gz")
-        else:
-            output = filename
+        prefix = os.path.normpath('/' + self.pkg_prefix.lstrip('/'))
+        python = self._python()
+        optimize = int(self.options.get('precompile-optimize', '0'))
+        jobs = jobs_from_cfg(self.options.get('precompile-jobs', '1'))
+        if not optimize in (0, 1, 2):
+            from zc.buildout import UserError
+            raise UserError('invalid optimization level "%d" (valid levels: 0, 1, 2)' % optimize)
+
+        logger.info('Compiling Python files (%d jobs).' % jobs)
+        compiled, skipped, failures = precompile_tree(self.virtualenv_dir, prefix, python,
+                                                      optimize, jobs, self.cleanups, self.command_timeout)
+        for failure in failures:
+            logger.warning('... could not compile %s' % failure)
+        logger.info('... %d files compiled (%d up to date, %d failed).' % (compiled, skipped, len(failures)))
+        self.report.count('compiled-files', compiled)
+
+        ## now we can remove the sources matching the cleanups
+        sources = PathMatcher(_lst_from_cfg(self.options.get('extra-cleanups', '')), self.virtualenv_dir)
+        if sources:
+            num_files, num_bytes = drop_sources(self.virtualenv_dir, sources)
+            if num_files:
+                logger.info('... %d sources (%d bytes) removed.' % (num_files, num_bytes))
+
+
+    def _strip(self):
+        """
+        Strip the symbols and debug info from the ELF files in the virtualenv (ie, the C extensions)
+        """
+        jobs = jobs_from_cfg(self.options.get('strip-jobs', '1'))
+        debug_root = self.debug_dir if _bool_from_cfg(self.options.get('strip-debug', '')) else None
+
+        logger.info('Stripping ELF files (%d jobs).' % jobs)
+        stripped, failed = strip_tree(self.virtualenv_dir, self.pkg_prefix, jobs, self.cleanups, debug_root,
+                                      self.command_timeout)
+        saved = 0
+        for path, before, after in stripped:
+            saved += before - after
+            self.report.add_detail('strip', {
+                'path': os.path.relpath(path, self.virtualenv_dir),
+                'bytes_before': before,
+                'bytes_after': after,
+            })
+        logger.info('... %d files stripped (%d bytes saved, %d failed).' % (len(stripped), saved, failed))
+        self.report.count('strip-bytes-saved', saved)
+
+
+    def _debug_artifacts(self):
+        """
+        Create the tar file with the debug info of the files stripped (if we have kept it)
+        """
+        if not _bool_from_cfg(self.options.get('strip-debug', '')) or not os.path.isdir(self.debug_dir):
+            return []
+
+        filename = os.path.join(self._output_dir(),
+                                '%s-%s-%s-debuginfo.tar' % (self.pkg_name, self.pkg_version, self.pkg_release))
+        start = time.time()
+        digest = hashlib.sha256()
+        output = write_tar(self.debug_dir, filename, 'gzip', digest = digest)
+        self.report.add_phase('debuginfo', time.time() - start, 1, os.path.getsize(output))
+        output = self._publish(output, digest.hexdigest())
+        logger.info('Debug info saved at %s' % output)
+        return [output]
+
+
+    def _delta_artifacts(self, artifacts, base = None):
+        """
+        Create the manifest of the files in the package and the delta from a previous
+        package (with its files in "base"), and a deltarpm when the previous package
+        is a RPM, if we want them
+        """
+        save_manifest = _bool_from_cfg(self.options.get('delta-manifest', ''))
+        if not base and not save_manifest:
+            return []
+
+        name = '%s-%s-%s' % (self.pkg_name, self.pkg_version, self.pkg_release)
+        outputs = []
+        with self.report.phase('delta'):
+            logger.info('Hashing the files in the package.')
+            files = tree_files(self.buildroot, self.virtualenv_dir, self.cleanups)
+            if save_manifest:
+                filename = write_files_manifest(os.path.join(self._output_dir(), name + FILES_MANIFEST_EXT), files, {
+                    'name': self.pkg_name,
+                    'version': self.pkg_version,
+                    'release': self.pkg_release,
+                    'prefix': self.pkg_prefix,
+                })
+                outputs.append(self._publish(filename))
+
+            if base:
+                logger.info('Creating the delta from %s.' % os.path.basename(self.delta_from))
+                old_files, old_info = base
+                changed, deleted = diff_files(old_files, files, os.path.relpath(self.virtualenv_dir, self.buildroot))
+                digest = hashlib.sha256()
+                filename = write_delta(os.path.join(self._output_dir(), name + DELTA_EXT),
+                                       self.buildroot, self.pkg_prefix, files, changed, deleted, {
+                                           'from': old_info['package'],
+                                           'to': name,
+                                           'changed': len(changed),
+                                           'deleted': len(deleted),
+                                       }, {
+                                           'def_user': self.options.get('attr-def-user', 'root'),
+                                           'def_group': self.options.get('attr-def-group', 'root'),
+                                           'def_mode': int(self.options.get('attr-def-mode', '0755'), 8),
+                                       }, digest)
+                logger.info('... %d files changed, %d deleted (%d bytes).' %
+                            (len(changed), len(deleted), os.path.getsize(filename)))
+                self.report.count('delta-files-changed', len(changed))
+                self.report.count('delta-files-deleted', len(deleted))
+                outputs.append(self._publish(filename, digest.hexdigest()))
+
+                ## file deltas do not update the RPM database, so RPMs get a deltarpm too
+                if self.delta_from.endswith('.rpm'):
+                    for rpm in [a for a in artifacts if a.endswith('.rpm') and
+                                os.path.abspath(a) != self.delta_from]:
+                        drpm = make_deltarpm(self.delta_from, rpm, self._output_dir(), self.command_timeout)
+                        if drpm:
+                            logger.info('... deltarpm: %s (%d bytes).' % (os.path.basename(drpm),
+                                                                        os.path.getsize(drpm)))
+                            outputs.append(self._publish(drpm))
+        return outputs
+
+
+    def _dedup(self):
+        """
+        Replace the identical files in the virtualenv by hardlinks, so they are stored only once in the package
+        """
+        jobs = jobs_from_cfg(self.options.get('dedup-jobs', '1'))
+        logger.info('Looking for duplicate files (%d jobs).' % jobs)
+        num_files, num_bytes = dedup_tree(self.virtualenv_dir, jobs, self.cleanups)
+        logger.info('... %d duplicate files replaced by hardlinks (%d bytes saved).' % (num_files, num_bytes))
+        self.report.count('dedup-files', num_files)
+        self.report.count('dedup-bytes-saved', num_bytes)
 
 
-        for name in glob.glob(os.path.join(self.buildroot, '*')):
-            shutil.rmtree(name, ignore_errors=True)
+    def _create_tar (self, filename, compression = 'none', digest = None):
+        """
+        Create a tar file from the virtualenv, returning the name of the file created
+        (and updating "digest" with its contents)
+        """
+        level = self.options.get('compression-level', None)
+        threads = jobs_from_cfg(self.options.get('compression-threads', '1'))
 
-        logger.debug('... overwriting everything on %s' % self.buildroot)
-        mode = 'r' if not compress else 'r:gz'
-        tar = tarfile.open(output, mode)
-        tar.extractall(path=self.buildroot)
-        tar.close()
+        logger.info('Creating tar file from the virtualenv.')
+        start = time.time()
+        output = write_tar(self.buildroot, filename, compression,
+                           int(level) if level else None, threads, self.cleanups, digest)
+        self.report.add_phase('tar', time.time() - start, 1, os.path.getsize(output))
 
         logger.debug('... output: %s.' % output)
         return output
@@ -0,0 +1,70 @@
+import logging
+import os
+import hashlib
+
+from frozen import Frozen, _bool_from_cfg, _deps_from_cfg
+from jobs import jobs_from_cfg
+from matcher import PathMatcher
+from debwriter import write_deb, deb_package_name
+
+logger = logging.getLogger(__name__)
+
+
+class FrozenDeb(Frozen):
+
+    format = 'deb'
+
+    def _deb_metadata(self):
+        """
+        The information about the package we put in the control file
+        """
+        if self.pkg_packager == 'unknown':
+            maintainer = self.pkg_vendor
+        else:
+            maintainer = self.pkg_packager
+
+        return {
+            'name':         self.pkg_name,
+            'version':      self.pkg_version,
+            'release':      self.pkg_release,
+            'description':  'The %s package.\n%s' % (self.pkg_name, self.pkg_license),
+            'maintainer':   maintainer,
+            'url':          self.pkg_url if self.pkg_url != 'unknown' else '',
+            'section':      self.pkg_group if self.pkg_group != 'unknown' else '',
+            'deps':         _deps_from_cfg(self.options.get('pkg-deps', '')),
+            'pre':          self.options.get('pkg-pre-install', '').strip(),
+            'post':         self.options.get('pkg-post-install', '').strip(),
+            'def_user':     self.options.get('attr-def-user', 'root'),
+            'def_group':    self.options.get('attr-def-group', 'root'),
+            'def_mode':     int(self.options.get('attr-def-mode', '0755'), 8),
+        }
+
+    def _package (self):
+        """
+        Create a deb
+        """
+        if _bool_from_cfg(self.pkg_autodeps):
+            logger.warning('automatic dependencies are not generated for deb packages')
+        if deb_package_name(self.pkg_name) != self.pkg_name:
+            logger.info('Using "%s" as the Debian package name.' % deb_package_name(self.pkg_name))
+
+        ## configuration files, as patterns relative to the buildroot
+        confs = PathMatcher([c.lstrip('/') for c in self._attr_confs()], self.buildroot)
+
+        level = self.options.get('compression-level', None)
+        digest = hashlib.sha256()
+        with self.report.phase('deb'):
+            deb_filename = write_deb(self._output_dir(),
+                                     self.buildroot,
+                                     self.pkg_prefix,
+                                     self._deb_metadata(),
+                                     self.options.get('compression', 'gzip').strip(),
+                                     int(level) if level else None,
+                                     jobs_from_cfg(self.options.get('compression-threads', '1')),
+                                     self.cleanups,
+                                     confs,
+                                     digest)
+        deb_filename = self._publish(deb_filename, digest.hexdigest())
+
+        logger.info('Built %s' % deb_filename)
+        return [os.path.basename(deb_filename)]
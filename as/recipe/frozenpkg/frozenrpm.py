@@ -1,13 +1,14 @@
-import StringIO
 import os
-import sys
 import shutil
-import tempfile
-import glob
+import hashlib
 import fnmatch
-import subprocess
 
-from frozen import Frozen
+from frozen import Frozen, _bool_from_cfg, _deps_from_cfg
+from copier import link_packaged_tree
+from jobs import jobs_from_cfg
+from matcher import PathMatcher
+from rpmwriter import write_rpm
+from runner import run
 
 import logging
 logger = logging.getLogger(__name__)
@@ -55,6 +56,9 @@ The @PKG_NAME@ package.
 
 @SCRIPTS@
 
+# the buildroot is removed once rpmbuild has finished
+%clean
+
 %files
 
 %defattr(-, @ATTR_DEFAULT_USER@, @ATTR_DEFAULT_GROUP@, @ATTR_DEFAULT_MODE@)
@@ -79,18 +83,45 @@ RPM_BUILD_DIRS = [
 
 class FrozenRPM(Frozen):
 
+    format = 'rpm'
+
+    def _rpm_metadata(self):
+        """
+        The information about the package we put in the RPM header
+        """
+        return {
+            'name':         self.pkg_name,
+            'version':      self.pkg_version,
+            'release':      self.pkg_release,
+            'summary':      self.pkg_name,
+            'description':  'The %s package.\n%s' % (self.pkg_name, self.pkg_license),
+            'vendor':       self.pkg_vendor,
+            'packager':     self.pkg_packager,
+            'url':          self.pkg_url,
+            'license':      self.pkg_license,
+            'group':        self.pkg_group,
+            'deps':         _deps_from_cfg(self.options.get('pkg-deps', '')),
+            'pre':          self.options.get('pkg-pre-install', '').strip(),
+            'post':         self.options.get('pkg-post-install', '').strip(),
+            'def_user':     self.options.get('attr-def-user', 'root'),
+            'def_group':    self.options.get('attr-def-group', 'root'),
+            'def_mode':     int(self.options.get('attr-def-mode', '0755'), 8),
+        }
+
     def _save_spec_file(self):
+        metadata = self._rpm_metadata()
+
         # replace the variables in the "spec" template
         rpmspec = RPM_SPEC_TEMPLATE
         rpmspec = rpmspec.replace("@TOP_DIR@", self.rpmbuild_dir)
-        rpmspec = rpmspec.replace("@PKG_NAME@", self.pkg_name)
-        rpmspec = rpmspec.replace("@PKG_VENDOR@", self.pkg_vendor)
-        rpmspec = rpmspec.replace("@PKG_VERSION@", self.pkg_version)
-        rpmspec = rpmspec.replace("@PKG_RELEASE@", self.pkg_release)
-        rpmspec = rpmspec.replace("@PKG_PACKAGER@", self.pkg_packager)
-        rpmspec = rpmspec.replace("@PKG_URL@", self.pkg_url)
-        rpmspec = rpmspec.replace("@PKG_LICENSE@", self.pkg_license)
-        rpmspec = rpmspec.replace("@PKG_GROUP@", self.pkg_group)
+        rpmspec = rpmspec.replace("@PKG_NAME@", metadata['name'])
+        rpmspec = rpmspec.replace("@PKG_VENDOR@", metadata['vendor'])
+        rpmspec = rpmspec.replace("@PKG_VERSION@", metadata['version'])
+        rpmspec = rpmspec.replace("@PKG_RELEASE@", metadata['release'])
+        rpmspec = rpmspec.replace("@PKG_PACKAGER@", metadata['packager'])
+        rpmspec = rpmspec.replace("@PKG_URL@", metadata['url'])
+        rpmspec = rpmspec.replace("@PKG_LICENSE@", metadata['license'])
+        rpmspec = rpmspec.replace("@PKG_GROUP@", metadata['group'])
         rpmspec = rpmspec.replace("@PKG_AUTODEPS@", self.pkg_autodeps)
         rpmspec = rpmspec.replace("@PKG_PREFIX@", self.pkg_prefix)
         rpmspec = rpmspec.replace("@BUILD_ROOT@", self.buildroot)
@@ -102,32 +133,23 @@ class FrozenRPM(Frozen):
 
         # determine if we must run any pre/post commands
         scripts = ""
-        pre_cmds = self.options.get('pkg-pre-install', None)
-        if pre_cmds:
-            scripts += "%pre\n" + pre_cmds.strip() + "\n\n"
+        if metadata['pre']:
+            scripts += "%pre\n" + metadata['pre'] + "\n\n"
 
-        post_cmds = self.options.get('pkg-post-install', None)
-        if post_cmds:
-            scripts += "%post\n" + post_cmds.strip() + "\n\n"
+        if metadata['post']:
+            scripts += "%post\n" + metadata['post'] + "\n\n"
 
         rpmspec = rpmspec.replace("@SCRIPTS@", scripts)
 
-        rpmspec = rpmspec.replace("@ATTR_DEFAULT_USER@",  self.options.get('attr-def-user', 'root'))
-        rpmspec = rpmspec.replace("@ATTR_DEFAULT_GROUP@", self.options.get('attr-def-group', 'root'))
-        rpmspec = rpmspec.replace("@ATTR_DEFAULT_MODE@",  self.options.get('attr-def-mode', '0755'))
-
+        rpmspec = rpmspec.replace("@ATTR_DEFAULT_USER@",  metadata['def_user'])
+        rpmspec = rpmspec.replace("@ATTR_DEFAULT_GROUP@", metadata['def_group'])
+        rpmspec = rpmspec.replace("@ATTR_DEFAULT_MODE@",  '%04o' % metadata['def_mode'])
 
-        conf_lines = self.options.get('attr-conf', None)
-        conf_lines_str = ''
-        if conf_lines:
-            for line in StringIO.StringIO(conf_lines).readlines():
-                if not os.path.isabs(line):
-                    line = os.path.abspath(self.pkg_prefix + '/' + line)
-                conf_lines_str += "\n%config " + line
+        conf_lines_str = ''.join(["\n%config " + line for line in self._attr_confs()])
         rpmspec = rpmspec.replace("@ATTR_CONFS@", conf_lines_str)
 
-        ## save the spec file
-        spec_filename = os.path.abspath(os.path.join(self.buildroot, self.pkg_name) + ".spec")
+        ## save the spec file (out of the buildroot, so it is not packaged in other formats)
+        spec_filename = self._spec_filename()
         logger.debug('Using spec file %s' % (spec_filename))
         spec_file = None
         try:
@@ -140,46 +162,65 @@ class FrozenRPM(Frozen):
         if spec_file:
             spec_file.close()
 
-    def install (self):
-        """
-        Create a RPM
-        """
+    def _spec_filename(self):
+        return os.path.abspath(os.path.join(self.rpmbuild_dir, "SPECS", self.pkg_name) + ".spec")
 
-        super(FrozenRPM, self).install()
+    def _rpm_builder(self):
+        builder = self.options.get('rpm-builder', 'rpmbuild').strip()
+        if not builder in ['native', 'rpmbuild']:
+            from zc.buildout import UserError
+            raise UserError('unknown rpm-builder "%s" (valid builders: native, rpmbuild)' % builder)
+        return builder
+
+    def _prepare_package(self):
+        if self._rpm_builder() != 'rpmbuild':
+            return
 
         self._create_rpm_dirs()
         self._save_spec_file()
-        self._copy_eggs()
-        self._copy_outputs()
-        self._create_extra_dirs()
-        self._copy_extra_files()
-        self._extra_cleanups()
-        self._prepare_venv()
-
-        # create a tar file at SOURCES/.
-        # we can pass a tar file to rpmbuild, so it is easier as we may need
-        # a "tar" anyway.
-        # the spec file should be inside the tar, at the top level...
-        tar_filename = os.path.join(self.rpmbuild_dir, "SOURCES", self.pkg_name + ".tar")
-        tar_filename = self._create_tar(tar_filename)
-
-        # launch rpmbuild
+
+        ## rpmbuild packages a buildroot as it is, so we give it a replica of ours (with
+        ## hardlinks) with the same contents as the other packages, ie, without links
+        ## to files that will not exist in the target machine
+        with self.report.phase('rpm-buildroot'):
+            rpm_buildroot = self._rpm_buildroot()
+            if os.path.exists(rpm_buildroot):
+                shutil.rmtree(rpm_buildroot)
+            link_packaged_tree(self.buildroot, self.virtualenv_dir, rpm_buildroot, self.cleanups)
+
+    def _rpm_buildroot(self):
+        return os.path.join(self.rpmbuild_dir, "RPMROOT", self.pkg_name)
+
+    def _package (self):
+        """
+        Create a RPM
+        """
+        if self._rpm_builder() == 'native':
+            return self._package_native()
+
+        # launch rpmbuild with the spec file: it packages the replica of the
+        # buildroot as it is, so we do not need to create a tar file with it
         command = [
             "rpmbuild",
-            "--buildroot", self.buildroot,
+            "--buildroot", self._rpm_buildroot(),
             "--define",
             "_topdir %s" % self.rpmbuild_dir,
-            "-ta", tar_filename,
+            "-bb", self._spec_filename(),
         ]
 
         logger.info('Launching "%s".' % ' '.join(command))
-        job = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-        stdout, _ = job.communicate()
-
-        if job.returncode != 0:
-            logger.critical('could not build the RPM.')
-            print stdout
-            return []
+        with self.report.phase('rpmbuild'):
+            try:
+                result = run(command, self.command_timeout, log = logger, level = logging.INFO)
+            finally:
+                shutil.rmtree(self._rpm_buildroot(), ignore_errors = True)
+
+        if not result.ok:
+            ## the other formats can succeed, but the build must fail
+            from zc.buildout import UserError
+            msg = 'could not build the RPM: %s' % result.error()
+            logger.critical(msg)
+            raise UserError(msg)
 
         # now try to find the RPMs we have built
         result_rpms = []
@@ -190,21 +231,49 @@ class FrozenRPM(Frozen):
                     if fnmatch.fnmatch(rpm_file, "*.rpm"):
                         full_rpm_file = os.path.abspath(os.path.join(full_arch_dir, rpm_file))
 
-                        shutil.copy(full_rpm_file, self.buildout['buildout']['directory'])
+                        self._publish(full_rpm_file)
 
                         logger.debug('Built %s' % (rpm_file))
                         result_rpms = result_rpms + [rpm_file]
 
-        if not self.debug:
-            shutil.rmtree(self.rpmbuild_dir)
-
         return result_rpms
 
 
+    def _package_native(self):
+        """
+        Create a RPM with our own RPM writer, in one pass over the buildroot
+        """
+        if _bool_from_cfg(self.pkg_autodeps):
+            logger.warning('the native RPM builder does not generate automatic dependencies')
+
+        ## configuration files, as patterns relative to the buildroot
+        confs = PathMatcher([c.lstrip('/') for c in self._attr_confs()], self.buildroot)
+
+        level = self.options.get('compression-level', None)
+        digest = hashlib.sha256()
+        with self.report.phase('rpm'):
+            rpm_filename = write_rpm(self._output_dir(),
+                                     self.buildroot,
+                                     self.pkg_prefix,
+                                     self._rpm_metadata(),
+                                     self.options.get('compression', 'gzip').strip(),
+                                     int(level) if level else None,
+                                     jobs_from_cfg(self.options.get('compression-threads', '1')),
+                                     self.cleanups,
+                                     confs,
+                                     digest)
+        rpm_filename = self._publish(rpm_filename, digest.hexdigest())
+
+        logger.info('Built %s' % rpm_filename)
+        return [os.path.basename(rpm_filename)]
+
     def _create_rpm_dirs(self):
         """
         Create all the top dirs
         """
+        # do not pick the RPMs from a previous build
+        shutil.rmtree(os.path.join(self.rpmbuild_dir, "RPMS"), ignore_errors = True)
+
         for p in RPM_BUILD_DIRS:
             full_p = os.path.join(self.rpmbuild_dir, p)
             if not os.path.exists(full_p):
@@ -215,6 +284,3 @@ class FrozenRPM(Frozen):
                     shutil.rmtree(self.rpmbuild_dir, ignore_errors = True)
                     raise
 
-
-    def update (self):
-        pass
@@ -0,0 +1,114 @@
+
+import os
+import shutil
+import pkg_resources
+
+from copier import link_tree
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: the script that "easy_install" creates for entry points (used when setuptools cannot generate it)
+ENTRY_POINT_SCRIPT_TEMPLATE = """\
+# EASY-INSTALL-ENTRY-SCRIPT: %(spec)r,%(group)r,%(name)r
+__requires__ = %(spec)r
+import re
+import sys
+from pkg_resources import load_entry_point
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\.pyw?|\.exe)?$', '', sys.argv[0])
+    sys.exit(
+        load_entry_point(%(spec)r, %(group)r, %(name)r)()
+    )
+"""
+
+
+
+def can_install(dist):
+    """
+    Return True if a distribution can be installed without running "easy_install",
+    ie, it is a built egg (zipped or unpacked) in the eggs directory. Develop eggs
+    must be built by "easy_install": their source directory has more than what goes
+    in the egg, and the "scripts" of their setup.py are not in their metadata.
+    """
+    return dist.precedence == pkg_resources.EGG_DIST and \
+           dist.location.endswith('.egg') and \
+           os.path.exists(dist.location)
+
+
+def _entry_point_scripts(dist, header):
+    """
+    Yield the (name, contents) of the scripts for the entry points of a distribution
+    """
+    try:
+        from setuptools.command.easy_install import ScriptWriter
+    except ImportError:
+        ScriptWriter = None
+
+    if ScriptWriter and hasattr(ScriptWriter, 'get_args'):
+        for args in ScriptWriter.get_args(dist, header):
+            yield args[0], args[1]
+        return
+
+    spec = str(dist.as_requirement())
+    for group in ['console_scripts', 'gui_scripts']:
+        for name in dist.get_entry_map(group).keys():
+            yield name, header + ENTRY_POINT_SCRIPT_TEMPLATE % locals()
+
+
+def _write_script(filename, contents):
+    if os.path.lexists(filename):
+        os.remove(filename)
+    f = open(filename, 'wb')
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+    os.chmod(filename, 0755)
+
+
+def install_egg(dist, virtualenv_dir, site_packages, exclude = None):
+    """
+    Install a built egg in the virtualenv, in the same way "easy_install" would do:
+    the egg is linked into the site-packages directory and the scripts are created
+    at "bin/". The "easy-install.pth" file must be written by the caller.
+    Files matching "exclude" are not installed.
+    """
+    dest = os.path.join(site_packages, os.path.basename(dist.location))
+    if os.path.lexists(dest):
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        else:
+            os.remove(dest)
+    link_tree(dist.location, dest, exclude)
+
+    bin_dir = os.path.join(virtualenv_dir, 'bin')
+    header = '#!%s\n' % os.path.join(bin_dir, 'python')
+
+    scripts = []
+    for name, contents in _entry_point_scripts(dist, header):
+        if exclude and exclude(os.path.join(bin_dir, name)):
+            continue
+        _write_script(os.path.join(bin_dir, name), contents)
+        scripts.append(name)
+
+    ## the scripts in the egg: just fix the interpreter they use
+    if dist.has_metadata('scripts'):
+        for name in dist.metadata_listdir('scripts'):
+            if dist.metadata_isdir('scripts/' + name):
+                continue
+            if exclude and exclude(os.path.join(bin_dir, name)):
+                continue
+            contents = dist.get_metadata('scripts/' + name)
+            first_line = contents.split('\n', 1)[0]
+            if first_line.startswith('#!') and 'python' in first_line:
+                contents = header + contents.split('\n', 1)[1]
+            _write_script(os.path.join(bin_dir, name), contents)
+            scripts.append(name)
+
+    logger.info('... installed "%s" from "%s"' % (dist.key, dist.location))
+    if scripts:
+        logger.debug('...... scripts: %s' % ', '.join(scripts))
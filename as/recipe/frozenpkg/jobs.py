@@ -0,0 +1,82 @@
+
+import sys
+import threading
+import Queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def jobs_from_cfg(opt, default = 1):
+    """
+    Parse a number of jobs from an option: a positive number, or "auto" for
+    the number of CPUs in this machine
+    """
+    opt = (opt or '').strip().lower()
+    if not opt:
+        return default
+    if opt == 'auto':
+        return _cpu_count()
+    try:
+        jobs = int(opt)
+    except ValueError:
+        from zc.buildout import UserError
+        raise UserError('invalid number of jobs "%s"' % opt)
+    return max(1, jobs)
+
+
+def run_jobs(func, items, jobs = 1):
+    """
+    Run "func" on every item, with at most "jobs" items being processed at the
+    same time, and return the results in the same order as the items.
+
+    When "func" raises an exception, no more items are started and the
+    exception is raised again (with its original traceback) once the running
+    items have finished.
+    """
+    items = list(items)
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+
+    failures = []
+    failed = threading.Event()
+
+    def _worker():
+        while not failed.is_set():
+            try:
+                i, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except:
+                failures.append(sys.exc_info())
+                failed.set()
+
+    workers = [threading.Thread(target = _worker) for _ in range(jobs)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if failures:
+        exc_type, exc_value, exc_tb = failures[0]
+        raise exc_type, exc_value, exc_tb
+
+    return results
@@ -0,0 +1,242 @@
+
+import os
+import time
+import shutil
+import zipfile
+import filecmp
+import pkg_resources
+
+from runner import run
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: the layouts of the site-packages directory we can create
+SITE_LAYOUTS = ['eggs', 'merged', 'zip']
+
+#: the archive (in the site-packages) where the eggs are merged with the "zip" layout
+MERGED_ZIP = 'merged-eggs.zip'
+
+#: extensions of the files that cannot be imported from a merged directory or a zip
+NATIVE_EXTENSIONS = ('.so', '.pyd', '.dylib', '.dll')
+
+#: times we run the interpreter when measuring the import time (we keep the best)
+IMPORT_RUNS = 3
+
+
+
+def check_site_layout(layout):
+    if not layout in SITE_LAYOUTS:
+        from zc.buildout import UserError
+        raise UserError('unknown site-packages layout "%s" (valid layouts: %s)' %
+                        (layout, ', '.join(SITE_LAYOUTS)))
+
+
+class _Egg(object):
+    """
+    An egg installed in the site-packages directory (unpacked or zipped)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.zipped = os.path.isfile(path)
+        if self.zipped:
+            self._zip = zipfile.ZipFile(path)
+            self.names = [n for n in self._zip.namelist() if not n.endswith('/')]
+        else:
+            self.names = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    self.names.append(os.path.relpath(os.path.join(dirpath, filename), path))
+
+    def has(self, name):
+        return name in self.names
+
+    def read(self, name):
+        if self.zipped:
+            return self._zip.read(name)
+        f = open(os.path.join(self.path, name), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def is_pure(self):
+        return not [n for n in self.names if n.endswith(NATIVE_EXTENSIONS)] and \
+               not self.has('EGG-INFO/native_libs.txt')
+
+    def is_zip_safe(self):
+        ## zipped eggs have been zipped because they were zip-safe
+        return self.zipped or (self.has('EGG-INFO/zip-safe') and not self.has('EGG-INFO/not-zip-safe'))
+
+    def destination(self, name, target_dir, egg_info_dir):
+        if name.startswith('EGG-INFO/'):
+            return os.path.join(egg_info_dir, name[len('EGG-INFO/'):])
+        return os.path.join(target_dir, name)
+
+    def conflicts(self, target_dir, egg_info_dir):
+        """
+        Return the files of this egg that already exist (with other contents) in the target
+        """
+        conflicts = []
+        for name in self.names:
+            dest = self.destination(name, target_dir, egg_info_dir)
+            if os.path.exists(dest):
+                if self.zipped:
+                    f = open(dest, 'rb')
+                    try:
+                        same = f.read() == self.read(name)
+                    finally:
+                        f.close()
+                else:
+                    same = filecmp.cmp(os.path.join(self.path, name), dest, shallow = False)
+                if not same:
+                    conflicts.append(name)
+        return conflicts
+
+    def move_to(self, target_dir, egg_info_dir):
+        """
+        Move the contents of the egg to the target directory, and its metadata
+        to "egg_info_dir", removing the egg
+        """
+        for name in self.names:
+            dest = self.destination(name, target_dir, egg_info_dir)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            if os.path.lexists(dest):
+                os.remove(dest)
+            if self.zipped:
+                f = open(dest, 'wb')
+                try:
+                    f.write(self.read(name))
+                finally:
+                    f.close()
+                info = self._zip.getinfo(name)
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                os.utime(dest, (mtime, mtime))
+                if info.external_attr >> 16:
+                    os.chmod(dest, (info.external_attr >> 16) & 07777)
+            else:
+                ## files are moved, so hardlinks to some cache are never modified
+                os.rename(os.path.join(self.path, name), dest)
+
+        if self.zipped:
+            self._zip.close()
+            os.remove(self.path)
+        else:
+            shutil.rmtree(self.path)
+
+
+def _pth_entries(pth_filename):
+    if not os.path.exists(pth_filename):
+        return []
+    return [l.rstrip('\n') for l in open(pth_filename).readlines()]
+
+
+def merge_eggs(site_packages, keys, layout):
+    """
+    Merge the pure-Python eggs installed in "site_packages" for the distributions
+    with "keys" in the site-packages directory ("merged" layout) or in a directory
+    that will become a zip file ("zip" layout, only for zip-safe eggs). The metadata
+    of the eggs is kept as ".egg-info" directories in the site-packages, and
+    "easy-install.pth" has only one entry for all the merged eggs.
+
+    Return the eggs merged.
+    """
+    if layout == 'zip':
+        target_dir = os.path.join(site_packages, MERGED_ZIP)
+    else:
+        target_dir = site_packages
+
+    installed = [d for d in pkg_resources.find_distributions(site_packages)
+                 if d.key in keys and d.location != site_packages and d.location.endswith('.egg')]
+
+    merged = []
+    for dist in installed:
+        egg = _Egg(dist.location)
+        egg_name = os.path.basename(dist.location)
+        egg_info_dir = os.path.join(site_packages, egg_name[:-len('.egg')] + '.egg-info')
+
+        if not egg.is_pure():
+            logger.debug('... keeping "%s": it has C extensions' % egg_name)
+            continue
+        if layout == 'zip' and not egg.is_zip_safe():
+            logger.debug('... keeping "%s": it is not zip-safe' % egg_name)
+            continue
+        conflicts = egg.conflicts(target_dir, egg_info_dir)
+        if conflicts:
+            logger.debug('... keeping "%s": %s would be overwritten' % (egg_name, conflicts[0]))
+            continue
+
+        logger.debug('... merging "%s"' % egg_name)
+        egg.move_to(target_dir, egg_info_dir)
+        merged.append(egg_name)
+
+    ## remove the merged eggs from "easy-install.pth", and put the zip where the first one was
+    pth_filename = os.path.join(site_packages, 'easy-install.pth')
+    entries = _pth_entries(pth_filename)
+    if merged and entries:
+        removed = ['./' + egg_name for egg_name in merged]
+        lines = []
+        for line in entries:
+            if line.strip() in removed:
+                if layout == 'zip' and not './' + MERGED_ZIP in lines:
+                    lines.append('./' + MERGED_ZIP)
+                continue
+            lines.append(line)
+        pth_file = open(pth_filename, 'w')
+        try:
+            pth_file.write('\n'.join(lines) + '\n')
+        finally:
+            pth_file.close()
+
+    return merged
+
+
+def zip_merged_eggs(site_packages):
+    """
+    Replace the directory where the eggs have been merged by a zip file (with the same name).
+    Members are stored without compression: the package is compressed anyway,
+    and they are faster to import.
+    """
+    target_dir = os.path.join(site_packages, MERGED_ZIP)
+    if not os.path.isdir(target_dir):
+        return None
+
+    tmp_filename = target_dir + '.tmp'
+    archive = zipfile.ZipFile(tmp_filename, 'w', zipfile.ZIP_STORED)
+    try:
+        for dirpath, dirnames, filenames in os.walk(target_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                archive.write(path, os.path.relpath(path, target_dir))
+    finally:
+        archive.close()
+
+    shutil.rmtree(target_dir)
+    os.rename(tmp_filename, target_dir)
+    return target_dir
+
+
+def import_time(python, modules, runs = IMPORT_RUNS, timeout = None):
+    """
+    Return the time (the best of some runs) it takes to start "python" and import
+    some modules. Nothing is written while importing, so the tree is not modified
+    and the bytecode used is the one already there. Runs after the first one find
+    the files in the page cache, so this is a warm start, not a cold one.
+    """
+    script = 'for m in %r:\n    try: __import__(m)\n    except Exception: pass\n' % sorted(set(modules))
+    best = None
+    for i in range(runs):
+        start = time.time()
+        result = run([python, '-B', '-c', script], timeout)
+        elapsed = time.time() - start
+        if not result.ok:
+            logger.debug('... could not measure the import time with "%s"' % python)
+            return None
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
@@ -0,0 +1,141 @@
+
+import os
+import json
+import hashlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: directories and files that change when building, but are not real changes in the inputs
+STAMP_SKIP_DIRS = ['build', 'dist', '.git', '.svn', '.hg']
+STAMP_SKIP_EXTS = ['.pyc', '.pyo']
+
+
+
+def stamp(path, filtered = True):
+    """
+    Return a cheap stamp for a file or a directory tree: the number of files, the
+    total size and the newest modification time. When "filtered", the build and VCS
+    directories and the bytecode are not taken into account (ie, for develop eggs,
+    but not for the data copied with "extra-copies").
+    """
+    if not os.path.isdir(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [1, st.st_size, int(st.st_mtime)]
+
+    num_files, size, mtime = 0, 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        if filtered:
+            dirnames[:] = [d for d in dirnames if d not in STAMP_SKIP_DIRS]
+        for filename in filenames:
+            if filtered and os.path.splitext(filename)[1] in STAMP_SKIP_EXTS:
+                continue
+            try:
+                st = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            num_files += 1
+            size += st.st_size
+            mtime = max(mtime, int(st.st_mtime))
+    return [num_files, size, mtime]
+
+
+def content_stamp(path, filtered = True):
+    """
+    Return a stamp for a file or a directory tree based on its contents, so it does not
+    change when files are written again with the same contents. "filtered" is the same
+    as in stamp() (and skips the ".egg-info" directories too).
+    """
+    h = hashlib.sha1()
+    if not os.path.isdir(path):
+        _hash_file(h, path)
+        return h.hexdigest()
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        if filtered:
+            dirnames[:] = [d for d in dirnames if d not in STAMP_SKIP_DIRS and not d.endswith('.egg-info')]
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filtered and os.path.splitext(filename)[1] in STAMP_SKIP_EXTS:
+                continue
+            full_filename = os.path.join(dirpath, filename)
+            h.update(os.path.relpath(full_filename, path) + '\0')
+            _hash_file(h, full_filename)
+    return h.hexdigest()
+
+
+def _hash_file(h, filename):
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+
+
+class Manifest(object):
+    """
+    The inputs used in the last successful build, grouped by the phase that uses them
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.previous = {}
+        self.current = {}
+        if filename and os.path.exists(filename):
+            try:
+                self.previous = json.load(open(filename))
+            except ValueError:
+                logger.warning('could not parse the manifest at "%s": ignoring it' % filename)
+
+    def get(self, phase, default = None):
+        return self.previous.get(phase, default)
+
+    def matches(self, phase, inputs):
+        """
+        Return True if the inputs of a phase are the same as in the last build
+        """
+        return phase in self.previous and self.previous[phase] == _normalized(inputs)
+
+    def record(self, phase, inputs):
+        self.current[phase] = _normalized(inputs)
+
+    def reset(self):
+        """
+        Forget the previous build: everything will be considered as changed
+        """
+        self.previous = {}
+
+    def invalidate(self):
+        """
+        Remove the saved manifest, so an interrupted build is not taken as a good one
+        """
+        if self.filename and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp_filename = self.filename + '.tmp'
+        f = open(tmp_filename, 'w')
+        try:
+            json.dump(self.current, f, indent = 1, sort_keys = True)
+        finally:
+            f.close()
+        os.rename(tmp_filename, self.filename)
+
+
+def _normalized(inputs):
+    ## a round trip to JSON, so tuples and lists compare the same
+    return json.loads(json.dumps(inputs))
@@ -0,0 +1,93 @@
+
+import os
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+def _translate(pattern):
+    """
+    Translate a glob pattern to a regular expression, with the same semantics as
+    "glob.glob": wildcards do not match "/", and they do not match a leading "."
+    """
+    res = []
+    i, n = 0, len(pattern)
+    component_start = True
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c in '*?' and component_start:
+            res.append(r'(?!\.)')
+        if c == '*':
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res.append(r'\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res.append('[%s]' % stuff)
+        else:
+            res.append(re.escape(c))
+        component_start = (c == '/')
+    return ''.join(res)
+
+
+class PathMatcher(object):
+    """
+    A set of glob patterns (relative to a root directory) compiled in one regular
+    expression. A path matches when it, or any of its parent directories, matches
+    any of the patterns.
+
+    Paths ending with any of the "keep" suffixes only match through their parents
+    (ie, we can keep the ".py" files for compiling them, and remove them later).
+    """
+
+    def __init__(self, patterns, root, keep = ()):
+        self.root = os.path.normpath(root)
+        self.keep = tuple(keep)
+        self.patterns = [os.path.normpath(p.strip().strip('/')) for p in patterns if p.strip()]
+        if self.patterns:
+            self._regex = re.compile('(?:%s)\Z' % '|'.join([_translate(p) for p in self.patterns]))
+        else:
+            self._regex = None
+
+    def __nonzero__(self):
+        return self._regex is not None
+
+    def matches(self, path):
+        """
+        Return True if an absolute path (under the root directory) matches
+        """
+        if self._regex is None:
+            return False
+
+        path = os.path.normpath(path)
+        if not path.startswith(self.root + os.sep):
+            return False
+
+        components = path[len(self.root) + 1:].split(os.sep)
+        last = len(components)
+        if self.keep and path.endswith(self.keep):
+            last -= 1
+        for i in range(1, last + 1):
+            if self._regex.match('/'.join(components[:i])):
+                return True
+        return False
+
+    __call__ = matches
@@ -0,0 +1,131 @@
+
+import os
+
+from jobs import run_jobs
+from runner import run
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: number of chunks of files we send to every compiler process
+CHUNKS_PER_JOB = 4
+
+#: the script run by the compiler processes: it compiles the files in its standard input,
+#: with the paths in the root directory replaced by the prefix, and writes the failures
+#: (as "! <failure>") and the number of files compiled and skipped (as "= <compiled> <skipped>")
+#: in its standard output. Bytecode is never written in place (it can be a hardlink to some
+#: cache), and the bytecode for the other optimization level is removed when it does not
+#: point to the prefix.
+COMPILE_SCRIPT = r'''
+import os, sys, imp, struct, marshal, py_compile
+root, prefix = sys.argv[1], sys.argv[2]
+ext, other_ext = __debug__ and ('c', 'o') or ('o', 'c')
+compiled, skipped = 0, 0
+def _is_current(cfile, mtime, dfile):
+    f = open(cfile, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    try:
+        return data[:4] == imp.get_magic() and struct.unpack('<I', data[4:8])[0] == mtime and \
+               marshal.loads(data[8:]).co_filename == dfile
+    except Exception:
+        return False
+for path in sys.stdin.read().splitlines():
+    cfile, dfile = path + ext, prefix + path[len(root):]
+    try:
+        mtime = int(os.stat(path).st_mtime) & 0xffffffff
+        if os.path.exists(path + other_ext) and not _is_current(path + other_ext, mtime, dfile):
+            os.remove(path + other_ext)
+        if os.path.exists(cfile):
+            if _is_current(cfile, mtime, dfile):
+                skipped += 1
+                continue
+            os.remove(cfile)
+        py_compile.compile(path, cfile, dfile, True)
+        compiled += 1
+    except Exception:
+        sys.stdout.write('! %s: %s\n' % (path, str(sys.exc_info()[1]).replace('\n', ' ')))
+sys.stdout.write('= %d %d\n' % (compiled, skipped))
+'''
+
+
+
+def find_sources(root, exclude = None):
+    """
+    Return the ".py" files in the tree at "root" (but those matching "exclude")
+    """
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if exclude:
+            dirnames[:] = [d for d in dirnames if not exclude(os.path.join(dirpath, d))]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith('.py') and os.path.isfile(path) and not (exclude and exclude(path)):
+                sources.append(path)
+    sources.sort()
+    return sources
+
+
+def _compile_chunk(python, optimize, root, prefix, sources, timeout = None):
+    command = [python] + ['-O'] * optimize + ['-c', COMPILE_SCRIPT, root, prefix]
+    counts, failures = [], []
+
+    def _parse(line):
+        if line.startswith('! '):
+            failures.append(line[2:])
+        elif line.startswith('= '):
+            counts[:] = [int(n) for n in line[2:].split()]
+
+    result = run(command, timeout, input = '\n'.join(sources) + '\n', on_line = _parse)
+    if not result.ok or not counts:
+        from zc.buildout import UserError
+        raise UserError('could not compile the Python files: %s' % result.error())
+
+    compiled, skipped = counts
+    return compiled, skipped, failures
+
+
+def precompile_tree(root, prefix, python, optimize = 0, jobs = 1, exclude = None, timeout = None):
+    """
+    Byte-compile the ".py" files in "root" (but those matching "exclude") with the
+    interpreter "python", using "jobs" processes. The paths in the bytecode point to
+    "prefix" instead of "root", and "optimize" is the optimization level (so we get
+    ".pyo" files when it is not 0). Files with bytecode that is up to date, and that
+    already points to "prefix", are not compiled again. Compiler processes running
+    for more than "timeout" seconds are killed.
+
+    Return the number of files compiled, skipped, and the failures.
+    """
+    sources = find_sources(root, exclude)
+    num_chunks = min(len(sources), jobs * CHUNKS_PER_JOB)
+    chunks = [sources[i::num_chunks] for i in range(num_chunks)]
+
+    results = run_jobs(lambda chunk: _compile_chunk(python, optimize, root, prefix.rstrip('/'), chunk, timeout),
+                       chunks, jobs)
+    compiled, skipped, failures = 0, 0, []
+    for chunk_compiled, chunk_skipped, chunk_failures in results:
+        compiled += chunk_compiled
+        skipped += chunk_skipped
+        failures += chunk_failures
+    return compiled, skipped, failures
+
+
+def drop_sources(root, matcher):
+    """
+    Remove the ".py" files in "root" matching "matcher" (once they have been compiled).
+    Return the number of files and bytes removed.
+    """
+    num_files, num_bytes = 0, 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith('.py') and matcher(path):
+                num_bytes += os.lstat(path).st_size
+                num_files += 1
+                logger.debug('... removing source "%s"' % path)
+                os.remove(path)
+    return num_files, num_bytes
@@ -0,0 +1,115 @@
+
+import os
+import stat
+import tempfile
+
+from jobs import run_jobs
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: suffixes of the files (anywhere in the tree) that can have paths to the virtualenv
+RELOCATABLE_SUFFIXES = ('.pth', '.egg-link')
+
+#: we do not rewrite files bigger than this (they are not scripts...)
+MAX_RELOCATABLE_SIZE = 4 * 1024 * 1024
+
+
+
+def _is_candidate(dirpath, filename):
+    """
+    Return True if a file can have paths to the build directory we must rewrite: the
+    scripts in "bin", the "activate" scripts and the ".pth" and ".egg-link" files
+    """
+    return os.path.basename(dirpath) == 'bin' or \
+           filename.startswith('activate') or \
+           filename.endswith(RELOCATABLE_SUFFIXES)
+
+
+def relocation_candidates(root):
+    """
+    Scan the tree at "root" (without following symlinks) and return the regular
+    files that can have paths to the build directory
+    """
+    candidates = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if not _is_candidate(dirpath, filename):
+                continue
+            path = os.path.join(dirpath, filename)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size <= MAX_RELOCATABLE_SIZE:
+                candidates.append(path)
+    return candidates
+
+
+def _replace_file(path, contents):
+    """
+    Replace a file by a new one with some contents (and the same mode). The file
+    is never modified in place, as it can be a hardlink to a file in some cache.
+    """
+    st = os.stat(path)
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), prefix = '.relocate-')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        os.utime(tmp_path, (st.st_atime, st.st_mtime))
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def relocate_file(path, old_paths, new_path):
+    """
+    Replace the "old_paths" by "new_path" in a (text) file. Return True if the
+    file has been rewritten.
+    """
+    f = open(path, 'rb')
+    try:
+        contents = f.read()
+    finally:
+        f.close()
+
+    ## binaries (ie, the python interpreter in "bin") are not touched
+    if '\0' in contents[:8192]:
+        return False
+
+    relocated = contents
+    for old_path in old_paths:
+        relocated = relocated.replace(old_path, new_path)
+    if relocated == contents:
+        return False
+
+    logger.debug('... relocating "%s"' % path)
+    _replace_file(path, relocated)
+    return True
+
+
+def relocate_tree(root, old_path, new_path, jobs = 1):
+    """
+    Rewrite the references to "old_path" (the directory where the virtualenv has been
+    built) as "new_path" (where it will be installed) in the shebangs, "activate"
+    scripts, ".pth" and ".egg-link" files found in "root", using "jobs" threads.
+    Files without references to "old_path" are left untouched.
+
+    Return the number of files rewritten.
+    """
+    old_paths = [old_path.rstrip('/')]
+    real_old_path = os.path.realpath(old_path)
+    if real_old_path != old_paths[0]:
+        old_paths.append(real_old_path)
+    ## the longest first, so we never replace only a part of a path
+    old_paths.sort(key = len, reverse = True)
+
+    candidates = relocation_candidates(root)
+    results = run_jobs(lambda path: relocate_file(path, old_paths, new_path.rstrip('/') or '/'),
+                       candidates, jobs)
+    return len([r for r in results if r])
@@ -0,0 +1,163 @@
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: extension for the build reports
+REPORT_EXT = '.report.json'
+
+#: extension for the profiler stats
+PROFILE_EXT = '.prof'
+
+
+
+def tree_usage(path):
+    """
+    Return the number of files and the bytes in a directory tree (without following symlinks)
+    """
+    num_files, num_bytes = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                num_bytes += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                continue
+            num_files += 1
+    return num_files, num_bytes
+
+
+class BuildReport(object):
+    """
+    Timings (and sizes) of the phases of a build, and of each egg installed.
+
+    When "measure" is a directory, we count the files and bytes in it after each
+    phase, so we can see how much every phase adds to the package.
+    """
+
+    def __init__(self, measure = None):
+        self.measure = measure
+        self.phases = []
+        self.eggs = []
+        self.artifacts = []
+        self.counters = {}
+        self.timings = {}
+        self.details = {}
+        self.result = None
+        self.started = time.time()
+        self._lock = threading.Lock()
+        if measure and os.path.isdir(measure):
+            self._last_usage = tree_usage(measure)
+        else:
+            self._last_usage = (0, 0)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the build (as a context manager)
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start)
+
+    def add_phase(self, name, seconds, num_files = None, num_bytes = None):
+        """
+        Add a phase that has taken "seconds", and has produced some files
+        (or the files found in the measured directory after it)
+        """
+        entry = {'name': name, 'seconds': round(seconds, 3)}
+        if num_files is None and self.measure and os.path.isdir(self.measure):
+            num_files, num_bytes = tree_usage(self.measure)
+            with self._lock:
+                entry['files_added'] = num_files - self._last_usage[0]
+                entry['bytes_added'] = num_bytes - self._last_usage[1]
+                self._last_usage = (num_files, num_bytes)
+        if num_files is not None:
+            entry['files'] = num_files
+            entry['bytes'] = num_bytes
+
+        logger.debug('... phase "%s": %.2f secs' % (name, seconds))
+        with self._lock:
+            self.phases.append(entry)
+
+    def add_egg(self, dist, seconds, method):
+        """
+        Add the time spent installing an egg (with some "method", ie, "cache" or "easy_install")
+        """
+        with self._lock:
+            self.eggs.append({
+                'name': dist.key,
+                'version': dist.version,
+                'method': method,
+                'seconds': round(seconds, 3),
+            })
+
+    def count(self, name, value):
+        """
+        Add "value" to a counter (ie, the number of files relocated)
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_timing(self, name, seconds):
+        """
+        Add some measure of time that is not a phase (ie, the time for importing the eggs)
+        """
+        with self._lock:
+            self.timings[name] = round(seconds, 3)
+
+    def add_detail(self, section, item):
+        """
+        Add some item to a section of details (ie, the savings of every file stripped)
+        """
+        with self._lock:
+            self.details.setdefault(section, []).append(item)
+
+    def add_artifacts(self, artifacts):
+        for artifact in artifacts:
+            try:
+                size = os.path.getsize(artifact)
+            except OSError:
+                size = None
+            self.artifacts.append({'path': artifact, 'bytes': size})
+
+    def summary(self):
+        """
+        Return a one-line summary of the phases
+        """
+        return ', '.join(['%s %.2fs' % (p['name'], p['seconds']) for p in self.phases])
+
+    def as_dict(self):
+        return {
+            'started': self.started,
+            'seconds': round(time.time() - self.started, 3),
+            'result': self.result,
+            'phases': self.phases,
+            'eggs': sorted(self.eggs, key = lambda e: -e['seconds']),
+            'artifacts': self.artifacts,
+            'counters': self.counters,
+            'timings': self.timings,
+            'details': self.details,
+        }
+
+    def save(self, filename, **extra):
+        """
+        Save the report (with some "extra" information) as JSON
+        """
+        report = self.as_dict()
+        report.update(extra)
+        f = open(filename, 'w')
+        try:
+            json.dump(report, f, indent = 2, sort_keys = True)
+            f.write('\n')
+        finally:
+            f.close()
+        return filename
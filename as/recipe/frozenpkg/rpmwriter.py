@@ -0,0 +1,429 @@
+
+import os
+import stat
+import time
+import struct
+import socket
+import hashlib
+import tempfile
+
+from archive import compressed_writer, check_compression, collect_tree, log_throughput, HashingFile, DEFAULT_LEVELS, utf8
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+RPM_LEAD_MAGIC = '\xed\xab\xee\xdb'
+RPM_HEADER_MAGIC = '\x8e\xad\xe8\x01'
+
+## types of the header entries
+RPM_INT16 = 3
+RPM_INT32 = 4
+RPM_STRING = 6
+RPM_BIN = 7
+RPM_STRING_ARRAY = 8
+RPM_I18NSTRING = 9
+
+#: alignment of the data of the header entries
+RPM_ALIGNMENT = {
+    RPM_INT16: 2,
+    RPM_INT32: 4,
+}
+
+## the regions of the signature and the main header
+RPMTAG_HEADERSIGNATURES = 62
+RPMTAG_HEADERIMMUTABLE = 63
+RPMTAG_HEADERI18NTABLE = 100
+
+## the signature tags
+RPMSIGTAG_SHA1 = 269
+RPMSIGTAG_SHA256 = 273
+RPMSIGTAG_SIZE = 1000
+RPMSIGTAG_MD5 = 1004
+RPMSIGTAG_PAYLOADSIZE = 1007
+
+## the main header tags
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_SUMMARY = 1004
+RPMTAG_DESCRIPTION = 1005
+RPMTAG_BUILDTIME = 1006
+RPMTAG_BUILDHOST = 1007
+RPMTAG_SIZE = 1009
+RPMTAG_VENDOR = 1011
+RPMTAG_LICENSE = 1014
+RPMTAG_PACKAGER = 1015
+RPMTAG_GROUP = 1016
+RPMTAG_URL = 1020
+RPMTAG_OS = 1021
+RPMTAG_ARCH = 1022
+RPMTAG_PREIN = 1023
+RPMTAG_POSTIN = 1024
+RPMTAG_FILESIZES = 1028
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILERDEVS = 1033
+RPMTAG_FILEMTIMES = 1034
+RPMTAG_FILEDIGESTS = 1035
+RPMTAG_FILELINKTOS = 1036
+RPMTAG_FILEFLAGS = 1037
+RPMTAG_FILEUSERNAME = 1039
+RPMTAG_FILEGROUPNAME = 1040
+RPMTAG_SOURCERPM = 1044
+RPMTAG_FILEVERIFYFLAGS = 1045
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_REQUIREFLAGS = 1048
+RPMTAG_REQUIRENAME = 1049
+RPMTAG_REQUIREVERSION = 1050
+RPMTAG_RPMVERSION = 1064
+RPMTAG_PREINPROG = 1085
+RPMTAG_POSTINPROG = 1086
+RPMTAG_FILEDEVICES = 1095
+RPMTAG_FILEINODES = 1096
+RPMTAG_FILELANGS = 1097
+RPMTAG_PROVIDEFLAGS = 1112
+RPMTAG_PROVIDEVERSION = 1113
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_PAYLOADFLAGS = 1126
+RPMTAG_FILEDIGESTALGO = 5011
+
+## dependencies flags
+RPMSENSE_LESS = 1 << 1
+RPMSENSE_GREATER = 1 << 2
+RPMSENSE_EQUAL = 1 << 3
+RPMSENSE_INTERP = 1 << 8
+RPMSENSE_SCRIPT_PRE = 1 << 9
+RPMSENSE_SCRIPT_POST = 1 << 10
+RPMSENSE_RPMLIB = 1 << 24
+
+RPMFILE_CONFIG = 1 << 0
+PGPHASHALGO_SHA256 = 8
+
+#: the flags for the operators in the dependencies
+DEPENDENCY_FLAGS = {
+    '':   0,
+    '<':  RPMSENSE_LESS,
+    '<=': RPMSENSE_LESS | RPMSENSE_EQUAL,
+    '=':  RPMSENSE_EQUAL,
+    '>=': RPMSENSE_GREATER | RPMSENSE_EQUAL,
+    '>':  RPMSENSE_GREATER,
+}
+
+#: the payload compressors, and the rpmlib() features they need
+RPM_COMPRESSIONS = {
+    'gzip': None,
+    'xz':   ('rpmlib(PayloadIsXz)', '5.2-1'),
+    'zstd': ('rpmlib(PayloadIsZstd)', '5.4.18-1'),
+}
+
+#: the rpmlib() features all our packages need
+RPMLIB_FEATURES = [
+    ('rpmlib(CompressedFileNames)', '3.0.4-1'),
+    ('rpmlib(FileDigests)', '4.6.0-1'),
+    ('rpmlib(PayloadFilesHavePrefix)', '4.0-1'),
+]
+
+#: the version of rpm we say built the packages: the first one with the file digests we write
+RPM_VERSION = '4.6.0'
+
+READ_SIZE = 1024 * 1024
+
+
+
+class RpmHeader(object):
+    """
+    A RPM header (or signature) structure, with an immutable region
+    """
+
+    def __init__(self, region_tag):
+        self.region_tag = region_tag
+        self.entries = {}
+
+    def add(self, tag, type, value):
+        if type in (RPM_STRING, RPM_I18NSTRING):
+            value = utf8(value)
+        elif type == RPM_STRING_ARRAY:
+            value = [utf8(v) for v in value]
+        self.entries[tag] = (type, value)
+
+    def serialize(self):
+        index = []
+        data = []
+        data_len = 0
+        for tag in sorted(self.entries.keys()):
+            type, value = self.entries[tag]
+            if type == RPM_INT16:
+                packed, count = struct.pack('>%dH' % len(value), *value), len(value)
+            elif type == RPM_INT32:
+                packed, count = struct.pack('>%dI' % len(value), *[v & 0xffffffff for v in value]), len(value)
+            elif type in (RPM_STRING, RPM_I18NSTRING):
+                packed, count = value + '\0', 1
+            elif type == RPM_STRING_ARRAY:
+                packed, count = ''.join([v + '\0' for v in value]), len(value)
+            else:
+                packed, count = value, len(value)
+
+            padding = (-data_len) % RPM_ALIGNMENT.get(type, 1)
+            data.append('\0' * padding)
+            data_len += padding
+
+            index.append(struct.pack('>IIiI', tag, type, data_len, count))
+            data.append(packed)
+            data_len += len(packed)
+
+        ## the region covers the whole header: its trailer is a copy of the region
+        ## entry with a (negative) offset to the beginning of the index
+        num_entries = len(index) + 1
+        region = struct.pack('>IIiI', self.region_tag, RPM_BIN, data_len, 16)
+        trailer = struct.pack('>IIiI', self.region_tag, RPM_BIN, -num_entries * 16, 16)
+        data.append(trailer)
+        data_len += len(trailer)
+
+        return RPM_HEADER_MAGIC + '\0' * 4 + struct.pack('>II', num_entries, data_len) + \
+               region + ''.join(index) + ''.join(data)
+
+
+def _lead(name, arch):
+    archnum = 1 if arch in ('i386', 'i486', 'i586', 'i686', 'x86_64', 'athlon') else 0
+    return RPM_LEAD_MAGIC + struct.pack('>BBhh66shh16s', 3, 0, 0, archnum, utf8(name)[:65], 1, 5, '')
+
+
+def _cpio_header(name, ino, mode, nlink, mtime, size):
+    name = utf8(name)
+    fields = (ino, mode, 0, 0, nlink, mtime, size, 0, 0, 0, 0, len(name) + 1, 0)
+    header = '070701' + ''.join(['%08X' % (f & 0xffffffff) for f in fields]) + name + '\0'
+    return header + '\0' * ((-len(header)) % 4)
+
+
+def write_rpm(dest_dir, buildroot, prefix, metadata, compression = 'gzip', level = None, threads = 1,
+              exclude = None, config = None, digest = None):
+    """
+    Write a binary RPM at "dest_dir" with the contents of "prefix" in the buildroot (but
+    the paths matching "exclude"), without using "rpmbuild", returning the file written.
+
+    "metadata" has the same information as the spec file: name, version, release, summary,
+    description, url, license, vendor, packager, group, deps, pre/post (the install scripts),
+    def_user/def_group (the owner of the files) and def_mode (the mode of the directories).
+    The files matching "config" are marked as configuration files. When "digest" is not
+    None, it is a hashlib object that is updated with the contents of the file written.
+    """
+    check_compression(compression, RPM_COMPRESSIONS.keys())
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+
+    arch = os.uname()[4]
+    nvr = '%s-%s-%s' % (metadata['name'], metadata['version'], metadata['release'])
+    filename = os.path.join(dest_dir, '%s.%s.rpm' % (nvr, arch))
+    start = time.time()
+
+    entries = collect_tree(buildroot, os.path.normpath(buildroot + '/' + prefix), exclude)
+
+    ## the payload goes to a temporary file, as the header (that we write before
+    ## the payload) needs the digests we compute while writing the payload
+    payload = tempfile.TemporaryFile(dir = dest_dir)
+    try:
+        files = _write_payload(payload, buildroot, entries, metadata, compression, level, threads, config)
+        payload_size = files.pop('payload_size')
+        header = _header(metadata, arch, nvr, compression, level, files).serialize()
+
+        ## the signature (that goes before the header) needs the MD5 of the header and
+        ## the payload, so we get it before writing the file, and the file is written
+        ## sequentially (so we can get its digest while we write it)
+        size = len(header) + payload.tell()
+        md5 = hashlib.md5(header)
+        payload.seek(0)
+        for data in iter(lambda: payload.read(READ_SIZE), ''):
+            md5.update(data)
+
+        tmp_filename = filename + '.tmp'
+        out = open(tmp_filename, 'wb')
+        try:
+            dest = HashingFile(out, digest) if digest else out
+            dest.write(_lead(nvr, arch))
+            dest.write(_signature(header, size, md5.digest(), payload_size))
+            dest.write(header)
+            payload.seek(0)
+            for data in iter(lambda: payload.read(READ_SIZE), ''):
+                dest.write(data)
+        finally:
+            out.close()
+        os.rename(tmp_filename, filename)
+    finally:
+        payload.close()
+
+    log_throughput('rpm', len(entries), payload_size, filename, compression, time.time() - start, threads)
+    return filename
+
+
+def _signature(header, size, md5, payload_size):
+    sig = RpmHeader(RPMTAG_HEADERSIGNATURES)
+    sig.add(RPMSIGTAG_SHA1, RPM_STRING, hashlib.sha1(header).hexdigest())
+    sig.add(RPMSIGTAG_SHA256, RPM_STRING, hashlib.sha256(header).hexdigest())
+    sig.add(RPMSIGTAG_SIZE, RPM_INT32, [size])
+    sig.add(RPMSIGTAG_MD5, RPM_BIN, md5)
+    sig.add(RPMSIGTAG_PAYLOADSIZE, RPM_INT32, [payload_size])
+    data = sig.serialize()
+    return data + '\0' * ((-len(data)) % 8)
+
+
+def _write_payload(payload, buildroot, entries, metadata, compression, level, threads, config):
+    """
+    Write the cpio archive for the entries, returning the files information for the header
+    """
+    files = dict([(tag, []) for tag in (RPMTAG_FILESIZES, RPMTAG_FILEMODES, RPMTAG_FILEMTIMES,
+                                        RPMTAG_FILEDIGESTS, RPMTAG_FILELINKTOS, RPMTAG_FILEFLAGS,
+                                        'paths')])
+    files[RPMTAG_FILEINODES] = []
+
+    ## hardlinks share their inode number, and the data goes with the last one of them
+    links = {}
+    for i, (path, real, st) in enumerate(entries):
+        if stat.S_ISREG(st.st_mode):
+            links.setdefault((st.st_dev, st.st_ino), []).append(i)
+
+    stream = compressed_writer(payload, compression, level, threads)
+    for i, (path, real, st) in enumerate(entries):
+        name = '/' + os.path.relpath(path, buildroot)
+        mode = st.st_mode
+        if stat.S_ISDIR(mode):
+            mode = stat.S_IFDIR | metadata['def_mode']
+
+        ino, nlink, has_data = i + 1, 1, True
+        digest, link, data_size = '', '', 0
+        if stat.S_ISREG(mode):
+            data_size = st.st_size
+            hardlinks = links[(st.st_dev, st.st_ino)]
+            ino, nlink, has_data = hardlinks[0] + 1, len(hardlinks), (i == hardlinks[-1])
+        elif stat.S_ISLNK(mode):
+            link = os.readlink(real)
+            data_size = len(link)
+        if data_size > 0xffffffff:
+            raise Exception('"%s" is too big for a RPM payload' % name)
+
+        stream.write(_cpio_header('.' + name, ino, mode, nlink, int(st.st_mtime),
+                                  data_size if has_data else 0))
+        if stat.S_ISREG(mode) and not has_data:
+            ## the digest is the one of the last hardlink: we set it below
+            data_size = 0
+        elif stat.S_ISREG(mode):
+            h = hashlib.sha256()
+            f = open(real, 'rb')
+            try:
+                written = 0
+                while written < data_size:
+                    data = f.read(min(READ_SIZE, data_size - written))
+                    if not data:
+                        raise Exception('"%s" has changed while packaging it' % real)
+                    h.update(data)
+                    stream.write(data)
+                    written += len(data)
+            finally:
+                f.close()
+            digest = h.hexdigest()
+        elif link:
+            stream.write(link)
+        stream.write('\0' * ((-data_size) % 4))
+
+        files['paths'].append(name)
+        files[RPMTAG_FILEINODES].append(ino)
+        files[RPMTAG_FILESIZES].append(st.st_size if stat.S_ISREG(mode) or stat.S_ISDIR(mode) else data_size)
+        files[RPMTAG_FILEMODES].append(mode & 0xffff)
+        files[RPMTAG_FILEMTIMES].append(int(st.st_mtime))
+        files[RPMTAG_FILEDIGESTS].append(digest)
+        files[RPMTAG_FILELINKTOS].append(link)
+        files[RPMTAG_FILEFLAGS].append(RPMFILE_CONFIG if config and config(path) else 0)
+
+    for hardlinks in links.values():
+        for i in hardlinks[:-1]:
+            files[RPMTAG_FILEDIGESTS][i] = files[RPMTAG_FILEDIGESTS][hardlinks[-1]]
+
+    stream.write(_cpio_header('TRAILER!!!', 0, 0, 1, 0, 0))
+    stream.close()
+    files['payload_size'] = stream.written
+    return files
+
+
+def _header(metadata, arch, nvr, compression, level, files):
+    h = RpmHeader(RPMTAG_HEADERIMMUTABLE)
+    h.add(RPMTAG_HEADERI18NTABLE, RPM_STRING_ARRAY, ['C'])
+    h.add(RPMTAG_NAME, RPM_STRING, metadata['name'])
+    h.add(RPMTAG_VERSION, RPM_STRING, metadata['version'])
+    h.add(RPMTAG_RELEASE, RPM_STRING, metadata['release'])
+    h.add(RPMTAG_SUMMARY, RPM_I18NSTRING, metadata['summary'])
+    h.add(RPMTAG_DESCRIPTION, RPM_I18NSTRING, metadata['description'])
+    h.add(RPMTAG_BUILDTIME, RPM_INT32, [int(time.time())])
+    h.add(RPMTAG_BUILDHOST, RPM_STRING, socket.gethostname())
+    h.add(RPMTAG_VENDOR, RPM_STRING, metadata['vendor'])
+    h.add(RPMTAG_LICENSE, RPM_STRING, metadata['license'])
+    h.add(RPMTAG_PACKAGER, RPM_STRING, metadata['packager'])
+    h.add(RPMTAG_GROUP, RPM_I18NSTRING, metadata['group'])
+    h.add(RPMTAG_URL, RPM_STRING, metadata['url'])
+    h.add(RPMTAG_OS, RPM_STRING, 'linux')
+    h.add(RPMTAG_ARCH, RPM_STRING, arch)
+    h.add(RPMTAG_SOURCERPM, RPM_STRING, '%s.src.rpm' % nvr)
+    h.add(RPMTAG_RPMVERSION, RPM_STRING, RPM_VERSION)
+    h.add(RPMTAG_PAYLOADFORMAT, RPM_STRING, 'cpio')
+    h.add(RPMTAG_PAYLOADCOMPRESSOR, RPM_STRING, compression)
+    h.add(RPMTAG_PAYLOADFLAGS, RPM_STRING, str(level))
+
+    requires = [(name, RPMSENSE_RPMLIB | RPMSENSE_LESS | RPMSENSE_EQUAL, version)
+                for name, version in RPMLIB_FEATURES]
+    if RPM_COMPRESSIONS[compression]:
+        name, version = RPM_COMPRESSIONS[compression]
+        requires.append((name, RPMSENSE_RPMLIB | RPMSENSE_LESS | RPMSENSE_EQUAL, version))
+    for tag, prog_tag, script, flags in [(RPMTAG_PREIN, RPMTAG_PREINPROG, metadata['pre'], RPMSENSE_SCRIPT_PRE),
+                                         (RPMTAG_POSTIN, RPMTAG_POSTINPROG, metadata['post'], RPMSENSE_SCRIPT_POST)]:
+        if script:
+            h.add(tag, RPM_STRING, script)
+            h.add(prog_tag, RPM_STRING, '/bin/sh')
+            requires.append(('/bin/sh', RPMSENSE_INTERP | flags, ''))
+    requires += [(name, DEPENDENCY_FLAGS[op], version) for name, op, version in metadata['deps']]
+    h.add(RPMTAG_REQUIRENAME, RPM_STRING_ARRAY, [r[0] for r in requires])
+    h.add(RPMTAG_REQUIREFLAGS, RPM_INT32, [r[1] for r in requires])
+    h.add(RPMTAG_REQUIREVERSION, RPM_STRING_ARRAY, [r[2] for r in requires])
+
+    h.add(RPMTAG_PROVIDENAME, RPM_STRING_ARRAY, [metadata['name']])
+    h.add(RPMTAG_PROVIDEFLAGS, RPM_INT32, [RPMSENSE_EQUAL])
+    h.add(RPMTAG_PROVIDEVERSION, RPM_STRING_ARRAY, ['%s-%s' % (metadata['version'], metadata['release'])])
+
+    ## the files, with their names split in directories and basenames
+    paths = files.pop('paths')
+    num_files = len(paths)
+    dirnames, dirindexes, basenames = [], [], []
+    dirs_index = {}
+    for path in paths:
+        dirname, basename = os.path.split(path)
+        dirname = dirname.rstrip('/') + '/'
+        if not dirname in dirs_index:
+            dirs_index[dirname] = len(dirnames)
+            dirnames.append(dirname)
+        dirindexes.append(dirs_index[dirname])
+        basenames.append(basename)
+
+    ## the hardlinks are only installed once
+    sizes = {}
+    for size, mode, ino in zip(files[RPMTAG_FILESIZES], files[RPMTAG_FILEMODES], files[RPMTAG_FILEINODES]):
+        if not stat.S_ISDIR(mode):
+            sizes[ino] = size
+    h.add(RPMTAG_SIZE, RPM_INT32, [sum(sizes.values())])
+    for tag, value in files.items():
+        h.add(tag, RPM_INT16 if tag == RPMTAG_FILEMODES else
+                   RPM_INT32 if tag in (RPMTAG_FILESIZES, RPMTAG_FILEMTIMES, RPMTAG_FILEFLAGS,
+                                        RPMTAG_FILEINODES) else
+                   RPM_STRING_ARRAY, value)
+    h.add(RPMTAG_FILERDEVS, RPM_INT16, [0] * num_files)
+    h.add(RPMTAG_FILEVERIFYFLAGS, RPM_INT32, [0xffffffff] * num_files)
+    h.add(RPMTAG_FILEDEVICES, RPM_INT32, [1] * num_files)
+    h.add(RPMTAG_FILELANGS, RPM_STRING_ARRAY, [''] * num_files)
+    h.add(RPMTAG_FILEUSERNAME, RPM_STRING_ARRAY, [metadata['def_user']] * num_files)
+    h.add(RPMTAG_FILEGROUPNAME, RPM_STRING_ARRAY, [metadata['def_group']] * num_files)
+    h.add(RPMTAG_FILEDIGESTALGO, RPM_INT32, [PGPHASHALGO_SHA256])
+    h.add(RPMTAG_DIRINDEXES, RPM_INT32, dirindexes)
+    h.add(RPMTAG_BASENAMES, RPM_STRING_ARRAY, basenames)
+    h.add(RPMTAG_DIRNAMES, RPM_STRING_ARRAY, dirnames)
+    return h
@@ -0,0 +1,157 @@
+
+import os
+import time
+import signal
+import threading
+import subprocess
+import collections
+from distutils.spawn import find_executable
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: lines of output we keep for reporting errors
+TAIL_LINES = 100
+
+#: seconds we wait for the output once a command has been killed
+KILL_GRACE = 5
+
+## commands run in their own process group (so we can kill their children too),
+## but we cannot use "preexec_fn = os.setsid" for that: in Python 2, running code
+## between fork() and exec() while other threads hold locks (ie, the logging ones)
+## can deadlock the child. So we exec the "setsid" program instead, and when it
+## is not available we only kill the command on timeouts.
+SETSID = find_executable('setsid')
+
+
+
+def timeout_from_cfg(opt):
+    """
+    Parse a timeout (in seconds) from an option: None (no timeout) when it is empty or 0
+    """
+    opt = (opt or '').strip()
+    if not opt:
+        return None
+    try:
+        timeout = float(opt)
+    except ValueError:
+        from zc.buildout import UserError
+        raise UserError('invalid timeout "%s"' % opt)
+    return timeout if timeout > 0 else None
+
+
+class CommandResult(object):
+    """
+    The result of a command: its exit code and the last lines of its output
+    """
+
+    def __init__(self, command, returncode, tail, seconds, timed_out):
+        self.command = command
+        self.returncode = returncode
+        self.tail = tail
+        self.seconds = seconds
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    @property
+    def output(self):
+        return '\n'.join(self.tail)
+
+    def error(self):
+        """
+        A description of the failure, with the last lines of the output
+        """
+        if self.timed_out:
+            reason = 'timed out after %d secs' % self.seconds
+        else:
+            reason = 'failed with exit code %s' % self.returncode
+        return '"%s" %s: %s' % (' '.join(self.command), reason, self.output.strip())
+
+
+def _kill(job):
+    try:
+        if SETSID:
+            os.killpg(job.pid, signal.SIGKILL)
+        else:
+            os.kill(job.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def run(command, timeout = None, input = None, log = None, level = logging.DEBUG, prefix = '... ',
+        on_line = None, tail_lines = TAIL_LINES, **kwargs):
+    """
+    Run a command, streaming its output (stdout and stderr) line by line to the
+    "log" logger (at "level", with some "prefix") and to "on_line", and keeping
+    only the last "tail_lines" lines in memory. "input" is written to its standard
+    input. The command is killed (with all its children, when "setsid" is available)
+    when it runs for more than "timeout" seconds.
+
+    It can be called from several threads, for running commands at the same time.
+    Return a CommandResult.
+    """
+    start = time.time()
+    ## a child of ours is not a process group leader, so "setsid" does not
+    ## fork and the pid of the command is the id of its process group
+    job = subprocess.Popen(([SETSID] if SETSID else []) + list(command),
+                           stdin = subprocess.PIPE if input is not None else None,
+                           stdout = subprocess.PIPE,
+                           stderr = subprocess.STDOUT,
+                           close_fds = True,
+                           **kwargs)
+
+    tail = collections.deque(maxlen = tail_lines)
+
+    def _read():
+        for line in iter(job.stdout.readline, ''):
+            line = line.rstrip('\n')
+            tail.append(line)
+            if log:
+                log.log(level, prefix + line)
+            if on_line:
+                on_line(line)
+        job.stdout.close()
+
+    def _write():
+        ## in its own thread, so a command that does not read its input is
+        ## killed on timeouts too
+        try:
+            job.stdin.write(input)
+            job.stdin.close()
+        except IOError:
+            ## the command has finished without reading everything
+            pass
+
+    reader = threading.Thread(target = _read)
+    reader.daemon = True
+    reader.start()
+
+    if input is not None:
+        writer = threading.Thread(target = _write)
+        writer.daemon = True
+        writer.start()
+
+    timed_out = False
+    try:
+        if timeout is None:
+            while reader.is_alive():
+                reader.join(1)
+        else:
+            reader.join(max(0, timeout - (time.time() - start)))
+            if reader.is_alive():
+                timed_out = True
+                logger.warning('"%s" has been running for %d secs: killing it' % (' '.join(command), timeout))
+                _kill(job)
+                reader.join(KILL_GRACE)
+        job.wait()
+    except:
+        _kill(job)
+        job.wait()
+        raise
+
+    return CommandResult(command, job.returncode, list(tail), time.time() - start, timed_out)
@@ -0,0 +1,223 @@
+
+import os
+import re
+import shutil
+import zipfile
+import threading
+import pkg_resources
+
+from matcher import _translate
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: files that are never removed (without them, the egg would not be found)
+PROTECTED_FILES = ['EGG-INFO/PKG-INFO']
+
+#: prefix for the rules that are regular expressions (instead of globs)
+REGEX_PREFIX = 're:'
+
+
+
+def _rule_regex(pattern):
+    """
+    Translate a pattern of a rule to a compiled regular expression. Globs without a "/"
+    match a file or directory with that name anywhere in the egg (ie, "tests" or "*.c"),
+    and globs with a "/" are relative to the root of the egg (ie, "EGG-INFO/SOURCES.txt").
+    """
+    if pattern.startswith(REGEX_PREFIX):
+        ## compiled on its own, so its groups (and backreferences) are not mixed with others
+        regex = '(?:%s)\Z' % pattern[len(REGEX_PREFIX):]
+    else:
+        pattern = pattern.strip('/')
+        if '/' in pattern:
+            regex = _translate(pattern) + '\Z'
+        else:
+            regex = '(?:.*/)?' + _translate(pattern) + '\Z'
+    try:
+        return re.compile(regex)
+    except re.error, e:
+        from zc.buildout import UserError
+        raise UserError('invalid regular expression "%s" in the slim policy: %s' % (pattern, str(e)))
+
+
+class SlimPolicy(object):
+    """
+    A set of named rules for removing files from the eggs, as lines like:
+
+        tests:     tests  test
+        sources:   *.c  *.pyx
+        egg-info:  EGG-INFO/SOURCES.txt  re:EGG-INFO/(dependency_links|not-zip-safe)[.]txt
+
+    A file is removed when it (or any of its parent directories, relative to the egg)
+    matches any rule, and it is accounted to the first rule it matches.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._regexes = [(name, [_rule_regex(p) for p in patterns]) for name, patterns in rules]
+
+    @classmethod
+    def from_cfg(cls, opt):
+        rules = []
+        for line in [l.strip() for l in (opt or '').splitlines() if l.strip()]:
+            name, sep, patterns = line.partition(':')
+            if not sep or not name.strip() or not patterns.split():
+                from zc.buildout import UserError
+                raise UserError('invalid slim policy rule "%s" (it must be "name: pattern ...")' % line)
+            rules.append((name.strip(), patterns.split()))
+        return cls(rules)
+
+    def __nonzero__(self):
+        return bool(self._regexes)
+
+    def rule(self, rel_path):
+        """
+        Return the name of the rule matching a path (relative to the egg, with "/"),
+        or None if it must be kept
+        """
+        if not self._regexes or rel_path in PROTECTED_FILES:
+            return None
+        components = rel_path.split('/')
+        for i in range(1, len(components) + 1):
+            path = '/'.join(components[:i])
+            for name, regexes in self._regexes:
+                if [r for r in regexes if r.match(path)]:
+                    return name
+        return None
+
+
+def _tree_stats(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        return 1, os.lstat(path).st_size
+    num_files, num_bytes = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            num_files += 1
+            num_bytes += os.lstat(os.path.join(dirpath, filename)).st_size
+    return num_files, num_bytes
+
+
+class SlimExclude(object):
+    """
+    An "exclude" for staging the eggs in "site_packages" without the files matching
+    the "policy" (nor the ones matching "cleanups"), so they are never copied.
+
+    The copier tells us about the things it has skipped (with "skipped"), so the files
+    and bytes not copied are kept in "results" as slim_eggs() returns them. It can be
+    used from several threads.
+    """
+
+    def __init__(self, policy, site_packages, cleanups = None):
+        self.policy = policy
+        self.site_packages = os.path.normpath(site_packages)
+        self.cleanups = cleanups
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def _rule(self, path):
+        path = os.path.normpath(path)
+        if not path.startswith(self.site_packages + os.sep):
+            return None, None
+        components = path[len(self.site_packages) + 1:].split(os.sep)
+        if len(components) < 2 or not components[0].endswith('.egg'):
+            return None, None
+        return components[0], self.policy.rule('/'.join(components[1:]))
+
+    def __call__(self, path):
+        if self.cleanups and self.cleanups(path):
+            return True
+        return self._rule(path)[1] is not None
+
+    def skipped(self, src, dst):
+        """
+        Account for "src" (a file or a directory), not copied to "dst"
+        """
+        if self.cleanups and self.cleanups(dst):
+            return
+        egg_name, rule = self._rule(dst)
+        if rule:
+            num_files, num_bytes = _tree_stats(src)
+            with self._lock:
+                stats = self.results.setdefault(egg_name, {}).setdefault(rule, [0, 0])
+                stats[0] += num_files
+                stats[1] += num_bytes
+
+
+def _slim_dir(egg_path, policy, removed):
+    for dirpath, dirnames, filenames in os.walk(egg_path):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            rel_path = os.path.relpath(path, egg_path).replace(os.sep, '/')
+            rule = policy.rule(rel_path)
+            if rule:
+                stats = removed.setdefault(rule, [0, 0])
+                stats[0] += 1
+                stats[1] += os.lstat(path).st_size
+                ## files are removed, not modified, so hardlinks to some cache are safe
+                os.remove(path)
+
+    ## remove the directories left empty
+    for dirpath, dirnames, filenames in os.walk(egg_path, topdown = False):
+        if dirpath != egg_path and not os.listdir(dirpath) and \
+           policy.rule(os.path.relpath(dirpath, egg_path).replace(os.sep, '/')):
+            os.rmdir(dirpath)
+
+
+def _slim_zip(egg_path, policy, removed):
+    archive = zipfile.ZipFile(egg_path)
+    try:
+        infos = archive.infolist()
+        dropped = [i for i in infos if policy.rule(i.filename.rstrip('/'))]
+        if not dropped:
+            return
+        dropped_names = set([i.filename for i in dropped])
+
+        ## the zip is replaced by a new one (it can be a hardlink to some cache)
+        tmp_filename = egg_path + '.tmp'
+        slimmed = zipfile.ZipFile(tmp_filename, 'w')
+        try:
+            for info in infos:
+                if info.filename in dropped_names:
+                    continue
+                slimmed.writestr(info, archive.read(info.filename))
+        finally:
+            slimmed.close()
+    finally:
+        archive.close()
+
+    for info in dropped:
+        if not info.filename.endswith('/'):
+            stats = removed.setdefault(policy.rule(info.filename), [0, 0])
+            stats[0] += 1
+            stats[1] += info.file_size
+    shutil.copystat(egg_path, tmp_filename)
+    os.rename(tmp_filename, egg_path)
+
+
+def slim_eggs(site_packages, keys, policy):
+    """
+    Remove the files matching the "policy" from the eggs installed in "site_packages"
+    for the distributions with "keys" (unpacked or zipped).
+
+    Return a dictionary with the files and bytes removed by every rule, for every egg.
+    """
+    results = {}
+    for dist in pkg_resources.find_distributions(site_packages):
+        if not dist.key in keys or dist.location == site_packages or not dist.location.endswith('.egg'):
+            continue
+
+        removed = {}
+        if os.path.isdir(dist.location):
+            _slim_dir(dist.location, policy, removed)
+        else:
+            _slim_zip(dist.location, policy, removed)
+
+        egg_name = os.path.basename(dist.location)
+        for rule, (num_files, num_bytes) in sorted(removed.items()):
+            logger.debug('... %s: rule "%s" removed %d files (%d bytes)' % (egg_name, rule, num_files, num_bytes))
+        if removed:
+            results[egg_name] = removed
+    return results
@@ -0,0 +1,281 @@
+
+import os
+import json
+import stat
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: extension for the files with the fingerprint of an artifact
+FINGERPRINT_EXT = '.fingerprint'
+
+#: the description of a store entry
+ENTRY_FILE = 'entry.json'
+
+#: the index of a content store
+INDEX_FILE = 'index.json'
+
+#: default size limit for the artifacts store (in MB)
+DEFAULT_STORE_SIZE = 4096
+
+#: size of the reads when hashing files
+READ_SIZE = 1024 * 1024
+
+## the index of a content store can be updated by the packagers of several formats at the same time
+_index_lock = threading.Lock()
+
+
+
+def fingerprint(inputs):
+    """
+    Return the fingerprint for the inputs of a build
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys = True)).hexdigest()
+
+
+def write_fingerprint(artifact, fp):
+    """
+    Write the fingerprint of an artifact next to it, returning the file written
+    """
+    filename = artifact + FINGERPRINT_EXT
+    f = open(filename, 'w')
+    try:
+        f.write(fp + '\n')
+    finally:
+        f.close()
+    return filename
+
+
+def _link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _entry_size(entry_dir):
+    size = 0
+    for name in os.listdir(entry_dir):
+        size += os.lstat(os.path.join(entry_dir, name)).st_size
+    return size
+
+
+class ArtifactStore(object):
+    """
+    A local store of the artifacts built, indexed by the fingerprint of the inputs used for building them.
+    The least recently used entries are removed when the store is bigger than its limit.
+    """
+
+    def __init__(self, cache_dir, max_size = DEFAULT_STORE_SIZE):
+        self.store_dir = os.path.join(cache_dir, 'artifacts')
+        self.max_size = max_size * 1024 * 1024
+
+    def get(self, fp, dest_dir):
+        """
+        Restore the artifacts built with a fingerprint at "dest_dir", returning their paths,
+        or None if there is nothing for that fingerprint
+        """
+        entry_dir = os.path.join(self.store_dir, fp)
+        try:
+            entry = json.load(open(os.path.join(entry_dir, ENTRY_FILE)))
+        except (IOError, ValueError):
+            return None
+
+        for name in entry['artifacts']:
+            if not os.path.exists(os.path.join(entry_dir, name)):
+                logger.warning('the artifact store entry %s is incomplete: ignoring it' % fp)
+                return None
+
+        restored = []
+        for name in entry['artifacts']:
+            dest = os.path.join(dest_dir, name)
+            _link_or_copy(os.path.join(entry_dir, name), dest)
+            logger.info('... restored %s from the artifacts store' % name)
+            restored.append(dest)
+
+        ## the modification time of the entry is used for the LRU
+        os.utime(os.path.join(entry_dir, ENTRY_FILE), None)
+        return restored
+
+    def put(self, fp, artifacts):
+        """
+        Save the artifacts built with a fingerprint
+        """
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+        tmp_dir = tempfile.mkdtemp(prefix = 'tmp-', dir = self.store_dir)
+        try:
+            for artifact in artifacts:
+                _link_or_copy(artifact, os.path.join(tmp_dir, os.path.basename(artifact)))
+
+            f = open(os.path.join(tmp_dir, ENTRY_FILE), 'w')
+            try:
+                json.dump({'artifacts': [os.path.basename(a) for a in artifacts]}, f)
+            finally:
+                f.close()
+
+            entry_dir = os.path.join(self.store_dir, fp)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+            logger.debug('... saved %s in the artifacts store as %s' % (', '.join(artifacts), fp))
+        except (IOError, OSError), e:
+            logger.warning('could not save the artifacts in the store: %s' % str(e))
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the store fits in its limit
+        """
+        if not os.path.exists(self.store_dir):
+            return
+
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.store_dir):
+            entry_dir = os.path.join(self.store_dir, name)
+            try:
+                mtime = os.stat(os.path.join(entry_dir, ENTRY_FILE)).st_mtime
+                size = _entry_size(entry_dir)
+            except OSError:
+                continue
+            entries.append((mtime, size, name))
+            total_size += size
+
+        entries.sort()
+        while total_size > self.max_size and entries:
+            _, size, name = entries.pop(0)
+            logger.debug('... evicting %s from the artifacts store' % name)
+            shutil.rmtree(os.path.join(self.store_dir, name), ignore_errors = True)
+            total_size -= size
+
+
+def _sha256(filename):
+    h = hashlib.sha256()
+    f = open(filename, 'rb')
+    try:
+        for data in iter(lambda: f.read(READ_SIZE), ''):
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def _replace(dst, make_link):
+    """
+    Replace "dst" (atomically) by the link created by "make_link(tmp_path)"
+    """
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(dst), prefix = '.link-')
+    os.close(fd)
+    os.remove(tmp_path)
+    make_link(tmp_path)
+    try:
+        os.rename(tmp_path, dst)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class ContentStore(object):
+    """
+    A store of files named by the SHA-256 of their contents, with an index of their
+    names, versions, digests and sizes.
+
+    Files are published by renaming them into the store (so they must be in the same
+    filesystem to avoid copying them), and they are used through links. Files in the
+    store are read-only, as they can have many hardlinks.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, 'objects')
+
+    def path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def publish(self, filename, sha256 = None, version = None):
+        """
+        Move a file to the store, returning its digest. When we do not have the
+        digest (ie, for files written by other tools), we compute it.
+        """
+        if sha256 is None:
+            sha256 = _sha256(filename)
+        size = os.path.getsize(filename)
+        dest = self.path(sha256)
+        if not os.path.isdir(os.path.dirname(dest)):
+            try:
+                os.makedirs(os.path.dirname(dest))
+            except OSError:
+                ## another thread has created it
+                pass
+
+        if os.path.exists(dest):
+            logger.debug('... %s is already in the store' % os.path.basename(filename))
+            os.remove(filename)
+        else:
+            os.chmod(filename, stat.S_IMODE(os.stat(filename).st_mode) & 0444)
+            try:
+                os.rename(filename, dest)
+            except OSError, e:
+                if e.errno != errno.EXDEV:
+                    raise
+                logger.warning('the store at "%s" is in another filesystem: copying %s' %
+                               (self.store_dir, filename))
+                _replace(dest, lambda tmp_path: shutil.copy2(filename, tmp_path))
+                os.remove(filename)
+
+        self._add_to_index(os.path.basename(filename), version, sha256, size)
+        return sha256
+
+    def link(self, sha256, dest):
+        """
+        Link a file in the store at "dest" (with a hardlink, or with a symlink when
+        they are in different filesystems), returning "dest"
+        """
+        src = self.path(sha256)
+        def _link(tmp_path):
+            try:
+                os.link(src, tmp_path)
+            except OSError:
+                os.symlink(os.path.abspath(src), tmp_path)
+        _replace(dest, _link)
+        return dest
+
+    def _add_to_index(self, name, version, sha256, size):
+        """
+        Add a file to the index (locked, as other builds can be using the store)
+        """
+        index_filename = os.path.join(self.store_dir, INDEX_FILE)
+        with _index_lock:
+            lock = open(index_filename + '.lock', 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    index = json.load(open(index_filename))
+                except (IOError, ValueError):
+                    index = {}
+                index.setdefault(sha256, {'sha256': sha256, 'size': size, 'names': []})
+                entry = {'name': name, 'version': version}
+                if not entry in index[sha256]['names']:
+                    index[sha256]['names'].append(entry)
+
+                fd, tmp_filename = tempfile.mkstemp(dir = self.store_dir, prefix = '.index-')
+                f = os.fdopen(fd, 'w')
+                try:
+                    json.dump(index, f, indent = 2, sort_keys = True)
+                finally:
+                    f.close()
+                os.rename(tmp_filename, index_filename)
+            finally:
+                lock.close()
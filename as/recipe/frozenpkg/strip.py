@@ -0,0 +1,161 @@
+
+import os
+import stat
+import struct
+import tempfile
+
+from jobs import run_jobs
+from runner import run
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+ELF_MAGIC = '\x7fELF'
+
+#: where debuggers look for the debug info of a file (followed by its full path)
+DEBUG_DIR = 'usr/lib/debug'
+
+
+
+def is_elf(path):
+    f = open(path, 'rb')
+    try:
+        return f.read(4) == ELF_MAGIC
+    finally:
+        f.close()
+
+
+def elf_sections(path):
+    """
+    Return the names of the sections of an ELF file
+    """
+    f = open(path, 'rb')
+    try:
+        ident = f.read(16)
+        endian = '<' if ident[5] == '\x01' else '>'
+        if ident[4] == '\x02':
+            f.seek(0x28)
+            shoff, = struct.unpack(endian + 'Q', f.read(8))
+            f.seek(0x3a)
+            offset_format, offset_pos = endian + 'QQ', 0x18
+        else:
+            f.seek(0x20)
+            shoff, = struct.unpack(endian + 'I', f.read(4))
+            f.seek(0x2e)
+            offset_format, offset_pos = endian + 'II', 0x10
+        shentsize, shnum, shstrndx = struct.unpack(endian + 'HHH', f.read(6))
+        if not shoff or not shnum:
+            return []
+
+        f.seek(shoff)
+        table = f.read(shentsize * shnum)
+        headers = []
+        for i in range(shnum):
+            entry = table[i * shentsize:(i + 1) * shentsize]
+            name, = struct.unpack(endian + 'I', entry[:4])
+            offset, size = struct.unpack(offset_format, entry[offset_pos:offset_pos + struct.calcsize(offset_format)])
+            headers.append((name, offset, size))
+
+        _, strtab_offset, strtab_size = headers[shstrndx]
+        f.seek(strtab_offset)
+        strtab = f.read(strtab_size)
+        return [strtab[name:strtab.find('\0', name)] for name, _, _ in headers]
+    finally:
+        f.close()
+
+
+def is_strippable(path):
+    """
+    Return True if an ELF file has symbols or debug info we can remove
+    """
+    try:
+        sections = elf_sections(path)
+    except (struct.error, IndexError):
+        return False
+    return [s for s in sections if s == '.symtab' or s.startswith(('.debug', '.zdebug'))] != []
+
+
+def find_elf_files(root, exclude = None):
+    """
+    Return the ELF files (not the symlinks) in "root" that have something to strip
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if exclude:
+            dirnames[:] = [d for d in dirnames if not exclude(os.path.join(dirpath, d))]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if exclude and exclude(path):
+                continue
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 4 and is_elf(path) and is_strippable(path):
+                found.append(path)
+    found.sort()
+    return found
+
+
+def _run(command, timeout = None):
+    result = run(command, timeout)
+    if not result.ok:
+        raise Exception(result.error())
+
+
+def strip_file(path, debug_file = None, timeout = None):
+    """
+    Strip an ELF file, saving its debug info at "debug_file" (if it is not None). The
+    file is replaced by the stripped one (it is never modified in place, as it can be
+    a hardlink to some cache), killing the tools after "timeout" seconds. Return the
+    sizes before and after stripping it.
+    """
+    st = os.stat(path)
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), prefix = '.strip-')
+    os.close(fd)
+    try:
+        if debug_file:
+            if not os.path.isdir(os.path.dirname(debug_file)):
+                try:
+                    os.makedirs(os.path.dirname(debug_file))
+                except OSError:
+                    ## another thread has created it
+                    pass
+            _run(['objcopy', '--only-keep-debug', path, debug_file], timeout)
+        _run(['strip', '--strip-unneeded', '-o', tmp_path, path], timeout)
+        if debug_file:
+            _run(['objcopy', '--add-gnu-debuglink=%s' % debug_file, tmp_path], timeout)
+
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        os.utime(tmp_path, (st.st_atime, st.st_mtime))
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return st.st_size, os.path.getsize(path)
+
+
+def strip_tree(root, prefix, jobs = 1, exclude = None, debug_root = None, timeout = None):
+    """
+    Strip the ELF files in "root" (but those matching "exclude") with "jobs" threads.
+    When "debug_root" is not None, the debug info of every file is saved there (in
+    "usr/lib/debug/<prefix>/<path>.debug", where debuggers look for it).
+
+    Return the (path, size before, size after) of the files stripped, and the
+    number of files that could not be stripped.
+    """
+    def _strip(path):
+        debug_file = None
+        if debug_root:
+            rel_path = os.path.relpath(path, root)
+            debug_file = os.path.join(debug_root, DEBUG_DIR, prefix.strip('/'), rel_path + '.debug')
+        try:
+            before, after = strip_file(path, debug_file, timeout)
+        except Exception, e:
+            logger.warning('... could not strip "%s": %s' % (path, str(e)))
+            return None
+        logger.debug('... stripped "%s": %d -> %d bytes' % (path, before, after))
+        return path, before, after
+
+    results = run_jobs(_strip, find_elf_files(root, exclude), jobs)
+    return [r for r in results if r], len([r for r in results if not r])
@@ -0,0 +1,156 @@
+
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import tempfile
+
+from copier import copy_file
+from runner import run
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: file (in the template root) where we save the path where the template was created
+TEMPLATE_MARKER = '.frozenpkg-template'
+
+
+
+def _virtualenv_version():
+    return run(['virtualenv', '--version']).output.strip()
+
+
+def _is_mutable(rel_path):
+    """
+    Files that the build can modify in place: they must be copied, not linked
+    """
+    return rel_path.startswith('bin' + os.sep) or rel_path.endswith(('.pth', '.egg-link'))
+
+
+class VenvCache(object):
+    """
+    A cache of virtualenvs templates, keyed by the interpreter and the virtualenv version.
+
+    New virtualenvs are cloned from the template with hardlinks (or reflinks) for
+    the files that the build will never modify in place, and with copies for the rest.
+    """
+
+    def __init__(self, cache_dir, timeout = None):
+        self.cache_dir = os.path.join(cache_dir, 'venvs')
+        self.timeout = timeout
+
+    def key(self):
+        """
+        Return the key for the template of the current interpreter
+        """
+        h = hashlib.sha1()
+        h.update(os.path.realpath(sys.executable))
+        h.update(sys.version)
+        h.update(_virtualenv_version())
+        return h.hexdigest()
+
+    def clone(self, dest, exclude = None):
+        """
+        Clone the template for the current interpreter at "dest", creating the template if needed.
+        Files matching "exclude" are not cloned.
+        """
+        template = os.path.join(self.cache_dir, self.key())
+        if not os.path.exists(os.path.join(template, TEMPLATE_MARKER)):
+            self._create_template(template)
+        else:
+            logger.debug('... using cached virtualenv template at "%s"' % template)
+
+        orig_path = open(os.path.join(template, TEMPLATE_MARKER)).read().strip()
+
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        os.makedirs(dest)
+
+        logger.debug('... cloning "%s" -> "%s"' % (template, dest))
+        for dirpath, dirnames, filenames in os.walk(template):
+            rel_dir = os.path.relpath(dirpath, template)
+            dest_dir = os.path.normpath(os.path.join(dest, rel_dir))
+
+            for name in dirnames + filenames:
+                src = os.path.join(dirpath, name)
+                dst = os.path.join(dest_dir, name)
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+
+                if rel_path == TEMPLATE_MARKER or (exclude and exclude(dst)):
+                    continue
+                elif os.path.islink(src):
+                    link = os.readlink(src)
+                    if link.startswith(orig_path):
+                        link = dest + link[len(orig_path):]
+                    os.symlink(link, dst)
+                elif os.path.isdir(src):
+                    os.mkdir(dst)
+                    shutil.copystat(src, dst)
+                elif _is_mutable(rel_path):
+                    self._copy_replacing(src, dst, orig_path, dest)
+                else:
+                    try:
+                        os.link(src, dst)
+                    except OSError:
+                        copy_file(src, dst)
+
+            ## do not descend into symlinked (or skipped) directories
+            dirnames[:] = [d for d in dirnames if os.path.isdir(os.path.join(dest_dir, d)) and
+                                                  not os.path.islink(os.path.join(dest_dir, d))]
+
+    def _copy_replacing(self, src, dst, old, new):
+        """
+        Copy a file, replacing any reference to the "old" path by the "new" one
+        """
+        contents = open(src, 'rb').read()
+        if old in contents:
+            f = open(dst, 'wb')
+            try:
+                f.write(contents.replace(old, new))
+            finally:
+                f.close()
+            shutil.copystat(src, dst)
+        else:
+            copy_file(src, dst)
+
+    def _create_template(self, template):
+        """
+        Create a new template, in a temporary directory that is renamed when finished
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        tmp_dir = tempfile.mkdtemp(prefix = 'tmp-', dir = self.cache_dir)
+        logger.info('Creating virtualenv template at "%s".' % tmp_dir)
+
+        ## the template is created with the "virtualenv" command, as any other virtualenv
+        ## (the library API is not stable between virtualenv versions)
+        command = [
+            'virtualenv',
+            '--python=%s' % sys.executable,
+            '--distribute',
+            '--no-site-packages',
+            '--clear',
+            tmp_dir,
+        ]
+        result = run(command, self.timeout, log = logger)
+        if not result.ok:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+            raise Exception('could not create the virtualenv template: %s' % result.error())
+
+        marker = open(os.path.join(tmp_dir, TEMPLATE_MARKER), 'w')
+        try:
+            marker.write(tmp_dir + '\n')
+        finally:
+            marker.close()
+
+        try:
+            os.rename(tmp_dir, template)
+        except OSError, e:
+            ## somebody else created the same template while we were creating ours
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            shutil.rmtree(tmp_dir, ignore_errors = True)
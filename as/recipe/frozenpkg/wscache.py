@@ -0,0 +1,149 @@
+
+import os
+import sys
+import json
+import glob
+import hashlib
+import tempfile
+import threading
+import pkg_resources
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+#: the working sets resolved in this process (shared by all the parts in the buildout)
+_RESOLVED = {}
+_RESOLVED_LOCK = threading.Lock()
+
+
+
+def _develop_index(develop_dir, names):
+    """
+    The modification times of the metadata of the develop eggs linked from "develop_dir"
+    (so we notice when their requirements change)
+    """
+    index = []
+    for name in names:
+        if not name.endswith('.egg-link'):
+            continue
+        try:
+            location = open(os.path.join(develop_dir, name)).readline().strip()
+        except IOError:
+            continue
+        for egg_info in sorted(glob.glob(os.path.join(location, '*.egg-info'))):
+            if not os.path.isdir(egg_info):
+                index.append([egg_info, os.path.getmtime(egg_info)])
+                continue
+            for filename in sorted(os.listdir(egg_info)):
+                path = os.path.join(egg_info, filename)
+                index.append([path, os.path.getmtime(path)])
+    return index
+
+
+def directory_index(path, develop = False):
+    """
+    A cheap index of a directory of eggs: its modification time and its entries
+    (and the metadata of the develop eggs, for the develop eggs directory)
+    """
+    if not os.path.isdir(path):
+        return None
+    names = sorted(os.listdir(path))
+    index = [path, os.path.getmtime(path), names]
+    if develop:
+        index.append(_develop_index(path, names))
+    return index
+
+
+def _find_dist(key, version, location, precedence):
+    for dist in pkg_resources.find_distributions(location, only = True):
+        if dist.key == key and dist.version == version and dist.precedence == precedence:
+            return dist
+    return None
+
+
+class WorkingSetCache(object):
+    """
+    A cache of the working sets resolved for some eggs, in memory and on disk.
+
+    The key is the eggs requested (and the versions pinned), the interpreter and
+    a cheap index of the eggs directories, so a working set is resolved again when
+    any egg is added to (or removed from) them, or when the metadata of a develop
+    egg changes.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.join(cache_dir, 'working-sets')
+
+    def key(self, eggs, develop_dir, eggs_dir, versions = None):
+        """
+        Return the key for the working set of some eggs (with some pinned "versions")
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps([
+            list(eggs),
+            sorted((versions or {}).items()),
+            os.path.realpath(sys.executable),
+            sys.version,
+            directory_index(develop_dir, develop = True),
+            directory_index(eggs_dir),
+        ]))
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return the distributions for a key, or None if they are not in the cache
+        """
+        with _RESOLVED_LOCK:
+            if key in _RESOLVED:
+                logger.debug('... using the working set resolved for %s' % key)
+                return list(_RESOLVED[key])
+
+        filename = os.path.join(self.cache_dir, key + '.json')
+        if not os.path.exists(filename):
+            return None
+        try:
+            entries = json.load(open(filename))
+        except ValueError:
+            logger.debug('... ignoring corrupted working set "%s"' % filename)
+            return None
+
+        dists = []
+        for key_, version, location, precedence in entries:
+            dist = None
+            if os.path.exists(location):
+                dist = _find_dist(key_, version, location, precedence)
+            if dist is None:
+                logger.debug('... cached working set %s is stale: "%s" not found' % (key, location))
+                return None
+            dists.append(dist)
+
+        logger.debug('... using the cached working set at "%s"' % filename)
+        with _RESOLVED_LOCK:
+            _RESOLVED[key] = dists
+        return list(dists)
+
+    def put(self, key, dists):
+        """
+        Save the distributions resolved for a key
+        """
+        dists = list(dists)
+        with _RESOLVED_LOCK:
+            _RESOLVED[key] = dists
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entries = [[d.key, d.version, d.location, d.precedence] for d in dists]
+        fd, tmp_filename = tempfile.mkstemp(dir = self.cache_dir, prefix = '.ws-')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(entries, f)
+            finally:
+                f.close()
+            os.rename(tmp_filename, os.path.join(self.cache_dir, key + '.json'))
+        except:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
@@ -46,7 +46,8 @@ setup(
         'zc.buildout': [
             'default = as.recipe.frozenpkg.frozenrpm:FrozenRPM',
             'rpm     = as.recipe.frozenpkg.frozenrpm:FrozenRPM',
-            'tgz     = as.recipe.frozenpkg.frozentgz:FrozenTgz'
+            'tgz     = as.recipe.frozenpkg.frozentgz:FrozenTgz',
+            'deb     = as.recipe.frozenpkg.frozendeb:FrozenDeb',
         ]
     },
 )
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the frozenpkg recipes.
+
+It generates synthetic buildouts (with N eggs of M files, some data copied with
+"extra-copies" and a lot of cleanup globs) and packages them with the recipes,
+using the stub "virtualenv", "easy_install" and "rpmbuild" in "stubs/", so it
+works without network access or RPM tools. Every build runs in a new process, so
+we can report its peak RSS together with the time spent in every phase.
+
+    python testing/benchmark/bench.py                       # compare with the baselines
+    python testing/benchmark/bench.py --save-baselines      # update the baselines
+    python testing/benchmark/bench.py --scenario large --recipe tgz -o compression=xz
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import optparse
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBS_DIR = os.path.join(BENCHMARK_DIR, 'stubs')
+TOP_DIR = os.path.abspath(os.path.join(BENCHMARK_DIR, '..', '..'))
+BASELINES = os.path.join(BENCHMARK_DIR, 'baselines.json')
+
+#: the synthetic buildouts: number of eggs, files per egg, size of every file,
+#: data copied with "extra-copies" and number of cleanup globs
+SCENARIOS = {
+    'small':  {'eggs': 5,   'files': 10,  'file_size': 2048, 'data_files': 20,  'data_size': 64 * 1024,  'cleanups': 10},
+    'medium': {'eggs': 30,  'files': 40,  'file_size': 4096, 'data_files': 100, 'data_size': 256 * 1024, 'cleanups': 50},
+    'large':  {'eggs': 100, 'files': 100, 'file_size': 8192, 'data_files': 200, 'data_size': 1024 * 1024, 'cleanups': 200},
+}
+
+#: the recipes we can run
+RECIPES = {
+    'rpm': ('as.recipe.frozenpkg.frozenrpm', 'FrozenRPM'),
+    'tgz': ('as.recipe.frozenpkg.frozentgz', 'FrozenTgz'),
+}
+
+PY_TAG = 'py%d.%d' % sys.version_info[:2]
+
+
+
+def _write(filename, contents):
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    f = open(filename, 'wb')
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+
+
+def _filler(size, seed):
+    """
+    Some Python source of "size" bytes that does not compress too well
+    """
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = 'VALUE_%d_%d = %r\n' % (seed, i, hex(hash((seed, i)) & 0xffffffffffff))
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return ''.join(lines)
+
+
+def generate(work_dir, scenario):
+    """
+    Generate a buildout for a scenario at "work_dir", returning the names of the eggs
+    """
+    eggs_dir = os.path.join(work_dir, 'eggs')
+    os.makedirs(os.path.join(work_dir, 'develop-eggs'))
+    os.makedirs(os.path.join(work_dir, 'parts'))
+
+    names = []
+    for i in range(scenario['eggs']):
+        name = 'benchegg%03d' % i
+        egg_dir = os.path.join(eggs_dir, '%s-1.0-%s.egg' % (name, PY_TAG))
+        _write(os.path.join(egg_dir, 'EGG-INFO', 'PKG-INFO'),
+               'Metadata-Version: 1.0\nName: %s\nVersion: 1.0\nSummary: benchmark egg\n' % name)
+        _write(os.path.join(egg_dir, 'EGG-INFO', 'top_level.txt'), name + '\n')
+        _write(os.path.join(egg_dir, 'EGG-INFO', 'entry_points.txt'),
+               '[console_scripts]\n%s = %s:main\n' % (name, name))
+        _write(os.path.join(egg_dir, name, '__init__.py'), 'def main():\n    pass\n')
+        for j in range(scenario['files']):
+            _write(os.path.join(egg_dir, name, 'module%03d.py' % j), _filler(scenario['file_size'], i * 1000 + j))
+            if j % 10 == 0:
+                _write(os.path.join(egg_dir, name, 'tests', 'test_module%03d.py' % j), _filler(512, j))
+        names.append(name)
+
+    for i in range(scenario['data_files']):
+        _write(os.path.join(work_dir, 'data', 'set%02d' % (i % 10), 'file%04d.dat' % i),
+               _filler(scenario['data_size'], -i))
+        if i % 5 == 0:
+            _write(os.path.join(work_dir, 'data', 'set%02d' % (i % 10), 'file%04d.tmp' % i), 'temporary\n')
+
+    for i in range(5):
+        _write(os.path.join(work_dir, 'etc', 'service%d.conf' % i), '[service]\nport = %d\n' % (8000 + i))
+    return names
+
+
+def recipe_options(work_dir, scenario, eggs, extra_options):
+    cleanups = ['bin/activate*', 'data/*/*.tmp', 'lib/python*/site-packages/*/*/tests']
+    for i in range(scenario['cleanups'] - len(cleanups)):
+        cleanups.append('data/set%02d/never%04d-*.bak' % (i % 10, i))
+
+    options = {
+        'eggs': '\n'.join(eggs),
+        'pkg-name': 'benchmark',
+        'pkg-version': '1.0',
+        'pkg-prefix': '/opt/benchmark',
+        'extra-copies': os.path.join(work_dir, 'data') + ' -> data',
+        'extra-dirs': 'var/log\nvar/run',
+        'extra-cleanups': '\n'.join(cleanups),
+        'cache-dir': os.path.join(work_dir, 'cache'),
+    }
+    options.update(extra_options)
+    return options
+
+
+def run_build(work_dir, recipe, options):
+    """
+    Build a package in this process, returning the times and the peak RSS
+    """
+    sys.path.insert(0, TOP_DIR)
+    import importlib
+    module_name, class_name = RECIPES[recipe]
+    cls = getattr(importlib.import_module(module_name), class_name)
+
+    outputs = [os.path.join(work_dir, 'etc', f) for f in sorted(os.listdir(os.path.join(work_dir, 'etc')))]
+    buildout = {
+        'buildout': {
+            'directory': work_dir,
+            'parts': 'config frozen',
+            'eggs-directory': os.path.join(work_dir, 'eggs'),
+            'develop-eggs-directory': os.path.join(work_dir, 'develop-eggs'),
+            'parts-directory': os.path.join(work_dir, 'parts'),
+        },
+        'config': {'output': '\n'.join(outputs)},
+        'frozen': options,
+    }
+
+    start = time.time()
+    frozen = cls(buildout, 'frozen', options)
+    artifacts = frozen.install()
+    seconds = time.time() - start
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'seconds': round(seconds, 3),
+        'phases': dict([(p['name'], p['seconds']) for p in frozen.report.phases]),
+        'max_rss_kb': usage_self.ru_maxrss,
+        'children_max_rss_kb': usage_children.ru_maxrss,
+        'artifacts_bytes': sum([os.path.getsize(a) for a in artifacts if os.path.exists(a)]),
+    }
+
+
+def _stub_wrappers(bin_dir):
+    """
+    Write the scripts that run the stub tools with this interpreter (they are Python 2
+    code, and "python" in the PATH can be Python 3), returning their directory
+    """
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir)
+    for name in os.listdir(STUBS_DIR):
+        filename = os.path.join(bin_dir, name)
+        f = open(filename, 'w')
+        try:
+            f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(STUBS_DIR, name)))
+        finally:
+            f.close()
+        os.chmod(filename, 0755)
+    return bin_dir
+
+
+def run_in_subprocess(work_dir, recipe, options):
+    env = dict(os.environ)
+    env['PATH'] = _stub_wrappers(os.path.join(work_dir, 'stubs')) + os.pathsep + env.get('PATH', '')
+    command = [sys.executable, os.path.abspath(__file__), '--child', work_dir, recipe, json.dumps(options)]
+    job = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE, env = env)
+    stdout, stderr = job.communicate()
+    if job.returncode != 0:
+        raise Exception('the build failed:\n%s' % stderr)
+    return json.loads(stdout.strip().splitlines()[-1])
+
+
+def _best(runs):
+    """
+    The best times of several runs (the less noisy measure), and the highest peak RSS
+    """
+    best = dict(runs[0])
+    best['seconds'] = min([r['seconds'] for r in runs])
+    best['max_rss_kb'] = max([r['max_rss_kb'] for r in runs])
+    best['children_max_rss_kb'] = max([r['children_max_rss_kb'] for r in runs])
+    best['phases'] = {}
+    for name in runs[0]['phases']:
+        best['phases'][name] = min([r['phases'].get(name, 0) for r in runs])
+    return best
+
+
+def _delta(current, baseline):
+    if not baseline:
+        return ''
+    return '%+.0f%%' % (100.0 * (current - baseline) / baseline)
+
+
+def print_result(key, result, baseline):
+    baseline = baseline or {}
+    print '%s: %.2fs (baseline %s %s), peak RSS %d KB (children %d KB), artifacts %d bytes' % (
+        key, result['seconds'], baseline.get('seconds', '-'), _delta(result['seconds'], baseline.get('seconds')),
+        result['max_rss_kb'], result['children_max_rss_kb'], result['artifacts_bytes'])
+    baseline_phases = baseline.get('phases', {})
+    for name, seconds in sorted(result['phases'].items(), key = lambda p: -p[1]):
+        print '    %-18s %8.3fs %10s %6s' % (name, seconds, baseline_phases.get(name, '-'),
+                                             _delta(seconds, baseline_phases.get(name)))
+
+
+def main():
+    parser = optparse.OptionParser(usage = '%prog [OPTIONS]')
+    parser.add_option('-s', '--scenario', action = 'append', choices = sorted(SCENARIOS.keys()),
+                      help = 'scenario to run (can be repeated; default: small and medium)')
+    parser.add_option('-r', '--recipe', action = 'append', choices = sorted(RECIPES.keys()),
+                      help = 'recipe to run (can be repeated; default: all)')
+    parser.add_option('-o', '--option', action = 'append', default = [], metavar = 'KEY=VALUE',
+                      help = 'additional option for the recipe (ie, "-o install-jobs=4")')
+    parser.add_option('-n', '--repeat', type = 'int', default = 3,
+                      help = 'runs of every benchmark (we report the best one)')
+    parser.add_option('--warm', action = 'store_true',
+                      help = 'keep the cache directory between runs')
+    parser.add_option('--baselines', default = BASELINES,
+                      help = 'baselines file (default: %default)')
+    parser.add_option('--save-baselines', action = 'store_true',
+                      help = 'save the results as the new baselines')
+    parser.add_option('--max-regression', type = 'float', default = None, metavar = 'PERCENT',
+                      help = 'exit with an error when a build is slower than its baseline by more than this')
+    parser.add_option('--keep', action = 'store_true',
+                      help = 'keep the generated buildouts')
+    parser.add_option('--child', action = 'store_true',
+                      help = optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        work_dir, recipe, recipe_opts = args
+        ## buildout passes the options as "str", not as the unicode we get from json
+        recipe_opts = dict([(str(k), str(v)) for k, v in json.loads(recipe_opts).items()])
+        print json.dumps(run_build(work_dir, recipe, recipe_opts))
+        return 0
+
+    extra_options = dict([o.split('=', 1) for o in options.option])
+    extra_options['report'] = 'yes'
+
+    try:
+        baselines = json.load(open(options.baselines))
+    except (IOError, ValueError):
+        baselines = {}
+
+    results = {}
+    regressions = []
+    for scenario_name in options.scenario or ['small', 'medium']:
+        scenario = SCENARIOS[scenario_name]
+        work_dir = tempfile.mkdtemp(prefix = 'frozenpkg-bench-')
+        try:
+            eggs = generate(work_dir, scenario)
+            for recipe in options.recipe or sorted(RECIPES.keys()):
+                key = '%s/%s' % (scenario_name, recipe)
+                if extra_options:
+                    key += ''.join([' %s=%s' % (k, v) for k, v in sorted(extra_options.items()) if k != 'report'])
+                runs = []
+                for i in range(options.repeat):
+                    if not options.warm:
+                        shutil.rmtree(os.path.join(work_dir, 'cache'), ignore_errors = True)
+                    runs.append(run_in_subprocess(work_dir, recipe,
+                                                  recipe_options(work_dir, scenario, eggs, extra_options)))
+                results[key] = _best(runs)
+                print_result(key, results[key], baselines.get(key))
+
+                baseline_seconds = baselines.get(key, {}).get('seconds')
+                if options.max_regression is not None and baseline_seconds and \
+                   results[key]['seconds'] > baseline_seconds * (1 + options.max_regression / 100.0):
+                    regressions.append(key)
+        finally:
+            if options.keep:
+                print 'Buildout kept at %s' % work_dir
+            else:
+                shutil.rmtree(work_dir, ignore_errors = True)
+
+    if options.save_baselines:
+        baselines.update(results)
+        f = open(options.baselines, 'w')
+        try:
+            json.dump(baselines, f, indent = 2, sort_keys = True)
+            f.write('\n')
+        finally:
+            f.close()
+        print 'Baselines saved at %s' % options.baselines
+
+    if regressions:
+        print 'Slower than the baselines: %s' % ', '.join(regressions)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
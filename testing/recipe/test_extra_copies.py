@@ -0,0 +1,89 @@
+"""
+Tests for the inputs of the "extra-copies": everything in the sources is copied,
+so a change anywhere in them (even in directories named like the build or the VCS
+ones) must be seen by the incremental builds and change the fingerprint.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+## the modules of the recipe import each other by their names
+sys.path.insert(0, os.path.join(TOP_DIR, 'as', 'recipe', 'frozenpkg'))
+
+from frozentgz import FrozenTgz
+
+
+
+def _write_file(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, 'w')
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+
+
+class ExtraCopiesInputsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buildout_dir = tempfile.mkdtemp(prefix = 'frozenpkg-test-')
+        self.static = os.path.join(self.buildout_dir, 'static')
+        _write_file(os.path.join(self.static, 'index.html'), '<html></html>\n')
+        _write_file(os.path.join(self.static, 'dist', 'app.js'), 'var app = 1;\n')
+
+        buildout = {
+            'buildout': {
+                'directory': self.buildout_dir,
+                'parts': 'frozen',
+                'parts-directory': os.path.join(self.buildout_dir, 'parts'),
+            },
+        }
+        options = {
+            'eggs': '',
+            'pkg-name': 'app',
+            'pkg-prefix': '/opt/app',
+            'incremental': 'yes',
+            'extra-copies': 'static -> share/static',
+        }
+        buildout['frozen'] = options
+        self.recipe = FrozenTgz(buildout, 'frozen', options)
+        self.recipe._setup_build()
+
+    def tearDown(self):
+        shutil.rmtree(self.buildout_dir, ignore_errors = True)
+
+    def test_change_in_dist(self):
+        before = self.recipe._extra_copies_inputs()
+        _write_file(os.path.join(self.static, 'dist', 'app.js'), 'var app = 2; // rebuilt\n')
+        self.assertNotEqual(self.recipe._extra_copies_inputs(), before)
+
+    def test_new_file_in_vcs_dir(self):
+        before = self.recipe._extra_copies_inputs()
+        _write_file(os.path.join(self.static, '.git', 'HEAD'), 'ref: refs/heads/master\n')
+        self.assertNotEqual(self.recipe._extra_copies_inputs(), before)
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.recipe._extra_copies_inputs(), self.recipe._extra_copies_inputs())
+        self.assertEqual(self.recipe._fingerprint_inputs([]), self.recipe._fingerprint_inputs([]))
+
+    def test_fingerprint_change_in_dist(self):
+        ## the same size, and maybe the same modification time: only the contents change
+        before = self.recipe._fingerprint_inputs([])
+        _write_file(os.path.join(self.static, 'dist', 'app.js'), 'var app = 3;\n')
+        self.assertNotEqual(self.recipe._fingerprint_inputs([]), before)
+
+    def test_fingerprint_change_in_build(self):
+        before = self.recipe._fingerprint_inputs([])
+        _write_file(os.path.join(self.static, 'build', 'app.min.js'), 'var a=1;\n')
+        self.assertNotEqual(self.recipe._fingerprint_inputs([]), before)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Helpers for the tests of the package writers: a tiny buildroot and the metadata
+the recipes pass to the writers.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+WRITERS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.abspath(os.path.join(WRITERS_DIR, '..', '..'))
+
+## the modules of the recipe import each other by their names
+sys.path.insert(0, os.path.join(TOP_DIR, 'as', 'recipe', 'frozenpkg'))
+
+#: the prefix of the packages in the buildroot
+PREFIX = '/opt/app'
+
+#: the metadata for the RPM and deb writers
+METADATA = {
+    'name':         'app',
+    'version':      '1.0',
+    'release':      '1',
+    'summary':      'app',
+    'description':  u'The app package.\nGPL \u2013 caf\xe9',
+    'vendor':       u'Soci\xe9t\xe9',
+    'packager':     'someone <someone@example.com>',
+    'maintainer':   'someone <someone@example.com>',
+    'url':          'http://example.com',
+    'license':      'GPL',
+    'group':        'Applications',
+    'section':      'misc',
+    'deps':         [('python', '>=', '2.6')],
+    'pre':          '',
+    'post':         'echo installed',
+    'def_user':     'adm',
+    'def_group':    'adm',
+    'def_mode':     0750,
+}
+
+
+
+def write_file(path, contents, mode = 0644):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, 'wb')
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+    os.chmod(path, mode)
+
+
+def make_buildroot(buildroot):
+    """
+    Create a small tree at PREFIX in the buildroot, with a script, some modules, a
+    hardlink, a symlink and an empty directory
+    """
+    top = buildroot + PREFIX
+    write_file(os.path.join(top, 'bin', 'app'), '#!/bin/sh\necho app\n', 0755)
+    write_file(os.path.join(top, 'lib', 'app', '__init__.py'), 'VERSION = "1.0"\n')
+    write_file(os.path.join(top, 'lib', 'app', 'data.bin'), ''.join([chr(i % 256) for i in range(70000)]))
+    write_file(os.path.join(top, 'etc', 'app.cfg'), '[app]\n')
+    os.link(os.path.join(top, 'lib', 'app', '__init__.py'), os.path.join(top, 'lib', 'app', 'same.py'))
+    os.symlink('app/__init__.py', os.path.join(top, 'lib', 'link.py'))
+    os.makedirs(os.path.join(top, 'var', 'log'))
+    return top
+
+
+def tree_contents(top):
+    """
+    Return the paths in a tree (relative to it) with their type and contents
+    """
+    contents = {}
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, top)
+            if os.path.islink(path):
+                contents[rel] = ('l', os.readlink(path))
+            elif os.path.isdir(path):
+                contents[rel] = ('d', None)
+            else:
+                contents[rel] = ('f', open(path, 'rb').read())
+    return contents
+
+
+class WriterTestCase(unittest.TestCase):
+    """
+    A test with a buildroot and a directory for the packages, removed at the end
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix = 'frozenpkg-test-')
+        self.buildroot = os.path.join(self.tmp_dir, 'buildroot')
+        self.dest_dir = os.path.join(self.tmp_dir, 'dist')
+        os.makedirs(self.dest_dir)
+        self.top = make_buildroot(self.buildroot)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors = True)
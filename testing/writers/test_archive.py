@@ -0,0 +1,72 @@
+"""
+Tests for the tar writer: it handles the symlinks as the other writers do.
+"""
+
+import os
+import tarfile
+import unittest
+
+from common import WriterTestCase, PREFIX, write_file
+
+from archive import write_tar, collect_tree
+
+
+
+class TarWriterTest(WriterTestCase):
+
+    def setUp(self):
+        WriterTestCase.setUp(self)
+        ## a directory outside the buildroot (like the standard library linked
+        ## by virtualenv) with links to itself and to a parent of the buildroot
+        self.external = os.path.join(self.tmp_dir, 'external')
+        write_file(os.path.join(self.external, 'os.py'), '# os\n')
+        os.symlink('.', os.path.join(self.external, 'loop'))
+        os.symlink('..', os.path.join(self.external, 'up'))
+        os.symlink(self.external, os.path.join(self.top, 'lib', 'stdlib'))
+        ## a link to a directory in the buildroot
+        os.symlink('app', os.path.join(self.top, 'lib', 'app-link'))
+
+    def _members(self, **kwargs):
+        filename = write_tar(self.buildroot, os.path.join(self.dest_dir, 'app'), **kwargs)
+        tar = tarfile.open(filename)
+        try:
+            return dict([(info.name.lstrip('/'), info) for info in tar.getmembers()])
+        finally:
+            tar.close()
+
+    def test_links(self):
+        members = self._members()
+        prefix = PREFIX.lstrip('/')
+
+        ## the links in the buildroot are kept, and the external ones are dereferenced
+        self.assertTrue(members[prefix + '/lib/link.py'].issym())
+        self.assertTrue(members[prefix + '/lib/app-link'].issym())
+        self.assertFalse([name for name in members if name.startswith(prefix + '/lib/app-link/')])
+        self.assertTrue(members[prefix + '/lib/stdlib'].isdir())
+        self.assertTrue(members[prefix + '/lib/stdlib/os.py'].isfile())
+        self.assertTrue(members[prefix + '/lib/stdlib/loop'].issym())
+        self.assertTrue(members[prefix + '/lib/stdlib/up'].issym())
+
+        ## the same things as in the RPMs and the debs
+        entries = collect_tree(self.buildroot, self.buildroot)
+        self.assertEqual(sorted(members.keys()),
+                         sorted([os.path.relpath(path, self.buildroot) for path, real, st in entries
+                                 if path != self.buildroot]))
+
+    def test_hardlinks(self):
+        members = self._members(compression = 'gzip')
+        prefix = PREFIX.lstrip('/')
+        links = [members[prefix + '/lib/app/__init__.py'], members[prefix + '/lib/app/same.py']]
+        self.assertEqual(sorted([info.islnk() for info in links]), [False, True])
+
+    def test_failure(self):
+        def exclude(path):
+            if path.endswith('data.bin'):
+                raise IOError('cannot read "%s"' % path)
+        self.assertRaises(IOError, write_tar, self.buildroot, os.path.join(self.dest_dir, 'app'),
+                          compression = 'gzip', exclude = exclude)
+        self.assertEqual(os.listdir(self.dest_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests for the deb writer: the packages are read back with "dpkg-deb" (when it
+is installed) and with tarfile.
+"""
+
+import os
+import hashlib
+import tarfile
+import unittest
+import StringIO
+import subprocess
+from distutils.spawn import find_executable
+
+from common import WriterTestCase, METADATA, PREFIX, tree_contents
+
+from debwriter import write_deb
+
+
+
+def _ar_members(filename):
+    """
+    Return the members of an ar archive, as a list of (name, data)
+    """
+    f = open(filename, 'rb')
+    try:
+        if f.read(8) != '!<arch>\n':
+            raise ValueError('not an ar archive')
+        members = []
+        while True:
+            header = f.read(60)
+            if not header:
+                return members
+            name, size = header[:16].strip().rstrip('/'), int(header[48:58])
+            members.append((name, f.read(size)))
+            f.read(size % 2)
+    finally:
+        f.close()
+
+
+def _dpkg_deb(*args):
+    return subprocess.Popen(['dpkg-deb'] + list(args), stdout = subprocess.PIPE).communicate()[0]
+
+
+class DebWriterTest(WriterTestCase):
+
+    def test_members(self):
+        filename = write_deb(self.dest_dir, self.buildroot, PREFIX, METADATA,
+                             config = lambda path: path.endswith('.cfg'))
+        members = _ar_members(filename)
+        self.assertEqual([name for name, data in members], ['debian-binary', 'control.tar.gz', 'data.tar.gz'])
+        self.assertEqual(members[0][1], '2.0\n')
+
+        control = tarfile.open(fileobj = StringIO.StringIO(members[1][1]))
+        md5sums = dict([line.split('  ', 1)[::-1] for line in
+                        control.extractfile('./md5sums').read().splitlines()])
+        self.assertEqual(control.extractfile('./conffiles').read(), '%s/etc/app.cfg\n' % PREFIX)
+
+        ## the parents of the prefix are owned by root, and the package by "def_user"
+        data = tarfile.open(fileobj = StringIO.StringIO(members[2][1]))
+        parents = ['.', './opt']
+        self.assertEqual([info.name for info in data.getmembers()[:2]], parents)
+        for info in data.getmembers():
+            if info.name in parents:
+                self.assertEqual((info.uname, info.gname), ('root', 'root'))
+                continue
+            self.assertEqual((info.uname, info.gname), ('adm', 'adm'))
+            if info.isdir():
+                self.assertEqual(info.mode, METADATA['def_mode'])
+            elif info.isfile():
+                contents = data.extractfile(info).read()
+                self.assertEqual(contents, open(self.buildroot + info.name[1:], 'rb').read())
+                self.assertEqual(md5sums[info.name[2:]], hashlib.md5(contents).hexdigest())
+        self.assertEqual(len(md5sums), len([i for i in data.getmembers() if i.isfile() or i.islnk()]))
+
+    @unittest.skipUnless(find_executable('dpkg-deb'), 'dpkg-deb is not installed')
+    def test_dpkg_info(self):
+        filename = write_deb(self.dest_dir, self.buildroot, PREFIX, METADATA)
+        self.assertEqual(_dpkg_deb('-f', filename, 'Package').strip(), 'app')
+        self.assertEqual(_dpkg_deb('-f', filename, 'Version').strip(), '1.0-1')
+        self.assertEqual(_dpkg_deb('-f', filename, 'Depends').strip(), 'python (>= 2.6)')
+        self.assertEqual(_dpkg_deb('-f', filename, 'Description').decode('utf-8').strip(),
+                         METADATA['description'].replace('\n', '\n '))
+        self.assertTrue('postinst' in _dpkg_deb('-I', filename))
+
+    @unittest.skipUnless(find_executable('dpkg-deb'), 'dpkg-deb is not installed')
+    def test_dpkg_contents(self):
+        filename = write_deb(self.dest_dir, self.buildroot, PREFIX, METADATA)
+        listing = _dpkg_deb('-c', filename)
+        self.assertTrue('adm/adm' in listing)
+        self.assertTrue('.%s/lib/link.py -> app/__init__.py' % PREFIX in listing)
+
+        extracted = os.path.join(self.tmp_dir, 'extracted')
+        subprocess.check_call(['dpkg-deb', '-x', filename, extracted])
+        self.assertEqual(tree_contents(extracted + PREFIX), tree_contents(self.top))
+        self.assertEqual(os.stat(extracted + PREFIX + '/lib/app/same.py').st_ino,
+                         os.stat(extracted + PREFIX + '/lib/app/__init__.py').st_ino)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
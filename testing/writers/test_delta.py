@@ -0,0 +1,94 @@
+"""
+Tests for the deltas: a delta is applied to a copy of the previous tree, and the
+result must be the new tree.
+"""
+
+import os
+import shutil
+import tarfile
+import unittest
+import subprocess
+
+from common import WriterTestCase, METADATA, PREFIX, write_file, tree_contents
+
+from delta import tree_files, diff_files, write_delta, load_files, DELTA_EXT
+from rpmwriter import write_rpm
+
+
+
+class DeltaTest(WriterTestCase):
+
+    def _change_tree(self):
+        write_file(os.path.join(self.top, 'lib', 'app', '__init__.py'), 'VERSION = "2.0"\n')
+        write_file(os.path.join(self.top, 'lib', 'app', 'new.py'), 'NEW = True\n')
+        os.remove(os.path.join(self.top, 'etc', 'app.cfg'))
+        os.rmdir(os.path.join(self.top, 'var', 'log'))
+        ## a file that becomes a directory
+        os.remove(os.path.join(self.top, 'bin', 'app'))
+        write_file(os.path.join(self.top, 'bin', 'app', 'main'), '#!/bin/sh\necho app 2\n', 0755)
+
+    def _apply(self, old_files, old_root):
+        new_files = tree_files(self.buildroot, self.top)
+        changed, deleted = diff_files(old_files, new_files, PREFIX)
+        filename = write_delta(os.path.join(self.dest_dir, 'app-2.0-1' + DELTA_EXT),
+                               self.buildroot, PREFIX, new_files, changed, deleted,
+                               {'from': 'app-1.0-1', 'to': 'app-2.0-1',
+                                'changed': len(changed), 'deleted': len(deleted)},
+                               METADATA)
+
+        delta_dir = os.path.join(self.tmp_dir, 'delta')
+        tar = tarfile.open(filename)
+        for info in tar.getmembers():
+            if info.name == 'files.tar':
+                files_tar = tarfile.open(fileobj = tar.extractfile(info))
+                for member in files_tar.getmembers():
+                    self.assertEqual((member.uname, member.gname, member.uid, member.gid), ('adm', 'adm', 0, 0))
+                    if member.isdir():
+                        self.assertEqual(member.mode, METADATA['def_mode'])
+        tar.extractall(delta_dir)
+        tar.close()
+
+        subprocess.check_call(['sh', os.path.join(delta_dir, 'apply-delta.sh'), old_root],
+                              stdout = open(os.devnull, 'w'))
+        return changed, deleted
+
+    def test_apply(self):
+        old_files = tree_files(self.buildroot, self.top)
+        installed = os.path.join(self.tmp_dir, 'installed')
+        shutil.copytree(self.buildroot, installed, symlinks = True)
+        self._change_tree()
+
+        changed, deleted = self._apply(old_files, installed)
+        self.assertEqual(tree_contents(installed + PREFIX), tree_contents(self.top))
+        self.assertFalse('opt/app/lib/app/data.bin' in changed)
+        ## a hardlink to a file that has changed
+        self.assertTrue('opt/app/lib/app/same.py' in changed)
+        self.assertTrue('opt/app/etc/app.cfg' in deleted)
+
+    def test_apply_from_rpm(self):
+        old_rpm = write_rpm(self.dest_dir, self.buildroot, PREFIX, METADATA)
+        old_files, info = load_files(old_rpm)
+        self.assertEqual((info['name'], info['version']), ('app', '1.0'))
+        ## the directories in the package have the "def_mode", and we do not
+        ## know the contents of the targets of the symlinks
+        files = tree_files(self.buildroot, self.top)
+        self.assertEqual(dict([(path, entry[0]) for path, entry in old_files.items()]),
+                         dict([(path, entry[0]) for path, entry in files.items()]))
+        self.assertEqual(dict([(path, entry) for path, entry in old_files.items() if entry[0] == 'f']),
+                         dict([(path, entry) for path, entry in files.items() if entry[0] == 'f']))
+
+        installed = os.path.join(self.tmp_dir, 'installed')
+        shutil.copytree(self.buildroot, installed, symlinks = True)
+        self._change_tree()
+
+        self._apply(old_files, installed)
+        self.assertEqual(tree_contents(installed + PREFIX), tree_contents(self.top))
+
+    def test_nothing_changed(self):
+        files = tree_files(self.buildroot, self.top)
+        self.assertEqual(diff_files(files, files, PREFIX), ([], []))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
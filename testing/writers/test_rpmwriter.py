@@ -0,0 +1,148 @@
+"""
+Tests for the RPM writer: the packages are read back with a small parser of the
+lead, the headers and the cpio payload.
+"""
+
+import os
+import gzip
+import stat
+import struct
+import hashlib
+import unittest
+import StringIO
+
+from common import WriterTestCase, METADATA, PREFIX
+
+from rpmwriter import write_rpm
+import rpmwriter
+
+
+
+def _header(data, offset, region_tag):
+    """
+    Parse a header at "offset", returning its tags and the offset after it
+    """
+    if data[offset:offset + 4] != rpmwriter.RPM_HEADER_MAGIC:
+        raise ValueError('no header at %d' % offset)
+    num_entries, data_len = struct.unpack('>II', data[offset + 8:offset + 16])
+    index = offset + 16
+    store = index + num_entries * 16
+
+    tag, type, region_offset, count = struct.unpack('>IIiI', data[index:index + 16])
+    if (tag, type, count) != (region_tag, rpmwriter.RPM_BIN, 16):
+        raise ValueError('no region in the header at %d' % offset)
+    trailer = struct.unpack('>IIiI', data[store + region_offset:store + region_offset + 16])
+    if trailer != (region_tag, rpmwriter.RPM_BIN, -num_entries * 16, 16):
+        raise ValueError('bad region trailer in the header at %d' % offset)
+
+    tags = {}
+    for i in range(1, num_entries):
+        tag, type, value_offset, count = struct.unpack('>IIiI', data[index + i * 16:index + (i + 1) * 16])
+        start = store + value_offset
+        if type in (rpmwriter.RPM_STRING, rpmwriter.RPM_I18NSTRING):
+            value = data[start:data.index('\0', start)]
+        elif type == rpmwriter.RPM_STRING_ARRAY:
+            value = data[start:].split('\0')[:count]
+        elif type == rpmwriter.RPM_INT32:
+            value = list(struct.unpack('>%dI' % count, data[start:start + 4 * count]))
+        elif type == rpmwriter.RPM_INT16:
+            value = list(struct.unpack('>%dH' % count, data[start:start + 2 * count]))
+        else:
+            value = data[start:start + count]
+        tags[tag] = value
+    return tags, store + data_len
+
+
+def _cpio(data):
+    """
+    Return the entries of a "newc" cpio archive, as (name, ino, mode, nlink, data)
+    """
+    entries = []
+    pos = 0
+    while True:
+        if data[pos:pos + 6] != '070701':
+            raise ValueError('bad cpio header at %d' % pos)
+        fields = [int(data[pos + 6 + i * 8:pos + 14 + i * 8], 16) for i in range(13)]
+        ino, mode, nlink, size, namesize = fields[0], fields[1], fields[4], fields[6], fields[11]
+        name = data[pos + 110:pos + 110 + namesize - 1]
+        pos += 110 + namesize
+        pos += -pos % 4
+        contents = data[pos:pos + size]
+        pos += size
+        pos += -pos % 4
+        if name == 'TRAILER!!!':
+            return entries
+        entries.append((name, ino, mode, nlink, contents))
+
+
+class RpmWriterTest(WriterTestCase):
+
+    def _read(self, filename):
+        data = open(filename, 'rb').read()
+        self.assertEqual(data[:4], rpmwriter.RPM_LEAD_MAGIC)
+        self.assertEqual(data[10:76].rstrip('\0'), 'app-1.0-1')
+
+        sig, offset = _header(data, 96, rpmwriter.RPMTAG_HEADERSIGNATURES)
+        offset += -offset % 8
+        header_start = offset
+        header, offset = _header(data, offset, rpmwriter.RPMTAG_HEADERIMMUTABLE)
+
+        header_data, payload = data[header_start:offset], data[offset:]
+        self.assertEqual(sig[rpmwriter.RPMSIGTAG_SIZE], [len(header_data) + len(payload)])
+        self.assertEqual(sig[rpmwriter.RPMSIGTAG_MD5], hashlib.md5(header_data + payload).digest())
+        self.assertEqual(sig[rpmwriter.RPMSIGTAG_SHA256], hashlib.sha256(header_data).hexdigest())
+
+        cpio = gzip.GzipFile(fileobj = StringIO.StringIO(payload)).read()
+        self.assertEqual(sig[rpmwriter.RPMSIGTAG_PAYLOADSIZE], [len(cpio)])
+        return header, _cpio(cpio)
+
+    def test_header(self):
+        header, entries = self._read(write_rpm(self.dest_dir, self.buildroot, PREFIX, METADATA))
+        self.assertEqual(header[rpmwriter.RPMTAG_NAME], 'app')
+        self.assertEqual(header[rpmwriter.RPMTAG_VERSION], '1.0')
+        self.assertEqual(header[rpmwriter.RPMTAG_RELEASE], '1')
+        self.assertEqual(header[rpmwriter.RPMTAG_DESCRIPTION].decode('utf-8'), METADATA['description'])
+        self.assertEqual(header[rpmwriter.RPMTAG_VENDOR].decode('utf-8'), METADATA['vendor'])
+        self.assertEqual(header[rpmwriter.RPMTAG_POSTIN], 'echo installed')
+        self.assertTrue('python' in header[rpmwriter.RPMTAG_REQUIRENAME])
+        self.assertEqual(set(header[rpmwriter.RPMTAG_FILEUSERNAME]), set(['adm']))
+
+    def test_payload(self):
+        header, entries = self._read(write_rpm(self.dest_dir, self.buildroot, PREFIX, METADATA))
+
+        ## the files in the header are the ones in the payload, in the same order
+        names = [header[rpmwriter.RPMTAG_DIRNAMES][i] + name
+                 for i, name in zip(header[rpmwriter.RPMTAG_DIRINDEXES], header[rpmwriter.RPMTAG_BASENAMES])]
+        self.assertEqual(['.' + name for name in names], [e[0] for e in entries])
+        self.assertEqual(header[rpmwriter.RPMTAG_FILEMODES], [e[2] for e in entries])
+
+        ## the data of the hardlinks goes with the last one of them
+        data = {}
+        for name, ino, mode, nlink, contents in entries:
+            if stat.S_ISREG(mode) and contents:
+                data[ino] = contents
+        for (name, ino, mode, nlink, contents), digest in zip(entries, header[rpmwriter.RPMTAG_FILEDIGESTS]):
+            path = self.buildroot + name[1:]
+            if stat.S_ISDIR(mode):
+                self.assertEqual(stat.S_IMODE(mode), METADATA['def_mode'])
+            elif stat.S_ISLNK(mode):
+                self.assertEqual(contents, os.readlink(path))
+            else:
+                self.assertEqual(data[ino], open(path, 'rb').read())
+                self.assertEqual(digest, hashlib.sha256(data[ino]).hexdigest())
+                self.assertEqual(nlink, os.stat(path).st_nlink)
+
+        self.assertTrue(PREFIX + '/var/log' in names)
+        self.assertTrue(PREFIX + '/lib/link.py' in names)
+
+    def test_exclude(self):
+        exclude = lambda path: path.endswith('.cfg')
+        header, entries = self._read(write_rpm(self.dest_dir, self.buildroot, PREFIX, METADATA,
+                                               exclude = exclude))
+        self.assertFalse([e for e in entries if e[0].endswith('app.cfg')])
+        self.assertTrue([e for e in entries if e[0].endswith('data.bin')])
+
+
+
+if __name__ == '__main__':
+    unittest.main()